@@ -0,0 +1,121 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.utils.rag import INDEX_TYPES, create_ann_index  # noqa: E402
+
+
+def synthetic_embeddings(documents, dimension, clusters, seed, chunk_size=100000):
+    # Documents are drawn around topic centroids, closer to real knowledge base embeddings than uniform noise
+    rng = np.random.default_rng(seed)
+    centroids = rng.standard_normal((clusters, dimension)).astype('float32')
+    embeddings = np.empty((documents, dimension), dtype='float32')
+    for start in range(0, documents, chunk_size):
+        end = min(start + chunk_size, documents)
+        topics = rng.integers(0, clusters, end - start)
+        embeddings[start:end] = centroids[topics] + rng.standard_normal((end - start, dimension), dtype='float32')
+    faiss.normalize_L2(embeddings)
+    return embeddings
+
+
+def synthetic_queries(embeddings, queries, noise, seed):
+    rng = np.random.default_rng(seed + 1)
+    picked = embeddings[rng.integers(0, len(embeddings), queries)]
+    vectors = picked + noise * rng.standard_normal(picked.shape, dtype='float32')
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def index_size(index):
+    with tempfile.NamedTemporaryFile(suffix='.faiss') as f:
+        faiss.write_index(index, f.name)
+        return os.path.getsize(f.name)
+
+
+def recall_at_k(ground_truth, results):
+    k = ground_truth.shape[1]
+    found = sum(len(set(truth) & set(result)) for truth, result in zip(ground_truth, results))
+    return found / (len(ground_truth) * k)
+
+
+def benchmark(index_type, embeddings, ids, queries, ground_truth, k, index_config):
+    start = time.perf_counter()
+    index = create_ann_index(embeddings, ids, {**index_config, 'type': index_type})
+    build_seconds = time.perf_counter() - start
+
+    _, results = index.search(queries, k)
+
+    # RAG searches one query at a time, so latency is measured per query
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query.reshape(1, -1), k)
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000
+
+    return {
+        'type': index_type,
+        'recall': recall_at_k(ground_truth, results),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'size_mb': index_size(index) / 2 ** 20,
+        'build_s': build_seconds
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the RAG index types against exact search")
+    parser.add_argument('--documents', type=int, default=100000, help="Synthetic knowledge base size")
+    parser.add_argument('--dimension', type=int, default=384, help="Embedding dimension (384 for all-MiniLM-L6-v2)")
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--k', type=int, default=5, help="Documents retrieved per query")
+    parser.add_argument('--clusters', type=int, default=1000, help="Number of synthetic topics")
+    parser.add_argument('--noise', type=float, default=0.5, help="Query distance from the document it is drawn from")
+    parser.add_argument('--types', nargs='+', default=list(INDEX_TYPES), choices=INDEX_TYPES)
+    parser.add_argument('--nlist', type=int, default=1024)
+    parser.add_argument('--nprobe', type=int, default=16)
+    parser.add_argument('--hnsw-m', type=int, default=32)
+    parser.add_argument('--ef-construction', type=int, default=200)
+    parser.add_argument('--ef-search', type=int, default=64)
+    parser.add_argument('--pq-m', type=int, default=16)
+    parser.add_argument('--pq-nbits', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    index_config = {
+        'nlist': args.nlist,
+        'nprobe': args.nprobe,
+        'hnsw_m': args.hnsw_m,
+        'ef_construction': args.ef_construction,
+        'ef_search': args.ef_search,
+        'pq_m': args.pq_m,
+        'pq_nbits': args.pq_nbits
+    }
+
+    print(f"Generating {args.documents} documents of dimension {args.dimension}...")
+    embeddings = synthetic_embeddings(args.documents, args.dimension, args.clusters, args.seed)
+    ids = np.arange(args.documents, dtype='int64')
+    queries = synthetic_queries(embeddings, args.queries, args.noise, args.seed)
+
+    # Exact search is the reference for recall
+    exact = faiss.IndexFlatIP(args.dimension)
+    exact.add(embeddings)
+    _, ground_truth = exact.search(queries, args.k)
+
+    print(f"{'type':<8} {f'recall@{args.k}':>9} {'p50 ms':>8} {'p95 ms':>8} {'size MB':>9} {'build s':>8}")
+    for index_type in args.types:
+        result = benchmark(index_type, embeddings, ids, queries, ground_truth, args.k, index_config)
+        print(f"{result['type']:<8} {result['recall']:>9.3f} {result['p50_ms']:>8.3f} {result['p95_ms']:>8.3f} "
+              f"{result['size_mb']:>9.1f} {result['build_s']:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,158 @@
 import asyncio
 import json
 import logging
+import re
 
-from utils.error_handling import async_retry_with_backoff
-from utils.llm_utils import get_llm_response
+from src.log_retrieval import RetrievedLogs
+from src.utils.error_handling import async_retry_with_backoff
+from src.utils.json_stream import iter_json_array
+from src.utils.llm_utils import build_retrieval_query, get_llm_response, stream_llm_response
+from src.utils.llm_scheduler import estimate_tokens
+from src.utils.log_cache import field_value, hit_timestamp
+from src.utils.log_statistics import LogStatisticsAnalyzer, statistical_anomalies
+from src.utils.log_templates import LogTemplateMiner
 
 logger = logging.getLogger(__name__)
 
 
-def preprocess_logs(logs):
+def preprocess_logs(logs, config=None):
+    config = config or {}
     combined_logs = []
-    for source, entries in logs.items():
-        for entry in entries:
-            combined_logs.append(f"[{source}] {json.dumps(entry)}")
+    # Server-side summaries cover every matching hit and come first, so truncation never drops them
+    for source, summary in getattr(logs, 'summaries', {}).items():
+        combined_logs.append(f"[{source} summary] {json.dumps(summary)}")
+
+    template_config = config.get('templates', {})
+    if template_config.get('enabled', True):
+        # Repetitive entries are collapsed into templates, so the whole time window fits in the prompt
+        miner = LogTemplateMiner(template_config)
+        for source, entries in logs.items():
+            for entry in entries:
+                miner.add(source, entry)
+        combined_logs.extend(miner.render())
+    else:
+        for source, entries in logs.items():
+            for entry in entries:
+                combined_logs.append(f"[{source}] {json.dumps(entry)}")
 
-    max_chars = 15000  # Adjust based on LLM token limit
+    max_chars = config.get('max_log_chars', 15000)  # Adjust based on LLM token limit
     combined_logs_str = "\n".join(combined_logs)
-    if len(combined_logs_str) > max_chars:
+    if max_chars and len(combined_logs_str) > max_chars:
         combined_logs_str = combined_logs_str[:max_chars] + "... [truncated]"
 
     return combined_logs_str
 
 
+def chunk_logs(logs, max_chunk_tokens, date_field='date'):
+    # Consecutive entries of one source in time order, each chunk within the token budget, so related events are
+    # analysed together
+    chunks = []
+    for source, entries in logs.items():
+        chunk, chunk_tokens = [], 0
+        for entry in sorted(entries, key=lambda entry: hit_timestamp(field_value(entry, date_field))):
+            tokens = estimate_tokens(json.dumps(entry), 0)
+            if chunk and chunk_tokens + tokens > max_chunk_tokens:
+                chunks.append((source, chunk))
+                chunk, chunk_tokens = [], 0
+            chunk.append(entry)
+            chunk_tokens += tokens
+        if chunk:
+            chunks.append((source, chunk))
+    return chunks
+
+
+def description_words(anomaly):
+    # Counts, times and dates differ between the chunks reporting the same finding, they are not compared
+    words = re.findall(r'[a-z0-9]+', str(anomaly.get('description', '')).lower())
+    return {word for word in words if not word.isdigit()}
+
+
+ENTITY_KEYWORDS = {
+    'user': 'user', 'userid': 'user', 'office': 'office', 'officeid': 'office', 'ip': 'ip', 'address': 'ip',
+    'host': 'host'
+}
+ENTITY_STOPWORDS = {'a', 'an', 'and', 'from', 'in', 'is', 'of', 'on', 'the', 'to', 'was', 'with'}
+IP_PATTERN = re.compile(r'\b\d{1,3}(?:\.\d{1,3}){3}\b')
+
+
+def description_entities(anomaly):
+    # The users, IPs, offices or other identifiers a finding names, by kind: IP addresses, and the value following an
+    # entity keyword ("user jdoe", "office NCE1A0950")
+    description = str(anomaly.get('description', '')).lower()
+    entities = {}
+    for ip in IP_PATTERN.findall(description):
+        entities.setdefault('ip', set()).add(ip)
+    tokens = [token.rstrip('.') for token in re.findall(r'[a-z0-9][a-z0-9._@-]*', description)]
+    for keyword, value in zip(tokens, tokens[1:]):
+        kind = ENTITY_KEYWORDS.get(keyword)
+        if kind and value not in ENTITY_KEYWORDS and value not in ENTITY_STOPWORDS and not value.isdigit():
+            entities.setdefault(kind, set()).add(value)
+    return entities
+
+
+def conflicting_entities(first, second):
+    # Both findings name a user (or an IP, an office...) and not the same one
+    return any(kind in second and not values & second[kind] for kind, values in first.items())
+
+
+def confidence(anomaly):
+    try:
+        return float(anomaly.get('confidence_score', 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def merge_anomalies(anomalies, similarity=0.6):
+    # Anomalies whose descriptions share most of their words and name no conflicting entities are the same finding
+    # reported by several chunks. The chunks share the prompt and the model, so their reports are not independent:
+    # the merged finding keeps the confidence of its best report
+    groups = []
+    for anomaly in sorted(anomalies, key=confidence, reverse=True):
+        words, entities = description_words(anomaly), description_entities(anomaly)
+        for group in groups:
+            union = words | group['words']
+            if conflicting_entities(entities, group['entities']):
+                continue
+            if union and len(words & group['words']) / len(union) >= similarity:
+                group['members'].append(anomaly)
+                for kind, values in entities.items():
+                    group['entities'].setdefault(kind, set()).update(values)
+                break
+        else:
+            groups.append({'words': words, 'entities': entities, 'members': [anomaly]})
+
+    merged = []
+    for group in groups:
+        best, members = group['members'][0], group['members']
+        supporting_data, recommended_actions, patterns = [], [], []
+        for member in members:
+            for target, value in ((supporting_data, member.get('supporting_data')),
+                                  (recommended_actions, member.get('recommended_actions')),
+                                  (patterns, member.get('patterns'))):
+                for item in value if isinstance(value, list) else [value]:
+                    if item is not None and item not in target:
+                        target.append(item)
+        merged.append({
+            **best,
+            'supporting_data': supporting_data,
+            'confidence_score': confidence(best),
+            'recommended_actions': recommended_actions,
+            'patterns': patterns
+        })
+    merged.sort(key=confidence, reverse=True)
+    return merged
+
+
+def find_sections(analysis, names):
+    # The analysis keys are chosen by the LLM, e.g. "Initial Hypotheses", "initial_hypotheses" or "hypotheses"
+    if not isinstance(analysis, dict):
+        return []
+    return [
+        value for key, value in analysis.items()
+        if any(name in key.lower().replace(' ', '_') for name in names)
+    ]
+
+
 def parse_llm_response(llm_response):
     try:
         anomalies = json.loads(llm_response)
@@ -38,6 +169,10 @@ class AnomalyDetectionModule:
         self.config = config
         self.llm_config = llm_config
         self.rag = rag
+        statistics_config = config.get('statistics', {})
+        self.statistics = None
+        if statistics_config.get('enabled', True) or not config.get('use_llm', True):
+            self.statistics = LogStatisticsAnalyzer(statistics_config)
         self.prompt_template = """
 
         Analyze the following log data and incident understanding to detect any anomalies, suspicious patterns, or indicators of fraud:
@@ -45,7 +180,11 @@ class AnomalyDetectionModule:
         Incident Understanding:
         {incident_understanding}
 
-        Log Data:
+        Statistical Analysis (computed over every retrieved log entry, candidates ranked by score):
+        {statistics}
+
+        Log Data (repeated entries are collapsed into templates, where <*> marks a variable part, with their count and
+        first and last timestamps, followed by the rare entries verbatim and a few exemplars of each template):
         {log_data}
 
         Please provide a comprehensive analysis considering various fraud scenarios and anomaly types. For each detected anomaly, provide:
@@ -77,24 +216,30 @@ class AnomalyDetectionModule:
         structure without any additional text output. Validate the JSONs structure before returning the result.
         """
 
-    @async_retry_with_backoff(max_attempts=3, backoff_in_seconds=1)
     async def detect(self, logs, understanding):
         try:
-            combined_logs = preprocess_logs(logs)
-
-            prompt = self.prompt_template.format(
-                incident_understanding=json.dumps(understanding['analysis'], indent=2),
-                log_data=combined_logs
-            )
-
-            if self.rag is None:
-                prompt = self.llm_config['context'] + prompt
-
-            llm_response = await get_llm_response(prompt, self.llm_config, self.rag)
+            statistics = None
+            if self.statistics is not None:
+                # CPU bound on large incidents, kept off the event loop
+                statistics = await asyncio.to_thread(self.statistics.analyze, logs)
 
-            anomalies = parse_llm_response(llm_response)
+            if not self.config.get('use_llm', True):
+                anomalies = self.filter_anomalies(statistical_anomalies(statistics))
+                anomalies = anomalies[:self.config.get('max_anomalies', len(anomalies))]
+                logger.info(f"Detected {len(anomalies)} statistical anomalies for incident "
+                            f"{understanding['incident_id']}")
+                return anomalies
 
-            filtered_anomalies = self.filter_anomalies(anomalies)
+            if self.config.get('chunking', {}).get('enabled', False):
+                anomalies = await self.detect_chunked(logs, understanding, statistics)
+                filtered_anomalies = self.filter_anomalies(anomalies)
+                filtered_anomalies = filtered_anomalies[:self.config.get('max_anomalies', len(filtered_anomalies))]
+            else:
+                # Chunks are retried one by one, only the single prompt is retried here
+                combined_logs = preprocess_logs(logs, self.config)
+                analyze = async_retry_with_backoff(max_attempts=3, backoff_in_seconds=1)(self.analyze)
+                anomalies = await analyze(combined_logs, understanding, statistics)
+                filtered_anomalies = self.filter_anomalies(anomalies)
 
             logger.info(f"Detected {len(filtered_anomalies)} anomalies for incident {understanding['incident_id']}")
             return filtered_anomalies
@@ -102,6 +247,82 @@ class AnomalyDetectionModule:
             logger.error(f"Error detecting anomalies for incident {understanding['incident_id']}: {str(e)}")
             raise
 
+    def build_prompt(self, log_data, understanding, statistics):
+        prompt = self.prompt_template.format(
+            incident_understanding=json.dumps(understanding['analysis'], indent=2),
+            statistics=json.dumps(statistics, indent=2) if statistics is not None else "Not available",
+            log_data=log_data
+        )
+
+        if self.rag is None:
+            prompt = self.llm_config['context'] + prompt
+        return prompt
+
+    async def analyze(self, log_data, understanding, statistics):
+        prompt = self.build_prompt(log_data, understanding, statistics)
+        retrieval_query = self.build_retrieval_query(understanding)
+        # Knowledge base documents already given to the understanding stage are not sent again
+        seen_documents = set(understanding.get('context_documents', []))
+        if self.llm_config.get('streaming', False):
+            stream = stream_llm_response(prompt, self.llm_config, self.rag, retrieval_query=retrieval_query,
+                                         seen_documents=seen_documents)
+            return [anomaly async for anomaly in iter_json_array(stream) if isinstance(anomaly, dict)]
+        llm_response = await get_llm_response(prompt, self.llm_config, self.rag,
+                                              retrieval_query=retrieval_query, seen_documents=seen_documents)
+        return parse_llm_response(llm_response)
+
+    async def detect_chunked(self, logs, understanding, statistics):
+        # Map: every chunk is analysed on its own, concurrently. Reduce: the findings of all chunks are merged
+        chunking = self.config['chunking']
+        date_field = chunking.get('date_field', 'date')
+        summaries = getattr(logs, 'summaries', {})
+        # max_chunk_tokens bounds the whole prompt: the template, understanding, statistics and summaries sent with
+        # every chunk are taken off the budget of its log entries
+        fixed_tokens = estimate_tokens(self.build_prompt('', understanding, statistics), 0) + max(
+            [estimate_tokens(f"[{source} summary] {json.dumps(summary)}", 0) for source, summary in summaries.items()],
+            default=0
+        )
+        max_chunk_tokens = chunking.get('max_chunk_tokens', 8000)
+        if fixed_tokens >= max_chunk_tokens:
+            raise ValueError(f"max_chunk_tokens ({max_chunk_tokens}) leaves no room for log entries, the rest of the "
+                             f"prompt takes {fixed_tokens} tokens")
+        chunks = chunk_logs(logs, max_chunk_tokens - fixed_tokens, date_field)
+        semaphore = asyncio.Semaphore(chunking.get('max_concurrent_chunks', 4))
+        analyze_chunk = async_retry_with_backoff(
+            max_attempts=chunking.get('retry_attempts', 2), backoff_in_seconds=1
+        )(self.analyze)
+
+        async def run(source, entries):
+            chunk = RetrievedLogs({source: entries})
+            if source in summaries:
+                chunk.summaries[source] = summaries[source]
+            # The chunk already fits the budget, it is not truncated
+            log_data = preprocess_logs(chunk, {**self.config, 'max_log_chars': None})
+            async with semaphore:
+                return await analyze_chunk(log_data, understanding, statistics)
+
+        results = await asyncio.gather(*[run(source, entries) for source, entries in chunks], return_exceptions=True)
+        failures = [result for result in results if isinstance(result, Exception)]
+        if chunks and len(failures) == len(chunks):
+            raise failures[0]
+        if failures:
+            logger.warning(f"{len(failures)} of {len(chunks)} log chunks could not be analysed for incident "
+                           f"{understanding['incident_id']}")
+
+        anomalies = [anomaly for result in results if isinstance(result, list) for anomaly in result]
+        merged = merge_anomalies(anomalies, chunking.get('merge_similarity', 0.6))
+        logger.debug(f"Merged {len(anomalies)} anomalies from {len(chunks)} chunks into {len(merged)}")
+        return merged
+
+    def build_retrieval_query(self, understanding):
+        analysis = understanding.get('analysis')
+        return build_retrieval_query(
+            understanding.get('retrieval_query'),
+            find_sections(analysis, ('summary',)),
+            find_sections(analysis, ('investigation_areas', 'key_areas')),
+            find_sections(analysis, ('hypothes',))
+        )
+
     def filter_anomalies(self, anomalies):
         return [
             anomaly for anomaly in anomalies
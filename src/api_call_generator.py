@@ -3,7 +3,9 @@ import json
 import logging
 
 from src.utils.error_handling import async_retry_with_backoff
-from src.utils.llm_utils import get_llm_response
+from src.utils.json_stream import iter_json_array
+from src.utils.llm_scheduler import PRIORITY_HIGH
+from src.utils.llm_utils import get_llm_response, stream_llm_response
 
 logger = logging.getLogger(__name__)
 
@@ -28,17 +30,20 @@ class ApiCallGenerator:
         API call). Ensure that the generated JSONs are well-formed, properly escaped, and follow the specified 
         structure without any additional text output. Validate the JSON structure before returning the result."""
 
+    def build_prompt(self, understanding):
+        log_types = ', '.join(self.config['names_list'])
+
+        return self.prompt_template.format(
+            understanding=json.dumps(understanding['analysis'], indent=2),
+            logs_names_list=log_types
+        )
+
     @async_retry_with_backoff(max_attempts=3, backoff_in_seconds=1)
     async def generate(self, understanding):
         try:
-            log_types = ', '.join(self.config['names_list'])
+            prompt = self.build_prompt(understanding)
 
-            prompt = self.prompt_template.format(
-                understanding=json.dumps(understanding['analysis'], indent=2),
-                logs_names_list=log_types
-            )
-
-            api_calls_str = await get_llm_response(prompt, self.llm_config)
+            api_calls_str = await get_llm_response(prompt, self.llm_config, priority=PRIORITY_HIGH)
             api_calls = self.parse_api_calls(api_calls_str)
 
             logger.info(f"Generated {len(api_calls)} API calls for incident {understanding['incident_id']}")
@@ -47,6 +52,23 @@ class ApiCallGenerator:
             logger.error(f"Error generating API calls for incident {understanding['incident_id']}: {str(e)}")
             raise
 
+    async def stream(self, understanding):
+        # Yields each API call as soon as its JSON object is complete, so retrieval can start before the end
+        prompt = self.build_prompt(understanding)
+        count = 0
+        try:
+            async for api_call in iter_json_array(stream_llm_response(prompt, self.llm_config, priority=PRIORITY_HIGH)):
+                if not isinstance(api_call, dict):
+                    logger.warning(f"Ignoring API call that is not a JSON object: {api_call}")
+                    continue
+                count += 1
+                yield self.validate_api_call(api_call)
+        except Exception as e:
+            logger.error(f"Error streaming API calls for incident {understanding['incident_id']}: {str(e)}")
+            raise
+
+        logger.info(f"Streamed {count} API calls for incident {understanding['incident_id']}")
+
     def parse_api_calls(self, api_calls_str):
         try:
             api_calls = json.loads(api_calls_str)
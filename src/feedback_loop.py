@@ -1,5 +1,6 @@
 import asyncio
 import json
+from src.utils.llm_scheduler import PRIORITY_LOW
 from src.utils.llm_utils import get_llm_response
 
 
@@ -37,7 +38,7 @@ class FeedbackLoop:
         Format your response as a JSON object with clear sections for each type of insight or recommendation.
         """
 
-        insights = await get_llm_response(prompt, self.llm_config)
+        insights = await get_llm_response(prompt, self.llm_config, priority=PRIORITY_LOW)
         await self.apply_insights(insights)
         self.feedback_data = []  # Clear processed feedback
 
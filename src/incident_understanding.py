@@ -2,8 +2,9 @@ import asyncio
 import json
 import logging
 
-from utils.error_handling import async_retry_with_backoff
-from utils.llm_utils import get_llm_response
+from src.utils.error_handling import async_retry_with_backoff
+from src.utils.llm_scheduler import PRIORITY_HIGH
+from src.utils.llm_utils import build_retrieval_query, get_llm_response
 
 logger = logging.getLogger(__name__)
 
@@ -17,10 +18,11 @@ def structure_understanding(raw_understanding):
 
 
 class IncidentUnderstandingModule:
-    def __init__(self, llm_config, rag):
+    def __init__(self, llm_config, rag, config=None):
         self.llm_config = llm_config
         self.rag = rag
-        self.prompt_template = """
+        self.config = config or {}
+        self.incident_template = """
 
         **Analyze the provided incident details and generate a structured analysis with actionable insights:**
         
@@ -29,7 +31,8 @@ class IncidentUnderstandingModule:
         - **Timestamp:** {timestamp}  
         - **Description:** {description}  
         
-        **Your analysis must include all the following sections:**  
+"""
+        self.analysis_template = """        **Your analysis must include all the following sections:**  
         1. **Incident Summary:** A concise but thorough overview of the incident (be sure to include the timestamps).
         2. **Impact Assessment:** Evaluate the potential impact and assign a severity score on a scale of 1-10, with reasoning for the score.  
         3. **Key Investigation Areas:** Highlight the critical elements or anomalies that require immediate attention.  
@@ -42,7 +45,8 @@ class IncidentUnderstandingModule:
         - Use the provided details and relate them to any similar past incidents or known fraud patterns.  
         - Highlight any trends or correlations that could aid in understanding the incident further.  
         
-        **Output Format:**  
+"""
+        self.output_template = """        **Output Format:**  
         Provide your response as a JSON object.  
         
         **Additional Requirements:**  
@@ -52,6 +56,25 @@ class IncidentUnderstandingModule:
         **Objective:** Provide a comprehensive and actionable analysis of the incident based on the given data and context.  
         
         """
+        self.prompt_template = self.incident_template + self.analysis_template + self.output_template
+        self.batch_incident_template = """
+
+        **Analyze each of the following incidents separately and generate a structured analysis with actionable insights for each one:**
+        
+        {incidents}
+        
+"""
+        self.batch_output_template = """        **Output Format:**  
+        Provide your response as a single JSON object whose keys are the incident IDs listed above and whose values 
+        are the analysis of the corresponding incident, each one being a JSON object with all the sections above. 
+        Do not merge incidents together and do not add any text outside of the JSON object.
+        
+        **Additional Requirements:**  
+        - Ensure all special characters, particularly those that may conflict with APIs (e.g., quotation marks, slashes, newlines), are properly escaped.  
+        - Use concise and clear language to maximize readability and accuracy.  
+        
+        """
+        self.batch_prompt_template = self.batch_incident_template + self.analysis_template + self.batch_output_template
 
     @async_retry_with_backoff(max_attempts=3, backoff_in_seconds=1)
     async def process(self, incident):
@@ -65,18 +88,94 @@ class IncidentUnderstandingModule:
             if self.rag is None:
                 prompt = self.llm_config['context'] + prompt
 
-            understanding = await get_llm_response(prompt, self.llm_config, self.rag)
+            # The knowledge base is searched with the incident itself, not with the instructions around it
+            retrieval_query = self.build_retrieval_query(incident)
+            seen_documents = set()
+            understanding = await get_llm_response(prompt, self.llm_config, self.rag, priority=PRIORITY_HIGH,
+                                                   retrieval_query=retrieval_query, seen_documents=seen_documents)
             structured_understanding = structure_understanding(understanding)
 
             logger.info(f"Processed understanding for incident {incident['id']}")
-            return {
-                "incident_id": incident['id'],
-                "analysis": structured_understanding
-            }
+            return self.build_understanding(incident, structured_understanding, seen_documents)
         except Exception as e:
             logger.error(f"Error processing incident {incident['id']}: {str(e)}")
             raise
 
+    def build_retrieval_query(self, incident):
+        return build_retrieval_query(incident['description'])
+
+    def build_understanding(self, incident, analysis, seen_documents):
+        return {
+            "incident_id": incident['id'],
+            "analysis": analysis,
+            "retrieval_query": self.build_retrieval_query(incident),
+            "context_documents": sorted(seen_documents)
+        }
+
+    async def process_batch(self, incidents):
+        max_per_prompt = self.config.get('max_incidents_per_prompt', 5)
+        chunks = [incidents[i:i + max_per_prompt] for i in range(0, len(incidents), max_per_prompt)]
+        results = await asyncio.gather(*[self.process_chunk(chunk) for chunk in chunks], return_exceptions=True)
+
+        # A failed incident is left out, it gets its own understanding attempt when it is processed
+        understandings = {}
+        for chunk, result in zip(chunks, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error processing incidents {[incident['id'] for incident in chunk]}: {str(result)}")
+            else:
+                understandings.update(result)
+        return understandings
+
+    async def process_chunk(self, incidents):
+        seen_documents = set()
+        analyses = {}
+        if len(incidents) > 1:
+            try:
+                analyses = await self.request_batch(incidents, seen_documents)
+            except Exception as e:
+                logger.warning(f"Batched understanding of {len(incidents)} incidents failed: {str(e)}")
+
+        understandings = {}
+        missing = []
+        for incident in incidents:
+            analysis = analyses.get(str(incident['id']))
+            if isinstance(analysis, dict):
+                understandings[incident['id']] = self.build_understanding(incident, analysis, seen_documents)
+            else:
+                missing.append(incident)
+
+        if missing:
+            if len(incidents) > 1:
+                logger.warning(f"Falling back to per-incident understanding for {len(missing)} incidents")
+            results = await asyncio.gather(*[self.process(incident) for incident in missing], return_exceptions=True)
+            for incident, result in zip(missing, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Error processing incident {incident['id']}: {str(result)}")
+                else:
+                    understandings[incident['id']] = result
+
+        logger.info(f"Processed batched understanding for {len(incidents) - len(missing)} of {len(incidents)} incidents")
+        return understandings
+
+    async def request_batch(self, incidents, seen_documents=None):
+        incidents_str = "\n        ".join(
+            f"- **Incident ID:** {incident['id']} | **Timestamp:** {incident['timestamp']} | "
+            f"**Description:** {incident['description']}"
+            for incident in incidents
+        )
+        prompt = self.batch_prompt_template.format(incidents=incidents_str)
+
+        if self.rag is None:
+            prompt = self.llm_config['context'] + prompt
+
+        retrieval_query = build_retrieval_query([incident['description'] for incident in incidents])
+        response = await get_llm_response(prompt, self.llm_config, self.rag, priority=PRIORITY_HIGH,
+                                          retrieval_query=retrieval_query, seen_documents=seen_documents)
+        analyses = json.loads(response)
+        if not isinstance(analyses, dict):
+            raise ValueError("Batched understanding is not a JSON object")
+        return analyses
+
 
 # Example usage
 async def main():
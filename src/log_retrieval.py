@@ -1,23 +1,55 @@
 import asyncio
+import json
 import logging
-
-from elasticsearch import AsyncElasticsearch
-from sshtunnel import SSHTunnelForwarder
+from contextlib import aclosing
+from datetime import datetime, timedelta
 
 from src.utils.error_handling import async_retry_with_backoff
+from src.utils.es_clients import ElasticsearchClientRegistry
+from src.utils.file_log_source import FileLogSource
+from src.utils.log_cache import (DayPartitionedLogCache, contiguous_ranges, day_partitions, field_value,
+                                  hit_timestamp, partition_by_day)
+from src.utils.performance import SingleFlight
+from src.utils.ssh_tunnel import SSHTunnelManager
 
 logger = logging.getLogger(__name__)
 
 
-def build_elasticsearch_query(api_call):
+WILDCARD_CHARACTERS = ('*', '?')
+DEFAULT_QUERY_FIELDS = {'officeId': 'officeId', 'userId': 'user.userId', 'date': 'date'}
+
+
+def build_match_clause(field, value):
+    # Exact values are a term dictionary lookup, only real patterns pay for a wildcard scan
+    if isinstance(value, (list, tuple)):
+        values = [str(item).strip() for item in value if str(item).strip() not in ('', '*')]
+        if not values or len(values) < len(value):
+            return None
+        if any(character in item for item in values for character in WILDCARD_CHARACTERS):
+            return {"bool": {"should": [build_match_clause(field, item) for item in values], "minimum_should_match": 1}}
+        return {"terms": {field: values}} if len(values) > 1 else {"term": {field: values[0]}}
+
+    if value is None or str(value).strip() in ('', '*'):
+        return None
+    value = str(value).strip()
+    if any(character in value for character in WILDCARD_CHARACTERS):
+        if value[0] in WILDCARD_CHARACTERS:
+            logger.debug(f"Leading wildcard on {field} ({value}) scans the whole term dictionary")
+        return {"wildcard": {field: {"value": value}}}
+    return {"term": {field: value}}
+
+
+def build_elasticsearch_query(api_call, query_fields=None):
+    fields = {**DEFAULT_QUERY_FIELDS, **(query_fields or {})}
+    clauses = [
+        build_match_clause(fields['officeId'], api_call.get('officeId')),
+        build_match_clause(fields['userId'], api_call.get('userId'))
+    ]
+    # Everything is in filter context: no scoring is needed and ES can cache the clauses, the date range included
     query = {
         "bool": {
-            "must": [
-                {"wildcard": {"officeId": f"*{api_call["officeId"]}*"}},
-                {"wildcard": {"user.userId": f"{api_call["userId"]}"}}
-            ],
-            "filter": [
-                {"range": {"date": {"gte": f"{api_call["date_from"]}", "lt": f"{api_call["date_to"]}"}}}
+            "filter": [clause for clause in clauses if clause is not None] + [
+                {"range": {fields['date']: {"gte": api_call["date_from"], "lt": api_call["date_to"]}}}
             ]
         }
     }
@@ -25,47 +57,166 @@ def build_elasticsearch_query(api_call):
     return query
 
 
+def time_shards(date_from, date_to, shard_hours=None):
+    # Splits [date_from, date_to) into consecutive shards, keeping plain dates when the shards are whole days
+    if not shard_hours:
+        return [(date_from, date_to)]
+    try:
+        start = datetime.fromisoformat(str(date_from))
+        end = datetime.fromisoformat(str(date_to))
+        if end <= start:
+            return [(date_from, date_to)]
+    except (TypeError, ValueError):
+        return [(date_from, date_to)]
+
+    plain_dates = len(str(date_from)) == 10 and len(str(date_to)) == 10 and shard_hours % 24 == 0
+    shards = []
+    current = start
+    while current < end:
+        following = min(current + timedelta(hours=shard_hours), end)
+        if plain_dates:
+            shards.append((current.date().isoformat(), following.date().isoformat()))
+        else:
+            shards.append((current.isoformat(), following.isoformat()))
+        current = following
+    return shards
+
+
+def summarize_aggregation(result):
+    # Turns an Elasticsearch aggregation result into a compact {bucket: count} or value for the prompt
+    if 'buckets' in result:
+        buckets = result['buckets']
+        if isinstance(buckets, dict):
+            buckets = [{'key': key, **bucket} for key, bucket in buckets.items()]
+        summary = {}
+        for bucket in buckets:
+            key = str(bucket.get('key_as_string', bucket['key']))
+            sub_aggregations = {
+                name: summarize_aggregation(value) for name, value in bucket.items() if isinstance(value, dict)
+            }
+            summary[key] = {'count': bucket['doc_count'], **sub_aggregations} if sub_aggregations \
+                else bucket['doc_count']
+        return summary
+    if 'value' in result:
+        return result.get('value_as_string', result['value'])
+    return result
+
+
+class RetrievedLogs(dict):
+    # Hits per source, with the server-side aggregation summaries per source alongside
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.summaries = {}
+
+
 class LogRetrievalEngine:
     def __init__(self, config):
         self.config = config
-        self.es_client = None
+        self.search_flight = SingleFlight('Elasticsearch')
+        self.tunnels = None
+        if config.get('use_ssh_tunnel', False):
+            # One persistent tunnel per endpoint shared by every incident instead of one SSH handshake per incident
+            endpoints = {'default': config['tunnel']}
+            endpoints.update({tunnel['name']: tunnel for tunnel in config.get('tunnels', [])})
+            self.tunnels = SSHTunnelManager(endpoints, config['tunnel'].get('health_check_interval', 15))
+        self.es_clients = ElasticsearchClientRegistry(self.tunnels, config.get('max_concurrent_requests', 20))
+        self.file_sources = {}
+        self.log_cache = None
+        cache_config = config.get('cache', {})
+        if cache_config.get('enabled', False):
+            self.log_cache = DayPartitionedLogCache(
+                max_size_mb=cache_config.get('max_size_mb', 256),
+                ttl_seconds=cache_config.get('ttl_seconds', 604800),
+                current_day_ttl_seconds=cache_config.get('current_day_ttl_seconds', 300)
+            )
 
     async def retrieve(self, api_calls):
-        tasks = [self.process_api_call(call) for call in api_calls]
+        return await self.gather_logs(api_calls)
+
+    async def stream(self, api_calls):
+        # Yields (source, page of hits) as soon as any call returns a page, without collecting the full results.
+        # api_calls is a list or an async iterator of calls streamed from the LLM, each call starts when it arrives.
+        # The queue is bounded, so a slow consumer pauses the searches. The pipeline itself uses retrieve: the
+        # statistics, template mining and aggregation summaries of anomaly detection need the whole time window
+        queue = asyncio.Queue(maxsize=self.config.get('stream_queue_size', 8))
+        page_done, calls_done = object(), object()
+        tasks = []
+
+        async def produce(call):
+            try:
+                async with aclosing(self.iter_api_call(call)) as pages:
+                    async for page in pages:
+                        await queue.put((call['target_log_source'], page))
+            except Exception as e:
+                logger.error(f"Error retrieving logs for {call['target_log_source']}: {str(e)}")
+            await queue.put(page_done)
+
+        async def feed():
+            error = None
+            try:
+                if hasattr(api_calls, '__aiter__'):
+                    async for call in api_calls:
+                        tasks.append(asyncio.create_task(produce(call)))
+                else:
+                    for call in api_calls:
+                        tasks.append(asyncio.create_task(produce(call)))
+            except Exception as e:
+                error = e
+            await queue.put((calls_done, error))
+
+        feeder = asyncio.create_task(feed())
+        try:
+            finished, fed = 0, False
+            while not fed or finished < len(tasks):
+                item = await queue.get()
+                if item is page_done:
+                    finished += 1
+                elif item[0] is calls_done:
+                    fed = True
+                    if item[1] is not None:
+                        raise item[1]
+                else:
+                    yield item
+        finally:
+            feeder.cancel()
+            for task in tasks:
+                task.cancel()
+
+    async def gather_logs(self, api_calls):
+        # api_calls is either a list or an async iterator of calls streamed from the LLM, in which case
+        # each query is started as soon as its call arrives
+        if hasattr(api_calls, '__aiter__'):
+            calls, tasks = [], []
+            try:
+                async for call in api_calls:
+                    calls.append(call)
+                    tasks.append(asyncio.create_task(self.process_api_call(call)))
+            except Exception:
+                for task in tasks:
+                    task.cancel()
+                raise
+        else:
+            calls = list(api_calls)
+            tasks = [self.process_api_call(call) for call in calls]
         results = await asyncio.gather(*tasks, return_exceptions=True)
 
-        logs = {}
-        for call, result in zip(api_calls, results):
+        logs = RetrievedLogs()
+        for call, result in zip(calls, results):
             if isinstance(result, Exception):
                 logger.error(f"Error retrieving logs for {call['target_log_source']}: {str(result)}")
             else:
-                logs[call['target_log_source']] = result
+                hits, summary = result
+                logs[call['target_log_source']] = hits
+                if summary is not None:
+                    logs.summaries[call['target_log_source']] = summary
 
         return logs
 
     async def retrieve_with_tunnel(self, api_calls):
-        with SSHTunnelForwarder(
-                self.config['tunnel']['url'],
-                ssh_username="userHolder".replace('userHolder', self.config['tunnel']['user']),
-                ssh_password="pwdHolder".replace('pwdHolder', self.config['tunnel']['password']),
-                remote_bind_address=(self.config['tunnel']['remote_bind_url'], self.config['tunnel']['remote_bind_port']),
-                local_bind_address=(self.config['tunnel']['local_bind_url'], self.config['tunnel']['local_bind_port'])
-        ) as server:
-            server.start()
-            tasks = [self.process_api_call(call) for call in api_calls]
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-
-            logs = {}
-            for call, result in zip(api_calls, results):
-                if isinstance(result, Exception):
-                    logger.error(f"Error retrieving logs for {call['target_log_source']}: {str(result)}")
-                else:
-                    logs[call['target_log_source']] = result
-
-            server.stop()
-            return logs
+        # The tunnels are opened on demand by the client registry
+        return await self.gather_logs(api_calls)
 
-    async def process_api_call(self, api_call):
+    def get_source_type(self, api_call):
         source_type = ""
         source = api_call['target_log_source']
         if source in self.config["names_list"]:
@@ -74,34 +225,223 @@ class LogRetrievalEngine:
                     source_type = option["type"]
         else:
             raise ValueError(f"Unsupported log source: {source}")
+        return source_type
+
+    async def process_api_call(self, api_call):
+        source_type = self.get_source_type(api_call)
 
         match source_type:
             case "elasticsearch":
-                return await self.get_elasticsearch_logs(api_call)
+                hits, summary = await asyncio.gather(
+                    self.get_elasticsearch_logs(api_call), self.get_elasticsearch_summary(api_call),
+                    return_exceptions=True
+                )
+                if isinstance(hits, Exception):
+                    raise hits
+                # The summary is optional, a failed or rejected aggregation does not discard the hits
+                if isinstance(summary, Exception):
+                    logger.error(f"Aggregations failed for {api_call['target_log_source']}: {str(summary)}")
+                    summary = None
+                return hits, summary
+            case "file":
+                return await self.get_file_logs(api_call), None
             case _:
                 raise ValueError(f"Unsupported source type: {source_type}")
 
-    @async_retry_with_backoff(max_attempts=3, backoff_in_seconds=1)
+    async def iter_api_call(self, api_call):
+        source_type = self.get_source_type(api_call)
+
+        match source_type:
+            case "elasticsearch":
+                es_config, query = self.prepare_elasticsearch_query(api_call)
+                async with aclosing(self.iter_elasticsearch_pages(es_config, query)) as pages:
+                    async for page in pages:
+                        yield page
+            case "file":
+                hits = await self.get_file_logs(api_call)
+                page_size = self.get_source_config(api_call['target_log_source']).get('page_size', 1000)
+                for start in range(0, len(hits), page_size):
+                    yield hits[start:start + page_size]
+            case _:
+                raise ValueError(f"Unsupported source type: {source_type}")
+
+    def prepare_elasticsearch_query(self, api_call):
+        es_config = self.get_source_config(api_call['target_log_source'])
+        return es_config, build_elasticsearch_query(api_call, es_config.get('query_fields'))
+
     async def get_elasticsearch_logs(self, api_call):
-        es_config = next(source for source in self.config["sources"] if source['type'] == 'elasticsearch')
+        return await self.get_cached_logs(
+            api_call, lambda call: self.fetch_sharded_logs(call, self.fetch_elasticsearch_logs)
+        )
 
-        if not self.es_client:
-            self.es_client = AsyncElasticsearch(
-                es_config["url"],
-                http_auth=(es_config["username"], es_config["password"]),
-                timeout=es_config['timeout']
-            )
+    async def get_file_logs(self, api_call):
+        source_config = self.get_source_config(api_call['target_log_source'])
+        if source_config['name'] not in self.file_sources:
+            self.file_sources[source_config['name']] = FileLogSource(source_config)
+        file_source = self.file_sources[source_config['name']]
+        return await self.get_cached_logs(api_call, lambda call: self.fetch_sharded_logs(call, file_source.fetch))
+
+    async def fetch_sharded_logs(self, api_call, fetch):
+        # A wide date range is queried as several shards in parallel, each one retried on its own
+        source_config = self.get_source_config(api_call['target_log_source'])
+        shards = time_shards(api_call['date_from'], api_call['date_to'], source_config.get('shard_hours'))
+        semaphore = asyncio.Semaphore(source_config.get('max_parallel_shards', 4))
+        fetch_shard = async_retry_with_backoff(
+            max_attempts=source_config.get('retry_attempts', 3),
+            backoff_in_seconds=source_config.get('retry_delay', 1)
+        )(fetch)
+
+        async def run(date_from, date_to):
+            async with semaphore:
+                return await fetch_shard({**api_call, 'date_from': date_from, 'date_to': date_to})
+
+        results = await asyncio.gather(*[run(date_from, date_to) for date_from, date_to in shards])
+
+        # Shards are in time order and do not overlap, sorting each one orders the whole range
+        date_field = source_config.get('query_fields', {}).get('date', 'date')
+        hits = [
+            hit for shard_hits in results
+            for hit in sorted(shard_hits, key=lambda hit: hit_timestamp(field_value(hit, date_field)))
+        ]
+        max_hits = source_config.get('max_hits', 10000)
+        if len(shards) > 1:
+            logger.debug(f"Retrieved {len(hits)} hits from {len(shards)} shards of {api_call['target_log_source']}")
+            if len(hits) > max_hits:
+                logger.warning(f"Keeping the first {max_hits} of {len(hits)} hits (max_hits)")
+                hits = hits[:max_hits]
+        return hits
+
+    async def get_cached_logs(self, api_call, fetch):
+        # Days already retrieved for the same source, office and user are served from the cache, only the
+        # missing days are queried
+        source_config = self.get_source_config(api_call['target_log_source'])
+        days = day_partitions(api_call['date_from'], api_call['date_to'])
+        if self.log_cache is None or not days:
+            return await fetch(api_call)
+
+        key = (source_config['name'], str(api_call.get('officeId')), str(api_call.get('userId')))
+        date_field = source_config.get('query_fields', {}).get('date', 'date')
+        pieces = list(self.log_cache.get_days(key, days).items())
+        missing = sorted(set(days) - {day for day, _ in pieces})
+
+        for date_from, date_to in contiguous_ranges(missing):
+            hits = await fetch({**api_call, 'date_from': date_from, 'date_to': date_to})
+            partitions = partition_by_day(hits, date_field, day_partitions(date_from, date_to))
+            # A range cut short by max_hits is incomplete and is not cached
+            if partitions is None or len(hits) >= source_config.get('max_hits', 10000):
+                pieces.append((date_from, hits))
+            else:
+                self.log_cache.put_days(key, partitions)
+                pieces.extend(partitions.items())
 
-        query = build_elasticsearch_query(api_call)
+        if missing:
+            logger.debug(f"Log cache served {len(days) - len(missing)} of {len(days)} days for {key}")
+        return [hit for _, day_hits in sorted(pieces, key=lambda piece: piece[0]) for hit in day_hits]
+
+    async def fetch_elasticsearch_logs(self, api_call):
+        es_config, query = self.prepare_elasticsearch_query(api_call)
+        search_key = json.dumps({"source": es_config["name"], "index": es_config["index"], "query": query,
+                                 "fields": es_config.get('fields')}, sort_keys=True)
 
         try:
-            result = await self.es_client.search(index=es_config["index"], query=query,
-                                                 size=1000)
-            return [hit['_source'] for hit in result['hits']['hits']]
+            return await self.search_flight.do(search_key, lambda: self.search(es_config, query))
         except Exception as e:
             logger.error(f"Elasticsearch query failed: {str(e)}")
             raise
 
+    async def close(self):
+        if self.log_cache is not None:
+            logger.info(f"Log cache stats: {self.log_cache.stats()}")
+        await self.es_clients.close()
+
+    def get_source_config(self, source):
+        return next(option for option in self.config["sources"] if option['name'] == source)
+
+    @async_retry_with_backoff(max_attempts=3, backoff_in_seconds=1)
+    async def get_elasticsearch_summary(self, api_call):
+        es_config, query = self.prepare_elasticsearch_query(api_call)
+        if not es_config.get('aggregations'):
+            return None
+
+        search_key = json.dumps({"source": es_config["name"], "index": es_config["index"], "query": query,
+                                 "aggs": es_config['aggregations']}, sort_keys=True)
+        return await self.search_flight.do(search_key, lambda: self.aggregate(es_config, query))
+
+    async def aggregate(self, es_config, query):
+        # Computed over every matching hit on the cluster, not only over the hits read back
+        client = await self.es_clients.get_client(es_config)
+        result = await self.es_clients.request(client, 'search', index=es_config["index"], query=query,
+                                               aggs=es_config['aggregations'], size=0, track_total_hits=True)
+        return {
+            'total_hits': result['hits']['total']['value'],
+            'aggregations': {
+                name: summarize_aggregation(value) for name, value in result.get('aggregations', {}).items()
+            }
+        }
+
+    async def search(self, es_config, query):
+        hits = []
+        async with aclosing(self.iter_elasticsearch_pages(es_config, query)) as pages:
+            async for page in pages:
+                hits.extend(page)
+        return hits
+
+    async def iter_elasticsearch_pages(self, es_config, query):
+        # A point in time keeps a consistent view of the index while search_after walks through every hit
+        page_size = es_config.get('page_size', 1000)
+        max_hits = es_config.get('max_hits', 10000)
+        keep_alive = es_config.get('pit_keep_alive', '1m')
+
+        client = await self.es_clients.get_client(es_config)
+        pit = await self.es_clients.request(client, 'open_point_in_time', index=es_config["index"],
+                                            keep_alive=keep_alive)
+        pit_id = pit['id']
+        profile = es_config.get('profile', False)
+        search_after = None
+        retrieved = 0
+        try:
+            while retrieved < max_hits:
+                result = await self.search_page(client, query, pit_id, keep_alive, min(page_size, max_hits - retrieved),
+                                                search_after, es_config.get('fields'), profile and search_after is None)
+                pit_id = result.get('pit_id', pit_id)
+                if 'profile' in result:
+                    logger.debug(f"Elasticsearch profile for {es_config['index']}: {json.dumps(result['profile'])}")
+                hits = result['hits']['hits']
+                if not hits:
+                    break
+
+                retrieved += len(hits)
+                search_after = hits[-1]['sort']
+                yield [hit['_source'] for hit in hits]
+
+                if len(hits) < page_size:
+                    break
+            if retrieved >= max_hits:
+                logger.warning(f"Stopped reading {es_config['index']} after {max_hits} hits (max_hits)")
+        finally:
+            try:
+                await self.es_clients.request(client, 'close_point_in_time', id=pit_id)
+            except Exception as e:
+                logger.warning(f"Failed to close Elasticsearch point in time: {str(e)}")
+
+    async def search_page(self, client, query, pit_id, keep_alive, size, search_after=None, fields=None,
+                          profile=False):
+        # Only the configured fields are sent back by the cluster
+        options = {"source": fields} if fields else {}
+        if profile:
+            options["profile"] = True
+        return await self.es_clients.request(
+            client,
+            'search',
+            query=query,
+            pit={"id": pit_id, "keep_alive": keep_alive},
+            sort=[{"_shard_doc": "asc"}],
+            search_after=search_after,
+            size=size,
+            track_total_hits=False,
+            **options
+        )
+
 
 # Example usage
 async def main():
@@ -15,8 +15,11 @@ from notifications import NotificationSystem, send_notification
 from output_interface import OutputInterface
 from plugin_system import PluginManager
 from report_generation import ReportGenerationModule
-from utils.error_handling import async_retry_with_backoff
-from utils.llm_utils import RAG
+from src.utils.error_handling import async_retry_with_backoff
+from src.utils.llm_clients import client_registry
+from src.utils.llm_utils import (RAG, close_hedged_dispatcher, close_response_cache, close_scheduler,
+                                 llm_request_flight)
+from src.utils.rag import KnowledgeBaseRefresher
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -28,17 +31,22 @@ def load_config(config_file):
 
 
 @async_retry_with_backoff(max_attempts=3, backoff_in_seconds=1)
-async def process_incident(incident, modules):
+async def process_incident(incident, modules, streaming=False, understanding=None):
     try:
         send_notification(incident['id'], 'processing', 'Started processing incident')
 
-        understanding = await modules['understanding'].process(incident)
+        if understanding is None:
+            understanding = await modules['understanding'].process(incident)
         logger.info(f"Incident {incident['id']} understanding complete")
         print(understanding)
 
-        api_calls = await modules['api_call'].generate(understanding)
-        logger.info(f"Generated {len(api_calls)} API calls for incident {incident['id']}")
-        print(api_calls)
+        if streaming:
+            # Log queries start as soon as each API call is parsed from the LLM stream
+            api_calls = modules['api_call'].stream(understanding)
+        else:
+            api_calls = await modules['api_call'].generate(understanding)
+            logger.info(f"Generated {len(api_calls)} API calls for incident {incident['id']}")
+            print(api_calls)
 
         if modules['log_retrieval'].config['use_ssh_tunnel']:
             logs = await modules['log_retrieval'].retrieve_with_tunnel(api_calls)
@@ -90,10 +98,26 @@ async def main():
             knowledge_base_path=main_config['knowledge_base']['path'],
             sentence_transformer_model=main_config['rag']['sentence_transformer_model'],
             max_retrieved_documents=main_config['rag']['max_retrieved_documents'],
-            similarity_threshold=main_config['rag']['similarity_threshold']
+            similarity_threshold=main_config['rag']['similarity_threshold'],
+            index_dir=main_config['rag'].get('index_dir'),
+            index_config=main_config['rag'].get('index'),
+            query_config=main_config['rag'].get('query')
+        )
+        # Picks up knowledge base changes without restarting the service or re-embedding everything
+        kb_refresher = KnowledgeBaseRefresher(
+            rag, main_config['knowledge_base']['path'], main_config['knowledge_base']['update_frequency']
         )
+        kb_refresher.start()
     else:
         rag = None
+        kb_refresher = None
+
+    # Create the LLM provider clients once, so the first incident does not pay for it
+    await client_registry.warm_up(llm_config)
+    hedging_config = llm_config.get('hedging', {})
+    if hedging_config.get('enabled', False):
+        for provider in hedging_config.get('secondary_providers', []):
+            await client_registry.warm_up({**llm_config, 'provider': provider})
 
     # Initialize notification system
     notification_system = NotificationSystem()
@@ -101,7 +125,7 @@ async def main():
 
     modules = {
         'input': IncidentInputInterface(main_config['incident_input']),
-        'understanding': IncidentUnderstandingModule(llm_config, rag),
+        'understanding': IncidentUnderstandingModule(llm_config, rag, main_config.get('incident_understanding')),
         'api_call': ApiCallGenerator(main_config['log_sources'], llm_config),
         'log_retrieval': LogRetrievalEngine(main_config['log_sources']),
         'anomaly_detection': AnomalyDetectionModule(main_config['anomaly_detection'], llm_config, rag),
@@ -121,29 +145,54 @@ async def main():
 
     max_workers = main_config['performance']['max_workers']
     batch_size = main_config['performance']['batch_size']
+    streaming = llm_config.get('streaming', False)
+    batch_prompting = main_config.get('incident_understanding', {}).get('batch_prompting', False)
 
     with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        while True:
-            incidents = await modules['input'].get_incidents(batch_size)
-            if not incidents:
-                await asyncio.sleep(1)  # Avoid busy waiting
-                continue
-
-            tasks = [
-                asyncio.create_task(process_incident(incident, modules))
-                for incident in incidents
-            ]
-
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-
-            for incident, result in zip(incidents, results):
-                if isinstance(result, Exception):
-                    logger.error(f"Failed to process incident {incident['id']}: {str(result)}")
-                else:
-                    logger.info(f"Successfully processed incident {incident['id']}")
-
-            # Process feedback periodically
-            # await modules['feedback'].process_feedback() # TO IMPLEMENT
+        try:
+            while True:
+                incidents = await modules['input'].get_incidents(batch_size)
+                if not incidents:
+                    await asyncio.sleep(1)  # Avoid busy waiting
+                    continue
+
+                # Several incidents share one understanding prompt, the others are processed one by one
+                understandings = {}
+                if batch_prompting and len(incidents) > 1:
+                    try:
+                        understandings = await modules['understanding'].process_batch(incidents)
+                    except Exception as e:
+                        logger.error(f"Batched understanding failed, processing incidents one by one: {str(e)}")
+
+                tasks = [
+                    asyncio.create_task(
+                        process_incident(incident, modules, streaming, understandings.get(incident['id']))
+                    )
+                    for incident in incidents
+                ]
+
+                results = await asyncio.gather(*tasks, return_exceptions=True)
+
+                for incident, result in zip(incidents, results):
+                    if isinstance(result, Exception):
+                        logger.error(f"Failed to process incident {incident['id']}: {str(result)}")
+                    else:
+                        logger.info(f"Successfully processed incident {incident['id']}")
+
+                # Process feedback periodically
+                # await modules['feedback'].process_feedback() # TO IMPLEMENT
+        finally:
+            if kb_refresher is not None:
+                kb_refresher.stop()
+            if rag is not None:
+                rag.close()
+            logger.info(f"LLM request coalescing stats: {llm_request_flight.stats()}")
+            logger.info(f"Elasticsearch request coalescing stats: {modules['log_retrieval'].search_flight.stats()}")
+            close_response_cache()
+            close_scheduler()
+            close_hedged_dispatcher()
+            await client_registry.shutdown()
+            await modules['log_retrieval'].close()
 
 
 if __name__ == "__main__":
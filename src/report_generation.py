@@ -3,6 +3,7 @@ import io
 import json
 import logging
 import os.path
+import threading
 
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
@@ -12,11 +13,37 @@ from reportlab.lib.units import inch
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image
 
 from src.utils.error_handling import retry_with_backoff
-from src.utils.llm_utils import get_llm_response
+from src.utils.json_stream import iter_json_array
+from src.utils.llm_scheduler import PRIORITY_LOW
+from src.utils.llm_utils import get_llm_response, stream_llm_response
 
 logger = logging.getLogger(__name__)
 
 
+class StreamingStory(list):
+    # A story doc.build() can lay out while it is still being written: build() stops when the story is empty, so
+    # len() waits for the next flowables until the story is closed
+    def __init__(self, flowables=()):
+        super().__init__(flowables)
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def add(self, flowables):
+        with self.condition:
+            super().extend(flowables)
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed or list.__len__(self) > 0)
+            return list.__len__(self)
+
+
 class ReportGenerationModule:
     def __init__(self, config, llm_config):
         self.config = config
@@ -93,7 +120,10 @@ class ReportGenerationModule:
                 anomalies=json.dumps(anomalies, indent=2)
             )
 
-            report_content = await get_llm_response(prompt, self.llm_config)
+            if self.llm_config.get('streaming', False):
+                return await self.generate_streaming(prompt, incident, anomalies)
+
+            report_content = await get_llm_response(prompt, self.llm_config, priority=PRIORITY_LOW)
             print(report_content)
             structured_report = json.loads(report_content)
             logger.info(f"Correctly generated report content...")
@@ -110,10 +140,48 @@ class ReportGenerationModule:
             logger.error(f"Error generating report for incident {incident['id']}: {str(e)}")
             raise
 
+    async def generate_streaming(self, prompt, incident, anomalies):
+        # With a PDF output, the document is laid out in a worker thread while the report streams: each section is
+        # handed to doc.build() as soon as it is complete
+        structured_report = []
+        pdf = self.config['output_format'] == 'pdf'
+        if pdf:
+            story, styles = self.start_pdf_story(incident)
+            story = StreamingStory(story)
+            build = asyncio.create_task(asyncio.to_thread(self.build_pdf, story))
+        try:
+            async for section in iter_json_array(stream_llm_response(prompt, self.llm_config, priority=PRIORITY_LOW)):
+                structured_report.append(section)
+                if pdf:
+                    story.add(self.append_pdf_content([], section, styles) + [Spacer(1, 12)])
+            if not structured_report:
+                raise ValueError("LLM response did not contain any report section")
+            if pdf:
+                story.add(self.anomalies_table(anomalies))
+        finally:
+            if pdf:
+                story.close()
+        logger.info(f"Correctly generated {len(structured_report)} report sections...")
+
+        if pdf:
+            report = await build
+            self.export_report(report, 'pdf', self.config['output_path'])
+        else:
+            report = json.dumps(structured_report, indent=2)
+            self.export_report(report, 'txt', self.config['output_path'])
+        return report
+
     def generate_pdf_report(self, structured_report, incident, anomalies):
-        buffer = io.BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=letter, rightMargin=72, leftMargin=72, topMargin=72, bottomMargin=18)
+        story, styles = self.start_pdf_story(incident)
+
+        # Add content
+        for section in structured_report:
+            story = self.append_pdf_content(story, section, styles)
+            story.append(Spacer(1, 12))
 
+        return self.finish_pdf_report(story, anomalies)
+
+    def start_pdf_story(self, incident):
         styles = getSampleStyleSheet()
         styles.add(ParagraphStyle(name='Justify', alignment=1))
 
@@ -128,15 +196,22 @@ class ReportGenerationModule:
         # Add title
         story.append(Paragraph(f"Fraud Investigation Report - Incident {incident['id']}", styles['Title']))
         story.append(Spacer(1, 12))
+        return story, styles
 
-        # Add content
-        for section in structured_report:
-            story = self.append_pdf_content(story, section, styles)
-            story.append(Spacer(1, 12))
+    def finish_pdf_report(self, story, anomalies):
+        story.extend(self.anomalies_table(anomalies))
+        return self.build_pdf(story)
+
+    def build_pdf(self, story):
+        buffer = io.BytesIO()
+        doc = SimpleDocTemplate(buffer, pagesize=letter, rightMargin=72, leftMargin=72, topMargin=72, bottomMargin=18)
+        doc.build(story)
+        buffer.seek(0)
+        return buffer.getvalue()
 
-        # Add anomalies table
-        story.append(Paragraph("Detailed Anomalies", styles['Heading1']))
-        story.append(Spacer(1, 6))
+    def anomalies_table(self, anomalies):
+        styles = getSampleStyleSheet()
+        flowables = [Paragraph("Detailed Anomalies", styles['Heading1']), Spacer(1, 6)]
 
         anomalies_data = [["Description", "Confidence", "Potential Implications", "Recommended Actions"]]
         for anomaly in anomalies:
@@ -179,11 +254,8 @@ class ReportGenerationModule:
             ('GRID', (0, 0), (-1, -1), 1, colors.black),
             ('VALIGN', (0, 0), (-1, -1), 'TOP'),
         ]))
-        story.append(anomalies_table)
-
-        doc.build(story)
-        buffer.seek(0)
-        return buffer.getvalue()
+        flowables.append(anomalies_table)
+        return flowables
 
     def export_report(self, report, file_type, path):
         if file_type == 'pdf':
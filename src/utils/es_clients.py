@@ -0,0 +1,71 @@
+import asyncio
+import logging
+
+from elasticsearch import AsyncElasticsearch
+
+from .ssh_tunnel import tunneled_url
+
+logger = logging.getLogger(__name__)
+
+
+class ElasticsearchClientRegistry:
+    def __init__(self, tunnels=None, max_concurrent_requests=20):
+        self.tunnels = tunnels
+        self.clients = {}
+        self.locks = {}
+        # Global cap on the requests in flight across every source and incident
+        self.semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+    async def get_client(self, source_config):
+        name = source_config['name']
+        tunnel_address = None
+        if self.tunnels is not None:
+            # Reopens the tunnel on the same local port if it went down since the last call
+            tunnel_address = await self.tunnels.ensure(source_config.get('tunnel', 'default'))
+
+        if name not in self.clients:
+            async with self.locks.setdefault(name, asyncio.Lock()):
+                if name not in self.clients:
+                    self.clients[name] = self.create_client(source_config, tunnel_address)
+        return self.clients[name]
+
+    def create_client(self, source_config, tunnel_address=None):
+        url = source_config['url']
+        sniffing = source_config.get('sniffing', False)
+        if tunnel_address is not None:
+            url = tunneled_url(url, *tunnel_address)
+            if sniffing:
+                # Sniffed node addresses are only reachable from the other end of the tunnel
+                logger.warning(f"Sniffing disabled for {source_config['name']}, it is reached through an SSH tunnel")
+                sniffing = False
+
+        client = AsyncElasticsearch(
+            url,
+            basic_auth=(source_config['username'], source_config['password']),
+            request_timeout=source_config.get('timeout', 30),
+            connections_per_node=source_config.get('connections_per_node', 10),
+            # Failed requests are retried per time shard, up to retry_attempts times, by the log retrieval engine
+            max_retries=0,
+            retry_on_timeout=False,
+            sniff_on_start=sniffing,
+            sniff_on_node_failure=sniffing,
+            min_delay_between_sniffing=source_config.get('sniff_interval', 60)
+        )
+        logger.info(f"Created Elasticsearch client for log source {source_config['name']}")
+        return client
+
+    async def request(self, client, method, **kwargs):
+        async with self.semaphore:
+            return await getattr(client, method)(**kwargs)
+
+    async def close(self):
+        for name, client in list(self.clients.items()):
+            try:
+                await client.close()
+            except Exception as e:
+                logger.error(f"Failed to close Elasticsearch client {name}: {str(e)}")
+        self.clients.clear()
+        if self.tunnels is not None:
+            logger.info(f"SSH tunnel stats: {self.tunnels.stats()}")
+            await self.tunnels.close()
+        logger.info("Elasticsearch clients closed")
@@ -0,0 +1,209 @@
+import asyncio
+import json
+import logging
+import mmap
+import os
+import re
+from datetime import date, datetime, time, timedelta, timezone
+from fnmatch import fnmatchcase
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from pyarrow import fs
+
+from .log_cache import field_value, hit_timestamp
+
+logger = logging.getLogger(__name__)
+
+PARTITION_DATE = re.compile(r'(\d{4}-\d{2}-\d{2})')
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+NDJSON_EXTENSIONS = ('.ndjson', '.jsonl', '.json')
+DEFAULT_QUERY_FIELDS = {'officeId': 'officeId', 'userId': 'user.userId', 'date': 'date'}
+
+
+def expected_values(value):
+    # None when the predicate matches everything, like the "*" user of the Elasticsearch query
+    values = value if isinstance(value, (list, tuple)) else [value]
+    values = [str(item).strip() for item in values if item is not None]
+    if not values or any(item in ('', '*') for item in values):
+        return None
+    return values
+
+
+def is_pattern(value):
+    return '*' in value or '?' in value
+
+
+def matches(actual, values):
+    if actual is None:
+        return False
+    actual = str(actual)
+    return any(fnmatchcase(actual, value) if is_pattern(value) else actual == value for value in values)
+
+
+def nested_field_type(schema, path):
+    field_type = schema
+    for part in path:
+        index = field_type.get_field_index(part)
+        if index < 0:
+            return None
+        field_type = field_type.field(index).type
+    return field_type
+
+
+def json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {key: json_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [json_value(item) for item in value]
+    return value
+
+
+class FileLogSource:
+    def __init__(self, config):
+        self.config = config
+        self.path = config['path']
+        self.fields = {**DEFAULT_QUERY_FIELDS, **config.get('query_fields', {})}
+        self.max_hits = config.get('max_hits', 10000)
+        # Parquet files are memory-mapped, only the row groups that pass the filter are decoded
+        self.filesystem = fs.LocalFileSystem(use_mmap=True)
+
+    def list_files(self, date_from, date_to):
+        # Files are partitioned by the date found in their path (e.g. date=2024-03-01/ or app-2024-03-01.ndjson),
+        # those outside the range are never opened
+        selected = []
+        for root, _, filenames in os.walk(self.path):
+            for filename in sorted(filenames):
+                if not filename.endswith(PARQUET_EXTENSIONS + NDJSON_EXTENSIONS):
+                    continue
+                path = os.path.join(root, filename)
+                partition = PARTITION_DATE.findall(os.path.relpath(path, self.path))
+                if partition and not str(date_from)[:10] <= partition[-1] < str(date_to):
+                    continue
+                selected.append(path)
+        return sorted(selected)
+
+    def read(self, api_call):
+        files = self.list_files(api_call['date_from'], api_call['date_to'])
+        parquet_files = [path for path in files if path.endswith(PARQUET_EXTENSIONS)]
+        hits = self.read_parquet(parquet_files, api_call) if parquet_files else []
+        for path in files:
+            if len(hits) >= self.max_hits:
+                break
+            if path.endswith(NDJSON_EXTENSIONS):
+                hits.extend(self.read_ndjson(path, api_call, self.max_hits - len(hits)))
+
+        hits.sort(key=lambda hit: hit_timestamp(field_value(hit, self.fields['date'])))
+        logger.debug(f"Read {len(hits)} hits from {len(files)} files of {self.config['name']}")
+        return hits[:self.max_hits]
+
+    def build_filter(self, api_call, schema):
+        expression = None
+        for name in ('officeId', 'userId'):
+            values = expected_values(api_call.get(name))
+            path = self.fields[name].split('.')
+            if values is None or nested_field_type(schema, path) is None:
+                continue
+            field = pc.field(*path)
+            patterns = [value for value in values if is_pattern(value)]
+            exact = [value for value in values if not is_pattern(value)]
+            clauses = [field.isin(exact)] if exact else []
+            clauses += [
+                pc.match_like(field.cast(pa.string()), value.replace('%', '\\%').replace('_', '\\_')
+                              .replace('*', '%').replace('?', '_'))
+                for value in patterns
+            ]
+            clause = clauses[0]
+            for other in clauses[1:]:
+                clause = clause | other
+            expression = clause if expression is None else expression & clause
+
+        date_path = self.fields['date'].split('.')
+        date_type = nested_field_type(schema, date_path)
+        if date_type is not None:
+            field = pc.field(*date_path)
+            if pa.types.is_timestamp(date_type):
+                tz = timezone.utc if date_type.tz else None
+                start, end = (self.bound(api_call[key], tz) for key in ('date_from', 'date_to'))
+                clause = (field >= pa.scalar(start, date_type)) & (field < pa.scalar(end, date_type))
+            elif pa.types.is_date(date_type):
+                # A day column holds every entry of that day, the end of the range is rounded up to the next day
+                start, end = (self.bound(api_call[key], None) for key in ('date_from', 'date_to'))
+                end_day = end.date() if end.time() == time() else end.date() + timedelta(days=1)
+                clause = (field >= pa.scalar(start.date(), date_type)) & (field < pa.scalar(end_day, date_type))
+            elif pa.types.is_string(date_type) or pa.types.is_large_string(date_type):
+                clause = (field >= str(api_call['date_from'])) & (field < str(api_call['date_to']))
+            else:
+                start, end = (pa.scalar(str(api_call[key])).cast(date_type) for key in ('date_from', 'date_to'))
+                clause = (field >= start) & (field < end)
+            expression = clause if expression is None else expression & clause
+        return expression
+
+    @staticmethod
+    def bound(value, tz):
+        value = str(value)
+        parsed = datetime.combine(date.fromisoformat(value), time()) if len(value) == 10 \
+            else datetime.fromisoformat(value)
+        if tz is not None and parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=tz)
+        return parsed
+
+    def read_parquet(self, files, api_call):
+        # Row group statistics let the scanner skip the groups that cannot match the filter
+        dataset = ds.dataset(files, format='parquet', filesystem=self.filesystem)
+        expression = self.build_filter(api_call, dataset.schema)
+        hits = []
+        for batch in dataset.to_batches(filter=expression):
+            hits.extend(json_value(row) for row in batch.to_pylist())
+            if len(hits) >= self.max_hits:
+                break
+        return hits[:self.max_hits]
+
+    def read_ndjson(self, path, api_call, limit):
+        office_ids = expected_values(api_call.get('officeId'))
+        user_ids = expected_values(api_call.get('userId'))
+        date_from, date_to = str(api_call['date_from']), str(api_call['date_to'])
+        # Lines that cannot contain an exact officeId are skipped before being parsed
+        needles = [value.encode('utf-8') for value in office_ids or [] if not is_pattern(value)]
+        if office_ids and len(needles) < len(office_ids):
+            needles = []
+
+        hits, malformed = [], 0
+        if os.path.getsize(path) == 0:
+            return hits
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for line in iter(mapped.readline, b''):
+                if needles and not any(needle in line for needle in needles):
+                    continue
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    hit = json.loads(line)
+                except json.JSONDecodeError:
+                    malformed += 1
+                    continue
+                if not isinstance(hit, dict):
+                    malformed += 1
+                    continue
+                timestamp = hit_timestamp(field_value(hit, self.fields['date']))
+                if not date_from <= timestamp < date_to:
+                    continue
+                if office_ids and not matches(field_value(hit, self.fields['officeId']), office_ids):
+                    continue
+                if user_ids and not matches(field_value(hit, self.fields['userId']), user_ids):
+                    continue
+                hits.append(hit)
+                if len(hits) >= limit:
+                    break
+        if malformed:
+            logger.warning(f"Skipped {malformed} malformed lines of {path}")
+        return hits
+
+    async def fetch(self, api_call):
+        return await asyncio.to_thread(self.read, api_call)
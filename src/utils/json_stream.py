@@ -0,0 +1,84 @@
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class JSONArrayStreamParser:
+    def __init__(self):
+        self.buffer = ''
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.element_start = None
+        self.started = False
+        self.finished = False
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        elements = []
+
+        while self.position < len(self.buffer) and not self.finished:
+            char = self.buffer[self.position]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif not self.started:
+                # Skip any text or code fence the model writes before the array
+                if char == '[':
+                    self.started = True
+                    self.depth = 1
+            elif char == '"':
+                self.in_string = True
+                self.mark_element_start()
+            elif char in '{[':
+                self.mark_element_start()
+                self.depth += 1
+            elif char in '}]':
+                self.depth -= 1
+                if self.depth == 1:
+                    self.emit(elements, self.position + 1)
+                elif self.depth == 0:
+                    self.emit(elements, self.position)
+                    self.finished = True
+            elif char == ',' and self.depth == 1:
+                self.emit(elements, self.position)
+            elif not char.isspace():
+                self.mark_element_start()
+            self.position += 1
+
+        self.compact()
+        return elements
+
+    def mark_element_start(self):
+        if self.depth == 1 and self.element_start is None:
+            self.element_start = self.position
+
+    def emit(self, elements, end):
+        if self.element_start is None:
+            return
+        text = self.buffer[self.element_start:end]
+        self.element_start = None
+        try:
+            elements.append(json.loads(text))
+        except json.JSONDecodeError as e:
+            logger.warning(f"Skipping malformed JSON array element: {str(e)}")
+
+    def compact(self):
+        keep_from = self.position if self.element_start is None else self.element_start
+        self.buffer = self.buffer[keep_from:]
+        self.position -= keep_from
+        if self.element_start is not None:
+            self.element_start = 0
+
+
+async def iter_json_array(chunks):
+    parser = JSONArrayStreamParser()
+    async for chunk in chunks:
+        for element in parser.feed(chunk):
+            yield element
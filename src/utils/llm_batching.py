@@ -0,0 +1,88 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    def __init__(self, name, batch_function, max_batch_size=8, max_wait_ms=20):
+        self.name = name
+        self.batch_function = batch_function
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"batcher-{name}")
+        self.pending = []
+        self.wakeup = None
+        self.worker = None
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        if self.worker is None or self.worker.done():
+            self.wakeup = asyncio.Event()
+            self.worker = loop.create_task(self.run())
+        future = loop.create_future()
+        self.pending.append((item, future))
+        self.wakeup.set()
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+
+            # Give concurrent callers a short window to join the batch
+            deadline = loop.time() + self.max_wait
+            while len(self.pending) < self.max_batch_size and loop.time() < deadline:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), deadline - loop.time())
+                    self.wakeup.clear()
+                except asyncio.TimeoutError:
+                    break
+
+            while self.pending:
+                batch = [(item, future) for item, future in self.pending[:self.max_batch_size]
+                         if not future.cancelled()]
+                del self.pending[:self.max_batch_size]
+                if batch:
+                    await self.run_batch(loop, batch)
+
+    async def run_batch(self, loop, batch):
+        items = [item for item, _ in batch]
+        try:
+            # Single dedicated thread: batches run one after the other while the next one fills up
+            results = await loop.run_in_executor(self.executor, self.batch_function, items)
+        except Exception as e:
+            logger.error(f"Batch of {len(items)} items failed in {self.name}: {str(e)}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.items += len(items)
+        logger.debug(f"Ran batch of {len(items)} items in {self.name}")
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'items': self.items,
+            'average_batch_size': self.items / self.batches if self.batches else 0.0,
+            'pending': len(self.pending)
+        }
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+        for _, future in self.pending:
+            if not future.done():
+                future.cancel()
+        self.pending = []
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def build_cache_key(prompt, provider, model, temperature, max_tokens):
+    payload = json.dumps({
+        'prompt': prompt,
+        'provider': provider,
+        'model': model,
+        'temperature': temperature,
+        'max_tokens': max_tokens
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LLMResponseCache:
+    def __init__(self, max_entries=1024, ttl_seconds=86400, db_path=None, max_db_entries=100000):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_db_entries = max_db_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self.db = None
+        if db_path:
+            directory = os.path.dirname(db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS idx_llm_responses_created ON llm_responses (created_at)")
+            self.db.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                expires_at, response = entry
+                if expires_at > now:
+                    self.memory.move_to_end(key)
+                    self.hits += 1
+                    self.memory_hits += 1
+                    return response
+                del self.memory[key]
+                self.expirations += 1
+
+            if self.db is not None:
+                row = self.db.execute(
+                    "SELECT response, expires_at FROM llm_responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    response, expires_at = row
+                    if expires_at > now:
+                        self._store_in_memory(key, response, expires_at)
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return response
+                    self.db.execute("DELETE FROM llm_responses WHERE key = ?", (key,))
+                    self.db.commit()
+                    self.expirations += 1
+
+            self.misses += 1
+            return None
+
+    def set(self, key, response):
+        now = time.time()
+        expires_at = now + self.ttl_seconds
+        with self.lock:
+            self._store_in_memory(key, response, expires_at)
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO llm_responses (key, response, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                    (key, response, now, expires_at)
+                )
+                self._evict_from_disk(now)
+                self.db.commit()
+
+    def _store_in_memory(self, key, response, expires_at):
+        self.memory[key] = (expires_at, response)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+            self.evictions += 1
+
+    def _evict_from_disk(self, now):
+        self.db.execute("DELETE FROM llm_responses WHERE expires_at <= ?", (now,))
+        (count,) = self.db.execute("SELECT COUNT(*) FROM llm_responses").fetchone()
+        overflow = count - self.max_db_entries
+        if overflow > 0:
+            self.db.execute(
+                "DELETE FROM llm_responses WHERE key IN "
+                "(SELECT key FROM llm_responses ORDER BY created_at ASC LIMIT ?)", (overflow,)
+            )
+            self.evictions += overflow
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'memory_entries': len(self.memory)
+            }
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if self.db is not None:
+                self.db.execute("DELETE FROM llm_responses")
+                self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+
+import aiohttp
+from anthropic import AsyncAnthropic
+from openai import AsyncOpenAI
+from transformers import pipeline
+
+from .llm_batching import MicroBatcher
+
+logger = logging.getLogger(__name__)
+
+
+class LLMClientRegistry:
+    def __init__(self):
+        self.clients = {}
+        self.pipelines = {}
+        self.pipeline_tasks = {}
+        self.batchers = {}
+        self.http_session = None
+
+    def get_openai_client(self, config):
+        api_key = os.getenv(config['models']['default']['api_key'])
+        key = ('openai', api_key)
+        if key not in self.clients:
+            self.clients[key] = AsyncOpenAI(api_key=api_key)
+            logger.info("Created OpenAI client")
+        return self.clients[key]
+
+    def get_anthropic_client(self, config):
+        api_key = os.getenv(config['alternative_providers']['anthropic']['api_key'])
+        key = ('anthropic', api_key)
+        if key not in self.clients:
+            self.clients[key] = AsyncAnthropic(api_key=api_key)
+            logger.info("Created Anthropic client")
+        return self.clients[key]
+
+    async def get_huggingface_pipeline(self, config):
+        model_name = config['model']['name']
+        if model_name in self.pipelines:
+            return self.pipelines[model_name]
+
+        # Concurrent callers wait on the same load instead of reading the weights several times
+        if model_name not in self.pipeline_tasks:
+            self.pipeline_tasks[model_name] = asyncio.create_task(
+                asyncio.to_thread(pipeline, 'text-generation', model=model_name)
+            )
+        try:
+            generator = await self.pipeline_tasks[model_name]
+        finally:
+            self.pipeline_tasks.pop(model_name, None)
+
+        self.pipelines[model_name] = generator
+        logger.info(f"Loaded HuggingFace pipeline for model {model_name}")
+        return generator
+
+    async def get_huggingface_batcher(self, config):
+        model_config = config['model']
+        key = (model_config['name'], model_config['max_tokens'], model_config['temperature'])
+        if key in self.batchers:
+            return self.batchers[key]
+
+        generator = await self.get_huggingface_pipeline(config)
+        if generator.tokenizer.pad_token_id is None:
+            generator.tokenizer.pad_token_id = generator.model.config.eos_token_id
+        # Decoder-only models must be padded on the left to generate a batch
+        generator.tokenizer.padding_side = 'left'
+
+        def generate_batch(prompts):
+            outputs = generator(
+                prompts,
+                batch_size=len(prompts),
+                max_length=model_config['max_tokens'],
+                temperature=model_config['temperature']
+            )
+            return [output[0]['generated_text'] for output in outputs]
+
+        batching_config = model_config.get('batching', {})
+        if key not in self.batchers:
+            self.batchers[key] = MicroBatcher(
+                model_config['name'],
+                generate_batch,
+                max_batch_size=batching_config.get('max_batch_size', 8),
+                max_wait_ms=batching_config.get('max_wait_ms', 20)
+            )
+        return self.batchers[key]
+
+    def get_http_session(self, config):
+        if self.http_session is None or self.http_session.closed:
+            http_config = config.get('http', {})
+            connector = aiohttp.TCPConnector(
+                limit=http_config.get('max_connections', 100),
+                limit_per_host=http_config.get('max_connections_per_host', 10),
+                keepalive_timeout=http_config.get('keepalive_timeout', 60),
+                ttl_dns_cache=http_config.get('dns_cache_ttl', 300)
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=http_config.get('timeout', 120),
+                connect=http_config.get('connect_timeout', 10)
+            )
+            self.http_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self.http_session
+
+    async def warm_up(self, config):
+        provider = config['provider']
+        if provider == 'openai':
+            self.get_openai_client(config)
+        elif provider == 'anthropic':
+            self.get_anthropic_client(config)
+        elif provider == 'huggingface':
+            if config['model'].get('batching', {}).get('enabled', False):
+                await self.get_huggingface_batcher(config)
+            else:
+                await self.get_huggingface_pipeline(config)
+        elif provider == 'generic':
+            self.get_http_session(config)
+        logger.info(f"Warmed up LLM client for provider {provider}")
+
+    async def shutdown(self):
+        for key, client in self.clients.items():
+            try:
+                await client.close()
+            except Exception as e:
+                logger.error(f"Failed to close {key[0]} client: {str(e)}")
+        self.clients.clear()
+
+        for key, batcher in self.batchers.items():
+            logger.info(f"HuggingFace batching stats for {key[0]}: {batcher.stats()}")
+            batcher.close()
+        self.batchers.clear()
+        self.pipelines.clear()
+
+        if self.http_session is not None:
+            await self.http_session.close()
+            self.http_session = None
+        logger.info("LLM clients shut down")
+
+
+client_registry = LLMClientRegistry()
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict, deque
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    def __init__(self, window_size=200):
+        self.samples = defaultdict(lambda: deque(maxlen=window_size))
+
+    def record(self, provider, seconds):
+        self.samples[provider].append(seconds)
+
+    def percentile(self, provider, percentile, min_samples=1):
+        samples = self.samples[provider]
+        if len(samples) < min_samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(round(percentile / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+
+class HedgedDispatcher:
+    def __init__(self, config):
+        self.secondary_providers = config.get('secondary_providers', [])
+        self.percentile = config.get('percentile', 95)
+        self.min_samples = config.get('min_samples', 20)
+        self.initial_hedge_delay = config.get('initial_hedge_delay', 10)
+        self.min_hedge_delay = config.get('min_hedge_delay', 0.5)
+        self.degraded_after = config.get('degraded_after', 3)
+        self.cooldown_seconds = config.get('degraded_cooldown_seconds', 300)
+        self.latencies = LatencyTracker(config.get('window_size', 200))
+        self.strikes = defaultdict(int)
+        self.degraded_until = {}
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+
+    def is_degraded(self, provider):
+        until = self.degraded_until.get(provider)
+        if until is None:
+            return False
+        if until <= time.monotonic():
+            del self.degraded_until[provider]
+            logger.info(f"LLM provider {provider} cool-down is over, routing to it again")
+            return False
+        return True
+
+    def record_success(self, provider, seconds):
+        self.latencies.record(provider, seconds)
+        self.strikes[provider] = 0
+
+    def record_strike(self, provider):
+        # A strike is a failure or a request that lost against the hedge
+        self.strikes[provider] += 1
+        if self.strikes[provider] >= self.degraded_after and not self.is_degraded(provider):
+            self.degraded_until[provider] = time.monotonic() + self.cooldown_seconds
+            self.strikes[provider] = 0
+            logger.warning(f"LLM provider {provider} marked as degraded for {self.cooldown_seconds}s")
+
+    def route(self, primary):
+        candidates = [primary] + [p for p in self.secondary_providers if p != primary]
+        healthy = [p for p in candidates if not self.is_degraded(p)]
+        return healthy or candidates
+
+    def select_provider(self, primary):
+        return self.route(primary)[0]
+
+    def hedge_delay(self, provider):
+        delay = self.latencies.percentile(provider, self.percentile, self.min_samples)
+        if delay is None:
+            return self.initial_hedge_delay
+        return max(self.min_hedge_delay, delay)
+
+    async def timed(self, provider, request, starts):
+        # request(provider, started) calls started() once the request leaves our own queues, the latency of the
+        # provider is measured from there
+        def started():
+            starts[provider] = time.monotonic()
+
+        called = time.monotonic()
+        try:
+            response = await request(provider, started)
+        except asyncio.CancelledError:
+            # The hedge won: keep the elapsed time as a lower bound so the percentile sees slow requests, unless the
+            # request never reached the provider
+            if provider in starts:
+                self.latencies.record(provider, time.monotonic() - starts[provider])
+            raise
+        except Exception:
+            self.record_strike(provider)
+            raise
+        if not isinstance(response, str) or not response.strip():
+            self.record_strike(provider)
+            raise ValueError(f"LLM provider {provider} returned an empty response")
+        self.record_success(provider, time.monotonic() - starts.get(provider, called))
+        return provider, response
+
+    async def dispatch(self, primary, request):
+        return (await self.dispatch_with_provider(primary, request))[1]
+
+    async def dispatch_with_provider(self, primary, request):
+        # Returns the provider that answered along with the response
+        providers = self.route(primary)
+        if providers[0] != primary:
+            self.failovers += 1
+            logger.info(f"LLM provider {primary} is degraded, routing to {providers[0]}")
+
+        starts = {}
+        pending = {asyncio.create_task(self.timed(providers[0], request, starts)): providers[0]}
+        remaining = providers[1:]
+        last_error = None
+        try:
+            while pending:
+                timeout = None
+                if remaining and len(pending) == 1:
+                    # The hedge delay runs from the moment the request left our own queues, a request still waiting
+                    # in the local scheduler is not hedged
+                    current = next(iter(pending.values()))
+                    delay = self.hedge_delay(current)
+                    timeout = delay if current not in starts else starts[current] + delay - time.monotonic()
+                done, _ = await asyncio.wait(pending, timeout=max(timeout, 0.0) if timeout is not None else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    if current not in starts or time.monotonic() - starts[current] < delay:
+                        continue
+                    secondary = remaining.pop(0)
+                    self.hedged += 1
+                    logger.info(f"LLM provider {providers[0]} is slower than its p{self.percentile}, "
+                                f"hedging on {secondary}")
+                    pending[asyncio.create_task(self.timed(secondary, request, starts))] = secondary
+                    continue
+
+                for task in done:
+                    provider = pending.pop(task)
+                    if task.exception() is None:
+                        if provider != providers[0]:
+                            self.hedge_wins += 1
+                            if any(p == providers[0] for p in pending.values()) and providers[0] in starts:
+                                self.record_strike(providers[0])
+                        return task.result()
+                    last_error = task.exception()
+                    logger.warning(f"LLM provider {provider} failed: {str(last_error)}")
+
+                if not pending and remaining:
+                    # Immediate failover when every started request failed
+                    secondary = remaining.pop(0)
+                    self.failovers += 1
+                    pending[asyncio.create_task(self.timed(secondary, request, starts))] = secondary
+        finally:
+            for task in pending:
+                task.cancel()
+
+        raise last_error
+
+    def stats(self):
+        return {
+            'hedged': self.hedged,
+            'hedge_wins': self.hedge_wins,
+            'failovers': self.failovers,
+            'degraded': [p for p in list(self.degraded_until) if self.is_degraded(p)],
+            f'p{self.percentile}': {
+                provider: self.latencies.percentile(provider, self.percentile)
+                for provider in list(self.latencies.samples)
+            }
+        }
@@ -0,0 +1,158 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 10
+
+
+def estimate_tokens(prompt, max_tokens):
+    # Roughly four characters per token for the prompt, plus the completion budget
+    return len(prompt) // 4 + max_tokens
+
+
+def is_rate_limited(error):
+    # LLMRequestError carries `status`, the openai and anthropic SDK errors `status_code`
+    return 429 in (getattr(error, 'status', None), getattr(error, 'status_code', None))
+
+
+class ProviderLane:
+    def __init__(self, name, max_concurrency, tokens_per_minute):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.tokens = float(tokens_per_minute) if tokens_per_minute else 0.0
+        self.last_refill = time.monotonic()
+        self.waiting = []
+        self.in_flight = 0
+        self.timer = None
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def refill(self):
+        now = time.monotonic()
+        if self.tokens_per_minute:
+            self.tokens = min(
+                float(self.tokens_per_minute),
+                self.tokens + (now - self.last_refill) * self.tokens_per_minute / 60
+            )
+        self.last_refill = now
+
+    def seconds_until_available(self, tokens):
+        if not self.tokens_per_minute:
+            return 0.0
+        needed = min(tokens, self.tokens_per_minute) - self.tokens
+        return max(0.0, needed * 60 / self.tokens_per_minute)
+
+    def stats(self):
+        return {
+            'queue_depth': len(self.waiting),
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'average_wait_seconds': self.total_wait / self.completed if self.completed else 0.0,
+            'max_wait_seconds': self.max_wait
+        }
+
+
+class LLMScheduler:
+    def __init__(self, config):
+        self.config = config
+        self.lanes = {}
+        self.sequence = itertools.count()
+
+    def get_lane(self, provider, model):
+        key = f"{provider}:{model}"
+        if key not in self.lanes:
+            provider_config = self.config.get('providers', {}).get(provider, {})
+            model_config = provider_config.get('models', {}).get(model, {})
+
+            def setting(name, default):
+                return model_config.get(name, provider_config.get(name, self.config.get(name, default)))
+
+            self.lanes[key] = ProviderLane(key, setting('max_concurrency', 8), setting('tokens_per_minute', 0))
+        return self.lanes[key]
+
+    async def acquire(self, provider, model, priority, tokens):
+        lane = self.get_lane(provider, model)
+        enqueued_at = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(lane.waiting, (priority, next(self.sequence), tokens, future))
+        self.dispatch(lane)
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been granted right before the caller was cancelled
+            if future.done() and not future.cancelled():
+                self.release(lane)
+            raise
+
+        waited = time.monotonic() - enqueued_at
+        lane.total_wait += waited
+        lane.max_wait = max(lane.max_wait, waited)
+        if waited > 1:
+            logger.debug(f"LLM request waited {waited:.2f}s in lane {lane.name} (priority {priority})")
+        return lane
+
+    @asynccontextmanager
+    async def slot(self, provider, model, priority, tokens):
+        lane = await self.acquire(provider, model, priority, tokens)
+        try:
+            yield lane
+        except Exception as e:
+            if is_rate_limited(e):
+                # The provider is already throttling us, stop granting tokens until the bucket refills
+                lane.tokens = 0.0
+                lane.last_refill = time.monotonic()
+            raise
+        finally:
+            lane.completed += 1
+            self.release(lane)
+
+    async def run(self, provider, model, priority, tokens, request_factory):
+        async with self.slot(provider, model, priority, tokens):
+            return await request_factory()
+
+    def release(self, lane):
+        lane.in_flight -= 1
+        self.dispatch(lane)
+
+    def dispatch(self, lane):
+        if lane.timer is not None:
+            lane.timer.cancel()
+            lane.timer = None
+
+        while lane.waiting and lane.in_flight < lane.max_concurrency:
+            priority, sequence, tokens, future = lane.waiting[0]
+            if future.done():
+                heapq.heappop(lane.waiting)
+                continue
+
+            lane.refill()
+            if lane.tokens_per_minute:
+                tokens = min(tokens, lane.tokens_per_minute)
+                if lane.tokens < tokens:
+                    delay = lane.seconds_until_available(tokens)
+                    lane.timer = asyncio.get_running_loop().call_later(delay, self.dispatch, lane)
+                    return
+                lane.tokens -= tokens
+
+            heapq.heappop(lane.waiting)
+            lane.in_flight += 1
+            future.set_result(None)
+
+    def stats(self):
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+    def close(self):
+        for lane in self.lanes.values():
+            if lane.timer is not None:
+                lane.timer.cancel()
+                lane.timer = None
@@ -1,57 +1,238 @@
 import asyncio
 import json
 import logging
-import os
 
-import faiss
-import openai
-import requests
-from anthropic import Anthropic
-from sentence_transformers import SentenceTransformer
-from transformers import pipeline
+from .llm_cache import LLMResponseCache, build_cache_key
+from .llm_clients import client_registry
+from .llm_hedging import HedgedDispatcher
+from .llm_scheduler import PRIORITY_NORMAL, LLMScheduler, estimate_tokens
+from .performance import SingleFlight
+from .rag import RAG, document_id  # noqa: F401 - RAG is re-exported, it used to live here
 
 logger = logging.getLogger(__name__)
 
 
-class RAG:
-    def __init__(self, knowledge_base_path, sentence_transformer_model='all-MiniLM-L6-v2', max_retrieved_documents=5,
-                 similarity_threshold=0.7):
-        self.sentence_model = SentenceTransformer(sentence_transformer_model)
-        self.knowledge_base = self.load_knowledge_base(knowledge_base_path)
-        self.index = self.build_index()
-        self.max_retrieved_documents = max_retrieved_documents
-        self.similarity_threshold = similarity_threshold
-
-    def load_knowledge_base(self, path):
-        with open(path, 'r') as f:
-            return json.load(f)
-
-    def build_index(self):
-        embeddings = self.sentence_model.encode([item['content'] for item in self.knowledge_base])
-        index = faiss.IndexFlatL2(embeddings.shape[1])
-        index.add(embeddings)
-        return index
-
-    def retrieve(self, query):
-        query_vector = self.sentence_model.encode([query])
-        distances, indices = self.index.search(query_vector, self.max_retrieved_documents)
-        retrieved = [
-            self.knowledge_base[i] for i, dist in zip(indices[0], distances[0])
-            if dist <= self.similarity_threshold
-        ]
-        return retrieved
-
-
-async def get_llm_response(prompt, config, rag=None):
-    provider = config['provider']
+class LLMRequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"LLM request failed with status code {status}: {message}")
+        self.status = status
+
+
+_response_cache = None
+_scheduler = None
+_hedged_dispatcher = None
+llm_request_flight = SingleFlight('LLM')
+
+
+def get_response_cache(config):
+    global _response_cache
+    cache_config = config.get('cache', {})
+    if not cache_config.get('enabled', False):
+        return None
+    if _response_cache is None:
+        _response_cache = LLMResponseCache(
+            max_entries=cache_config.get('max_entries', 1024),
+            ttl_seconds=cache_config.get('ttl_seconds', 86400),
+            db_path=cache_config.get('db_path'),
+            max_db_entries=cache_config.get('max_db_entries', 100000)
+        )
+    return _response_cache
+
+
+def close_response_cache():
+    global _response_cache
+    if _response_cache is not None:
+        logger.info(f"LLM response cache stats: {_response_cache.stats()}")
+        _response_cache.close()
+        _response_cache = None
+
+
+def get_scheduler(config):
+    global _scheduler
+    scheduler_config = config.get('scheduler', {})
+    if not scheduler_config.get('enabled', False):
+        return None
+    if _scheduler is None:
+        _scheduler = LLMScheduler(scheduler_config)
+    return _scheduler
+
+
+def close_scheduler():
+    global _scheduler
+    if _scheduler is not None:
+        logger.info(f"LLM scheduler stats: {_scheduler.stats()}")
+        _scheduler.close()
+        _scheduler = None
+
+
+def get_hedged_dispatcher(config):
+    global _hedged_dispatcher
+    hedging_config = config.get('hedging', {})
+    if not hedging_config.get('enabled', False):
+        return None
+    if _hedged_dispatcher is None:
+        _hedged_dispatcher = HedgedDispatcher(hedging_config)
+    return _hedged_dispatcher
+
+
+def close_hedged_dispatcher():
+    global _hedged_dispatcher
+    if _hedged_dispatcher is not None:
+        logger.info(f"LLM hedging stats: {_hedged_dispatcher.stats()}")
+        _hedged_dispatcher = None
+
+
+def get_model_settings(provider, config):
+    if provider == 'anthropic':
+        settings = config['alternative_providers']['anthropic']
+        return settings['model'], settings['temperature'], settings['max_tokens']
+    if provider == 'huggingface':
+        settings = config['model']
+        return settings['name'], settings['temperature'], settings['max_tokens']
+    if provider not in ('openai', 'generic'):
+        raise ValueError(f"Unsupported LLM provider: {provider}")
+    default = config['models']['default']
+    model = default['name']
+    if provider == 'openai' and config.get('use_fine_tuned'):
+        model = config['models']['fine_tuned']['name']
+    return model, default['temperature'], default['max_tokens']
+
+
+def is_cacheable_response(response, cache_config):
+    if not isinstance(response, str) or not response.strip():
+        return False
+    if cache_config.get('require_json', True):
+        try:
+            json.loads(response)
+        except json.JSONDecodeError:
+            return False
+    return True
+
 
+def build_retrieval_query(*parts, max_chars=1000):
+    # Flattens strings, lists and dicts into a compact text the embedding model can take in full
+    texts = []
+
+    def collect(value):
+        if isinstance(value, dict):
+            for item in value.values():
+                collect(item)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                collect(item)
+        elif value is not None and str(value).strip():
+            texts.append(' '.join(str(value).split()))
+
+    for part in parts:
+        collect(part)
+    return '\n'.join(texts)[:max_chars]
+
+
+async def build_augmented_prompt(prompt, rag=None, retrieval_query=None, seen_documents=None):
     if rag:
-        retrieved_context = rag.retrieve(prompt)
+        retrieved_context = await rag.aretrieve(retrieval_query or prompt)
+        if seen_documents is not None:
+            # Documents already given to an earlier stage of the same incident are not repeated
+            retrieved_context = [item for item in retrieved_context if document_id(item) not in seen_documents]
+            seen_documents.update(document_id(item) for item in retrieved_context)
         context_str = "\n".join([f"- {item['content']}" for item in retrieved_context])
-        augmented_prompt = f"Context from knowledge base:\n{context_str}\n\nPrompt: {prompt}"
+        return f"Context from knowledge base:\n{context_str}\n\nPrompt: {prompt}"
+    return f"Prompt: {prompt}"
+
+
+async def get_llm_response(prompt, config, rag=None, priority=PRIORITY_NORMAL, retrieval_query=None,
+                           seen_documents=None):
+    provider = config['provider']
+    augmented_prompt = await build_augmented_prompt(prompt, rag, retrieval_query, seen_documents)
+    cache_key = build_cache_key(augmented_prompt, provider, *get_model_settings(provider, config))
+
+    cache = get_response_cache(config)
+    if cache is not None:
+        cached_response = cache.get(cache_key)
+        if cached_response is not None:
+            logger.debug(f"LLM response cache hit for key {cache_key[:12]}")
+            return cached_response
+
+    async def request():
+        answered_by, response = await schedule_llm_request(provider, augmented_prompt, config, priority)
+        if cache is not None and is_cacheable_response(response, config['cache']):
+            # A hedge or failover answer is cached under the provider that produced it
+            key = cache_key if answered_by == provider else build_cache_key(
+                augmented_prompt, answered_by, *get_model_settings(answered_by, config))
+            cache.set(key, response)
+        return response
+
+    if not config.get('single_flight', True):
+        return await request()
+    return await llm_request_flight.do(cache_key, request)
+
+
+async def schedule_llm_request(provider, augmented_prompt, config, priority=PRIORITY_NORMAL):
+    # Returns the provider that answered, which differs from provider after a hedge or a failover
+    hedged_dispatcher = get_hedged_dispatcher(config)
+    if hedged_dispatcher is None:
+        return provider, await run_on_provider(provider, augmented_prompt, config, priority)
+
+    return await hedged_dispatcher.dispatch_with_provider(
+        provider, lambda selected, started: run_on_provider(selected, augmented_prompt, config, priority, started)
+    )
+
+
+async def run_on_provider(provider, augmented_prompt, config, priority=PRIORITY_NORMAL, started=None):
+    # started is called once the scheduler has granted a slot, when the request is actually sent
+    async def send():
+        if started is not None:
+            started()
+        return await dispatch_llm_request(provider, augmented_prompt, config)
+
+    scheduler = get_scheduler(config)
+    if scheduler is None:
+        return await send()
+
+    model, _, max_tokens = get_model_settings(provider, config)
+    return await scheduler.run(provider, model, priority, estimate_tokens(augmented_prompt, max_tokens), send)
+
+
+async def stream_llm_response(prompt, config, rag=None, priority=PRIORITY_NORMAL, retrieval_query=None,
+                              seen_documents=None):
+    provider = config['provider']
+    augmented_prompt = await build_augmented_prompt(prompt, rag, retrieval_query, seen_documents)
+
+    hedged_dispatcher = get_hedged_dispatcher(config)
+    if hedged_dispatcher is not None:
+        # Streams are not hedged, but still avoid a degraded provider
+        provider = hedged_dispatcher.select_provider(provider)
+
+    cache = get_response_cache(config)
+    cache_key = None
+    if cache is not None:
+        cache_key = build_cache_key(augmented_prompt, provider, *get_model_settings(provider, config))
+        cached_response = cache.get(cache_key)
+        if cached_response is not None:
+            logger.debug(f"LLM response cache hit for key {cache_key[:12]}")
+            yield cached_response
+            return
+
+    chunks = []
+    scheduler = get_scheduler(config)
+    if scheduler is None:
+        async for chunk in dispatch_llm_stream(provider, augmented_prompt, config):
+            chunks.append(chunk)
+            yield chunk
     else:
-        augmented_prompt = f"Prompt: {prompt}"
+        model, _, max_tokens = get_model_settings(provider, config)
+        async with scheduler.slot(provider, model, priority, estimate_tokens(augmented_prompt, max_tokens)):
+            async for chunk in dispatch_llm_stream(provider, augmented_prompt, config):
+                chunks.append(chunk)
+                yield chunk
+
+    if cache is not None:
+        response = ''.join(chunks)
+        if is_cacheable_response(response, config['cache']):
+            cache.set(cache_key, response)
 
+
+async def dispatch_llm_request(provider, augmented_prompt, config):
     if provider == 'openai':
         return await get_openai_response(augmented_prompt, config)
     elif provider == 'anthropic':
@@ -64,11 +245,24 @@ async def get_llm_response(prompt, config, rag=None):
         raise ValueError(f"Unsupported LLM provider: {provider}")
 
 
+def dispatch_llm_stream(provider, augmented_prompt, config):
+    if provider == 'openai':
+        return stream_openai_response(augmented_prompt, config)
+    elif provider == 'anthropic':
+        return stream_anthropic_response(augmented_prompt, config)
+    elif provider == 'huggingface':
+        return stream_huggingface_response(augmented_prompt, config)
+    elif provider == "generic":
+        return stream_generic_post_response(augmented_prompt, config)
+    else:
+        raise ValueError(f"Unsupported LLM provider: {provider}")
+
+
 async def get_openai_response(prompt, config):
-    openai.api_key = os.getenv(config['models']['default']['api_key'])
+    client = client_registry.get_openai_client(config)
     model = config['models']['fine_tuned' if config['use_fine_tuned'] else 'default']['name']
 
-    response = await openai.ChatCompletion.acreate(
+    response = await client.chat.completions.create(
         model=model,
         messages=[{"role": "user", "content": prompt}],
         max_tokens=config['models']['default']['max_tokens'],
@@ -77,8 +271,24 @@ async def get_openai_response(prompt, config):
     return response.choices[0].message.content.strip()
 
 
+async def stream_openai_response(prompt, config):
+    client = client_registry.get_openai_client(config)
+    model = config['models']['fine_tuned' if config['use_fine_tuned'] else 'default']['name']
+
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=config['models']['default']['max_tokens'],
+        temperature=config['models']['default']['temperature'],
+        stream=True
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
 async def get_anthropic_response(prompt, config):
-    anthropic = Anthropic(api_key=os.getenv(config['alternative_providers']['anthropic']['api_key']))
+    anthropic = client_registry.get_anthropic_client(config)
     response = await anthropic.completions.create(
         model=config['alternative_providers']['anthropic']['model'],
         prompt=prompt,
@@ -88,8 +298,26 @@ async def get_anthropic_response(prompt, config):
     return response.completion
 
 
+async def stream_anthropic_response(prompt, config):
+    anthropic = client_registry.get_anthropic_client(config)
+    stream = await anthropic.completions.create(
+        model=config['alternative_providers']['anthropic']['model'],
+        prompt=prompt,
+        max_tokens_to_sample=config['alternative_providers']['anthropic']['max_tokens'],
+        temperature=config['alternative_providers']['anthropic']['temperature'],
+        stream=True
+    )
+    async for completion in stream:
+        if completion.completion:
+            yield completion.completion
+
+
 async def get_huggingface_response(prompt, config):
-    generator = pipeline('text-generation', model=config['model']['name'])
+    if config['model'].get('batching', {}).get('enabled', False):
+        batcher = await client_registry.get_huggingface_batcher(config)
+        return await batcher.submit(prompt)
+
+    generator = await client_registry.get_huggingface_pipeline(config)
     response = await asyncio.to_thread(
         generator,
         prompt,
@@ -99,8 +327,12 @@ async def get_huggingface_response(prompt, config):
     return response[0]['generated_text']
 
 
-async def get_generic_post_response(prompt, config):
-    url = config['url']
+async def stream_huggingface_response(prompt, config):
+    # The local pipeline has no token streaming, the whole completion is a single chunk
+    yield await get_huggingface_response(prompt, config)
+
+
+def build_generic_request(prompt, config):
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {config['token']}"
@@ -114,13 +346,43 @@ async def get_generic_post_response(prompt, config):
         "max_tokens": config['models']['default']['max_tokens'],
         "temperature": config['models']['default']['temperature']
     }
+    return headers, payload
 
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
 
-    if response.status_code == 200:
-        response_data = response.json()
-        choices = response_data.get('choices', 'Field not found')
-        content = choices[0]["message"]["content"]
-        return content
-    else:
-        print(f"Request failed with status code {response.status_code}")
+async def get_generic_post_response(prompt, config):
+    headers, payload = build_generic_request(prompt, config)
+
+    session = client_registry.get_http_session(config)
+    async with session.post(config['url'], headers=headers, json=payload) as response:
+        if response.status != 200:
+            error_body = await response.text()
+            raise LLMRequestError(response.status, error_body[:500])
+        response_data = await response.json(content_type=None)
+
+    choices = response_data.get('choices')
+    if not choices:
+        raise LLMRequestError(response.status, "Response does not contain any choices")
+    return choices[0]["message"]["content"]
+
+
+async def stream_generic_post_response(prompt, config):
+    headers, payload = build_generic_request(prompt, config)
+    payload["stream"] = True
+
+    session = client_registry.get_http_session(config)
+    async with session.post(config['url'], headers=headers, json=payload) as response:
+        if response.status != 200:
+            error_body = await response.text()
+            raise LLMRequestError(response.status, error_body[:500])
+
+        # Server-sent events, one "data: {...}" line per delta
+        async for line in response.content:
+            line = line.decode('utf-8').strip()
+            if not line.startswith('data:'):
+                continue
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                break
+            choices = json.loads(data).get('choices') or []
+            if choices and choices[0].get('delta', {}).get('content'):
+                yield choices[0]['delta']['content']
@@ -0,0 +1,129 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+
+def day_partitions(date_from, date_to):
+    # Days of the [date_from, date_to) range, or None when the bounds are not plain yyyy-MM-dd dates
+    try:
+        start = date.fromisoformat(str(date_from))
+        end = date.fromisoformat(str(date_to))
+    except ValueError:
+        return None
+    return [(start + timedelta(days=offset)).isoformat() for offset in range((end - start).days)]
+
+
+def contiguous_ranges(days):
+    # Groups sorted days into (date_from, date_to) ranges, date_to being exclusive
+    ranges = []
+    for day in days:
+        following = (date.fromisoformat(day) + timedelta(days=1)).isoformat()
+        if ranges and ranges[-1][1] == day:
+            ranges[-1] = (ranges[-1][0], following)
+        else:
+            ranges.append((day, following))
+    return ranges
+
+
+def field_value(hit, field):
+    value = hit
+    for part in field.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def hit_day(value):
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value / 1000, tz=timezone.utc).date().isoformat()
+    if isinstance(value, str) and len(value) >= 10:
+        return value[:10]
+    return None
+
+
+def hit_timestamp(value):
+    # Sort key putting ISO strings and epoch milliseconds on the same scale, hits without a date last
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value / 1000, tz=timezone.utc).isoformat()
+    if isinstance(value, str):
+        return value
+    return '~'
+
+
+def partition_by_day(hits, date_field, days):
+    # None when a hit has no usable date, the range is then not cached
+    partitions = {day: [] for day in days}
+    for hit in hits:
+        day = hit_day(field_value(hit, date_field))
+        if day not in partitions:
+            return None
+        partitions[day].append(hit)
+    return partitions
+
+
+class DayPartitionedLogCache:
+    def __init__(self, max_size_mb=256, ttl_seconds=604800, current_day_ttl_seconds=300):
+        self.max_bytes = max_size_mb * 1024 * 1024
+        self.ttl_seconds = ttl_seconds
+        self.current_day_ttl_seconds = current_day_ttl_seconds
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_days(self, key, days):
+        now = time.time()
+        found = {}
+        for day in days:
+            entry = self.entries.get((*key, day))
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end((*key, day))
+                found[day] = entry[2]
+                self.hits += 1
+            else:
+                if entry is not None:
+                    self.remove((*key, day))
+                self.misses += 1
+        return found
+
+    def put_days(self, key, partitions):
+        now = time.time()
+        today = datetime.now(timezone.utc).date().isoformat()
+        for day, hits in partitions.items():
+            # Today's logs are still being written, and later days are not there yet
+            ttl = self.current_day_ttl_seconds if day >= today else self.ttl_seconds
+            size = len(json.dumps(hits))
+            if size > self.max_bytes:
+                continue
+            self.remove((*key, day))
+            self.entries[(*key, day)] = (now + ttl, size, hits)
+            self.size += size
+
+        while self.size > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self.remove(oldest)
+            self.evictions += 1
+
+    def remove(self, entry_key):
+        entry = self.entries.pop(entry_key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def stats(self):
+        return {
+            'days': len(self.entries),
+            'size_mb': round(self.size / (1024 * 1024), 2),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
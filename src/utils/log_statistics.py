@@ -0,0 +1,274 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from .log_cache import field_value
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FIELDS = {
+    'user': 'user.userId',
+    'ip': 'clientIp',
+    'date': 'date',
+    'action': 'action',
+    'status': 'status',
+    'country': 'geo.country'
+}
+DEFAULT_FAILURE_VALUES = ['failed', 'failure', 'denied', 'error', '401', '403']
+
+IMPLICATIONS = {
+    'failed_login_burst': "Possible brute force or credential stuffing against the account",
+    'volume_spike': "Activity far above the baseline of the window, possibly automated or abusive use",
+    'new_ip': "Access from an address not seen earlier in the window, possibly a compromised account",
+    'new_country': "Access from a new country, possibly account takeover or impossible travel",
+    'automated_timing': "Events too fast or too regular to be produced by a person, likely a script or bot"
+}
+ACTIONS = {
+    'failed_login_burst': ["Check whether a login eventually succeeded after the failures",
+                           "Consider locking the account or blocking the source addresses"],
+    'volume_spike': ["Review the events of the spike and the operations performed"],
+    'new_ip': ["Confirm with the user whether the new address is legitimate",
+               "Check the reputation and location of the address"],
+    'new_country': ["Confirm the travel or VPN usage with the user", "Force a password reset if unconfirmed"],
+    'automated_timing': ["Check the user agent and client of the events", "Apply rate limiting to the account"]
+}
+
+
+def severity_confidence(ratio):
+    # A finding exactly at its threshold scores 0.5, twice the threshold 0.75, three times 0.875...
+    return round(float(min(0.99, 1 - 0.5 ** max(ratio, 0))), 2)
+
+
+def parse_timestamps(values):
+    # ISO strings and epoch milliseconds may be mixed across sources
+    numeric = pd.to_numeric(values, errors='coerce')
+    parsed = pd.to_datetime(values.where(numeric.isna()), utc=True, errors='coerce', format='ISO8601')
+    return parsed.fillna(pd.to_datetime(numeric, unit='ms', utc=True))
+
+
+def zscores(counts):
+    # Row-wise z-scores of a (keys x buckets) count matrix against the mean of each row
+    mean = counts.mean(axis=1, keepdims=True)
+    std = counts.std(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(std > 0, (counts - mean) / std, 0.0)
+
+
+class LogStatisticsAnalyzer:
+    def __init__(self, config=None):
+        config = config or {}
+        self.fields = {**DEFAULT_FIELDS, **config.get('fields', {})}
+        self.failure_values = {str(value).lower() for value in config.get('failure_values', DEFAULT_FAILURE_VALUES)}
+        self.login_actions = [action.lower() for action in config.get('login_actions', ['login', 'auth'])]
+        self.bucket = config.get('bucket', '1h')
+        self.burst_window = config.get('burst_window', '5min')
+        self.burst_threshold = config.get('burst_threshold', 5)
+        self.z_score_threshold = config.get('z_score_threshold', 3.0)
+        self.baseline_fraction = config.get('baseline_fraction', 0.5)
+        self.min_interval_seconds = config.get('min_interval_seconds', 1.0)
+        self.max_timing_cv = config.get('max_timing_cv', 0.1)
+        self.min_events = config.get('min_events', 10)
+        self.max_candidates = config.get('max_candidates', 20)
+        self.max_baseline_values = config.get('max_baseline_values', 5)
+
+    def build_frame(self, logs):
+        # Only the configured fields are extracted, the rest of each entry is left out of the frame
+        sources, columns = [], {name: [] for name in self.fields}
+        for source, entries in logs.items():
+            sources.extend([source] * len(entries))
+            for name, path in self.fields.items():
+                columns[name].extend(field_value(entry, path) for entry in entries)
+
+        frame = pd.DataFrame({'source': pd.Series(sources, dtype='object'),
+                              **{name: pd.Series(values, dtype='object') for name, values in columns.items()}})
+        frame['time'] = parse_timestamps(frame['date'])
+        frame = frame.dropna(subset=['time']).sort_values('time', kind='stable').reset_index(drop=True)
+        for name in ('user', 'ip', 'country'):
+            frame[name] = frame[name].astype('string')
+
+        action = frame['action'].astype('string').str.lower().fillna('')
+        status = frame['status'].astype('string').str.lower().fillna('')
+        is_login = np.zeros(len(frame), dtype=bool)
+        for login_action in self.login_actions:
+            is_login |= action.str.contains(login_action, regex=False).to_numpy()
+        frame['failed_login'] = is_login & status.isin(self.failure_values).to_numpy()
+        return frame
+
+    def analyze(self, logs):
+        frame = self.build_frame(logs)
+        if frame.empty:
+            return {'summary': {'events': 0}, 'candidates': []}
+
+        start, end = frame['time'].iloc[0], frame['time'].iloc[-1]
+        hours = max((end - start).total_seconds() / 3600, 1.0)
+        users = frame.groupby('user', dropna=True).size().sort_values(ascending=False)
+        ips = frame.groupby('ip', dropna=True).size().sort_values(ascending=False)
+
+        candidates = (self.failed_login_bursts(frame) + self.volume_spikes(frame) + self.novelty(frame, start, end)
+                      + self.timing(frame))
+        candidates.sort(key=lambda candidate: candidate['score'], reverse=True)
+
+        summary = {
+            'events': int(len(frame)),
+            'events_per_source': {source: int(count) for source, count in frame['source'].value_counts().items()},
+            'from': start.isoformat(),
+            'to': end.isoformat(),
+            'unique_users': int(len(users)),
+            'unique_ips': int(len(ips)),
+            'failed_logins': int(frame['failed_login'].sum()),
+            'top_users_per_hour': {user: round(count / hours, 2) for user, count in users.head(5).items()},
+            'top_ips_per_hour': {ip: round(count / hours, 2) for ip, count in ips.head(5).items()},
+            'candidates': len(candidates)
+        }
+        return {'summary': summary, 'candidates': candidates[:self.max_candidates]}
+
+    def failed_login_bursts(self, frame):
+        failed = frame.loc[frame['failed_login'] & frame['user'].notna(), ['user', 'ip', 'time']]
+        if failed.empty:
+            return []
+        # Number of failures of the same user in the burst window ending at each failure, the rolling result comes
+        # out grouped by user in time order, which is the order of the sorted frame
+        failed = failed.sort_values(['user', 'time'], kind='stable')
+        failed['count'] = (failed.assign(count=1).groupby('user').rolling(self.burst_window, on='time')['count']
+                           .sum().to_numpy())
+        peak_rows = failed.groupby('user')['count'].idxmax()
+
+        candidates = []
+        for user, row in peak_rows.items():
+            peak, peak_time = failed.at[row, 'count'], failed.at[row, 'time']
+            if peak < self.burst_threshold:
+                continue
+            in_burst = failed[(failed['user'] == user) & (failed['time'] > peak_time - pd.Timedelta(self.burst_window))
+                              & (failed['time'] <= peak_time)]
+            ratio = peak / self.burst_threshold
+            candidates.append({
+                'type': 'failed_login_burst',
+                'key': user,
+                'score': round(float(ratio), 2),
+                'description': f"{int(peak)} failed logins for user {user} within {self.burst_window}",
+                'supporting_data': {
+                    'user': user,
+                    'failures': int(peak),
+                    'ips': sorted(in_burst['ip'].dropna().unique().tolist()),
+                    'from': in_burst['time'].iloc[0].isoformat(),
+                    'to': peak_time.isoformat()
+                }
+            })
+        return candidates
+
+    def volume_spikes(self, frame):
+        # Events per user and bucket, empty buckets included, compared with the user's own baseline over the window
+        keyed = frame[frame['user'].notna()]
+        if keyed.empty:
+            return []
+        buckets = keyed['time'].dt.floor(self.bucket)
+        counts = pd.crosstab(keyed['user'], buckets)
+        counts = counts.reindex(columns=pd.date_range(buckets.min(), buckets.max(), freq=self.bucket), fill_value=0)
+        if counts.shape[1] < 3:
+            return []
+        scores = zscores(counts.to_numpy(dtype=float))
+
+        candidates = []
+        rows, columns = np.nonzero(scores >= self.z_score_threshold)
+        # Highest z-scores first, only as many as can be kept
+        top = np.argsort(-scores[rows, columns], kind='stable')[:self.max_candidates]
+        for row, column in zip(rows[top], columns[top]):
+            user, bucket = counts.index[row], counts.columns[column]
+            score = scores[row, column]
+            candidates.append({
+                'type': 'volume_spike',
+                'key': user,
+                'score': round(float(score / self.z_score_threshold), 2),
+                'description': f"User {user} produced {int(counts.iat[row, column])} events in the {self.bucket} "
+                               f"starting at {bucket.isoformat()}, z-score {score:.1f}",
+                'supporting_data': {
+                    'user': user,
+                    'bucket': bucket.isoformat(),
+                    'events': int(counts.iat[row, column]),
+                    'baseline_mean': round(float(counts.iloc[row].mean()), 2),
+                    'z_score': round(float(score), 2)
+                }
+            })
+        return candidates
+
+    def novelty(self, frame, start, end):
+        # An address or country first used by a user after the baseline part of the window, while the user was
+        # already active during the baseline
+        baseline_end = start + (end - start) * self.baseline_fraction
+        baseline_users = set(frame.loc[frame['time'] <= baseline_end, 'user'].dropna())
+
+        candidates = []
+        for name, candidate_type, weight in (('ip', 'new_ip', 1), ('country', 'new_country', 2)):
+            pairs = frame[frame['user'].notna() & frame[name].notna()]
+            if pairs.empty:
+                continue
+            seen = pairs.groupby(['user', name])['time'].agg(['min', 'size'])
+            novel = seen[(seen['min'] > baseline_end) & seen.index.get_level_values(0).isin(baseline_users)]
+            # A new country weighs more than a new address, and rarely used new values more than frequent ones.
+            # Only the pairs that can make it to the candidates are turned into dicts
+            novel = novel.assign(score=weight + 1 / novel['size']).nlargest(self.max_candidates, 'score')
+            top_users = novel.index.get_level_values(0).unique()
+            baseline = pairs[(pairs['time'] <= baseline_end) & pairs['user'].isin(top_users)]
+            known = baseline.groupby('user')[name].unique()
+            for (user, value), first_seen, size, score in zip(novel.index, novel['min'], novel['size'], novel['score']):
+                candidates.append({
+                    'type': candidate_type,
+                    'key': user,
+                    'score': round(float(score), 2),
+                    'description': f"User {user} used the new {name} {value} from {first_seen.isoformat()}",
+                    'supporting_data': {
+                        'user': user,
+                        name: value,
+                        'first_seen': first_seen.isoformat(),
+                        'events': int(size),
+                        f"baseline_{name}s": sorted(map(str, known.get(user, [])))[:self.max_baseline_values]
+                    }
+                })
+        return candidates
+
+    def timing(self, frame):
+        keyed = frame.loc[frame['user'].notna(), ['user', 'time']]
+        gaps = keyed.groupby('user')['time'].diff().dt.total_seconds()
+        stats = gaps.groupby(keyed['user']).agg(['count', 'median', 'mean', 'std'])
+        stats = stats[stats['count'] >= self.min_events - 1]
+        if stats.empty:
+            return []
+        cv = (stats['std'] / stats['mean'].where(stats['mean'] > 0)).fillna(0)
+        fast = stats['median'] < self.min_interval_seconds
+        regular = cv < self.max_timing_cv
+
+        candidates = []
+        for user in stats.index[fast | regular]:
+            median = float(stats.at[user, 'median'])
+            ratio = max(self.min_interval_seconds / max(median, 1e-3) if fast[user] else 0,
+                        self.max_timing_cv / max(float(cv[user]), 1e-3) if regular[user] else 0)
+            candidates.append({
+                'type': 'automated_timing',
+                'key': user,
+                'score': round(float(min(ratio, 10)), 2),
+                'description': f"User {user} has a median of {median:.2f}s between events "
+                               f"(coefficient of variation {cv[user]:.2f}) over {int(stats.at[user, 'count']) + 1} events",
+                'supporting_data': {
+                    'user': user,
+                    'events': int(stats.at[user, 'count']) + 1,
+                    'median_interval_seconds': round(median, 3),
+                    'interval_cv': round(float(cv[user]), 3)
+                }
+            })
+        return candidates
+
+
+def statistical_anomalies(analysis):
+    # Candidates in the schema of the LLM anomalies, for when no LLM is used
+    return [
+        {
+            'description': candidate['description'],
+            'supporting_data': candidate['supporting_data'],
+            'potential_implications': IMPLICATIONS[candidate['type']],
+            'confidence_score': severity_confidence(candidate['score']),
+            'recommended_actions': ACTIONS[candidate['type']],
+            'patterns': [candidate['type']]
+        }
+        for candidate in analysis['candidates']
+    ]
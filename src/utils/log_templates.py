@@ -0,0 +1,135 @@
+import json
+import logging
+import re
+
+from .log_cache import field_value, hit_timestamp
+
+logger = logging.getLogger(__name__)
+
+WILDCARD = '<*>'
+HAS_DIGIT = re.compile(r'\d')
+
+
+def flatten(entry, prefix=''):
+    for key, value in entry.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        else:
+            yield f"{prefix}{key}", value
+
+
+def mask(token):
+    # Numbers, ids, addresses and timestamps are variables, only the key of a key=value token is kept
+    if not HAS_DIGIT.search(token):
+        return token
+    key, separator, _ = token.partition('=')
+    return f"{key}={WILDCARD}" if separator else WILDCARD
+
+
+class LogTemplate:
+    def __init__(self, template_id, source, tokens):
+        self.template_id = template_id
+        self.source = source
+        self.tokens = tokens
+        self.count = 0
+        self.first = None
+        self.last = None
+        self.entries = []
+
+    def similarity(self, tokens):
+        # Share of the positions where the template has the same constant token
+        same = sum(1 for own, other in zip(self.tokens, tokens) if own == other and own != WILDCARD)
+        return same / len(tokens) if tokens else 1.0
+
+    def merge(self, tokens):
+        self.tokens = [own if own == other else WILDCARD for own, other in zip(self.tokens, tokens)]
+
+    def text(self):
+        return ' '.join(self.tokens)
+
+
+class LogTemplateMiner:
+    # Drain: entries are routed by token count and their first tokens to a small group of templates, and join the
+    # most similar one, so each entry is handled in constant time whatever the number of entries seen
+    def __init__(self, config=None):
+        config = config or {}
+        self.depth = max(config.get('depth', 4), 3)
+        self.similarity_threshold = config.get('similarity_threshold', 0.5)
+        self.max_children = config.get('max_children', 100)
+        self.max_exemplars = config.get('max_exemplars', 2)
+        self.rare_count = config.get('rare_count', 3)
+        self.message_field = config.get('message_field', 'message')
+        self.date_field = config.get('date_field', 'date')
+        self.tree = {}
+        self.templates = []
+        self.entries = 0
+
+    def tokenize(self, entry):
+        message = field_value(entry, self.message_field) if isinstance(entry, dict) else entry
+        if isinstance(message, str):
+            tokens = message.split()
+        else:
+            # Structured entries without a message are mined on their key=value pairs, the date excluded
+            tokens = [
+                f"{key}={json.dumps(value) if isinstance(value, (list, dict)) else value}"
+                for key, value in sorted(flatten(entry)) if key != self.date_field
+            ]
+        return [mask(token) for token in tokens]
+
+    def add(self, source, entry):
+        tokens = self.tokenize(entry)
+        node = self.tree.setdefault((source, len(tokens)), {})
+        for token in tokens[:self.depth - 2]:
+            if HAS_DIGIT.search(token) or WILDCARD in token:
+                token = WILDCARD
+            if token not in node and len(node) >= self.max_children:
+                token = WILDCARD
+            node = node.setdefault(token, {})
+        group = node.setdefault(None, [])
+
+        best, best_similarity = None, -1.0
+        for template in group:
+            similarity = template.similarity(tokens)
+            if similarity > best_similarity:
+                best, best_similarity = template, similarity
+        if best is None or best_similarity < self.similarity_threshold:
+            best = LogTemplate(len(self.templates) + 1, source, tokens)
+            group.append(best)
+            self.templates.append(best)
+        else:
+            best.merge(tokens)
+
+        timestamp = hit_timestamp(field_value(entry, self.date_field)) if isinstance(entry, dict) else '~'
+        best.count += 1
+        self.entries += 1
+        if timestamp != '~':
+            best.first = timestamp if best.first is None else min(best.first, timestamp)
+            best.last = timestamp if best.last is None else max(best.last, timestamp)
+        # Rare templates keep every entry, the others a few exemplars
+        if len(best.entries) < max(self.max_exemplars, self.rare_count):
+            best.entries.append(entry)
+        return best
+
+    def render(self):
+        # Templates first, one line each so the whole time window fits, then the rare entries verbatim, then the
+        # exemplars of the frequent templates
+        frequent = sorted((template for template in self.templates if template.count > self.rare_count),
+                          key=lambda template: template.first or '~')
+        rare = [
+            (hit_timestamp(field_value(entry, self.date_field)) if isinstance(entry, dict) else '~', template, entry)
+            for template in self.templates if template.count <= self.rare_count for entry in template.entries
+        ]
+
+        lines = [
+            f"[{template.source} template T{template.template_id}] count={template.count} first={template.first} "
+            f"last={template.last} {template.text()}"
+            for template in frequent
+        ]
+        rare.sort(key=lambda item: item[0])
+        lines += [f"[{template.source}] {json.dumps(entry)}" for _, template, entry in rare]
+        lines += [
+            f"[{template.source} T{template.template_id} exemplar] {json.dumps(entry)}"
+            for template in frequent for entry in template.entries[:self.max_exemplars]
+        ]
+        logger.debug(f"Mined {len(self.templates)} templates from {self.entries} log entries")
+        return lines
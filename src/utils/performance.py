@@ -18,6 +18,35 @@ async def batch_process(items, process_func, batch_size=100, max_workers=4):
     return results
 
 
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self.in_flight = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key, func):
+        # Concurrent callers with the same key share one execution of func instead of running duplicates
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            logger.debug(f"Coalesced duplicate {self.name} request ({self.coalesced} so far)")
+        else:
+            task = asyncio.ensure_future(func())
+            self.in_flight[key] = task
+            self.executed += 1
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        # Shielded so that one cancelled caller does not cancel the request for the others
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            'executed': self.executed,
+            'coalesced': self.coalesced,
+            'in_flight': len(self.in_flight)
+        }
+
+
 class AsyncRateLimiter:
     def __init__(self, rate_limit, time_period=60):
         self.rate_limit = rate_limit
@@ -0,0 +1,417 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import faiss
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+from .llm_batching import MicroBatcher
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = 'manifest.json'
+EMBEDDINGS_FILE = 'embeddings.npy'
+IDS_FILE = 'ids.npy'
+DOCUMENTS_FILE = 'documents.json'
+INDEX_FILE = 'index.faiss'
+INDEX_FORMAT = 3
+
+INDEX_TYPES = ('flat', 'ivf', 'hnsw', 'ivf_pq', 'sq8')
+# FAISS k-means wants at least this many training points per centroid
+MIN_POINTS_PER_CENTROID = 39
+
+UPDATE_FREQUENCIES = {'hourly': 3600, 'daily': 86400, 'weekly': 604800}
+
+
+def load_knowledge_base(path):
+    # A knowledge base is either a JSON file or a directory of JSON files, each holding a document or a list of them
+    if os.path.isdir(path):
+        documents = []
+        for filename in sorted(os.listdir(path)):
+            if filename.endswith('.json'):
+                documents.extend(load_knowledge_base(os.path.join(path, filename)))
+        return documents
+
+    with open(path, 'r') as f:
+        content = json.load(f)
+    return content if isinstance(content, list) else [content]
+
+
+def knowledge_base_mtime(path):
+    if not os.path.isdir(path):
+        return os.path.getmtime(path)
+    # The directory mtime changes when a file is added or removed
+    mtimes = [os.path.getmtime(path)]
+    mtimes.extend(
+        os.path.getmtime(os.path.join(path, filename))
+        for filename in os.listdir(path) if filename.endswith('.json')
+    )
+    return max(mtimes)
+
+
+def document_id(item):
+    if 'id' in item:
+        return str(item['id'])
+    return hashlib.sha256(item['content'].encode('utf-8')).hexdigest()[:16]
+
+
+def faiss_id(doc_id):
+    # Stable 60-bit integer id, FAISS ids are signed 64-bit
+    return int(hashlib.sha256(doc_id.encode('utf-8')).hexdigest()[:15], 16)
+
+
+def query_hash(query):
+    return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+
+def knowledge_base_hash(documents):
+    content = json.dumps(sorted(documents, key=document_id), sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def create_ann_index(embeddings, ids, index_config=None):
+    # Embeddings are L2-normalized, so the inner product is the cosine similarity
+    index_config = index_config or {}
+    index_type = index_config.get('type', 'flat')
+    count, dimension = embeddings.shape
+    metric = faiss.METRIC_INNER_PRODUCT
+
+    if index_type == 'ivf_pq' and count < MIN_POINTS_PER_CENTROID * 2 ** index_config.get('pq_nbits', 8):
+        logger.info(f"Not enough documents to train a PQ codebook ({count}), using an IVF index instead")
+        index_type = 'ivf'
+
+    if index_type == 'flat' or count == 0:
+        base = faiss.IndexFlatIP(dimension)
+    elif index_type in ('ivf', 'ivf_pq'):
+        nlist = max(1, min(index_config.get('nlist', 1024), count // MIN_POINTS_PER_CENTROID))
+        quantizer = faiss.IndexFlatIP(dimension)
+        if index_type == 'ivf':
+            base = faiss.IndexIVFFlat(quantizer, dimension, nlist, metric)
+        else:
+            pq_m = index_config.get('pq_m', 16)
+            if dimension % pq_m:
+                raise ValueError(f"pq_m ({pq_m}) must divide the embedding dimension ({dimension})")
+            base = faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m, index_config.get('pq_nbits', 8), metric)
+    elif index_type == 'hnsw':
+        base = faiss.IndexHNSWFlat(dimension, index_config.get('hnsw_m', 32), metric)
+        base.hnsw.efConstruction = index_config.get('ef_construction', 200)
+    elif index_type == 'sq8':
+        base = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, metric)
+    else:
+        raise ValueError(f"Unsupported RAG index type: {index_type}, expected one of {', '.join(INDEX_TYPES)}")
+
+    if not base.is_trained:
+        base.train(embeddings)
+    index = faiss.IndexIDMap2(base)
+    index.add_with_ids(embeddings, ids)
+    configure_search(index, index_config)
+    return index
+
+
+def configure_search(index, index_config=None):
+    index_config = index_config or {}
+    base = faiss.downcast_index(index.index)
+    if isinstance(base, faiss.IndexIVF):
+        base.nprobe = min(index_config.get('nprobe', 16), base.nlist)
+    elif isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efSearch = index_config.get('ef_search', 64)
+    return index
+
+
+class RAG:
+    def __init__(self, knowledge_base_path, sentence_transformer_model='all-MiniLM-L6-v2', max_retrieved_documents=5,
+                 similarity_threshold=0.7, index_dir=None, index_config=None, query_config=None):
+        self.knowledge_base_path = knowledge_base_path
+        self.model_name = sentence_transformer_model
+        self.sentence_model = SentenceTransformer(sentence_transformer_model)
+        self.index_dir = index_dir
+        self.max_retrieved_documents = max_retrieved_documents
+        self.similarity_threshold = similarity_threshold
+        self.index_config = index_config or {}
+        query_config = query_config or {}
+        self.query_cache = OrderedDict()
+        self.query_cache_size = query_config.get('cache_size', 1024)
+        self.query_cache_hits = 0
+        self.query_cache_misses = 0
+        # Queries are embedded and searched on a dedicated thread, concurrent ones in a single encode call
+        self.query_batcher = MicroBatcher(
+            'rag-queries',
+            self.retrieve_batch,
+            max_batch_size=query_config.get('max_batch_size', 32),
+            max_wait_ms=query_config.get('max_wait_ms', 5)
+        )
+        self.lock = threading.RLock()
+        self.documents = {}
+        self.ids = np.zeros(0, dtype='int64')
+        self.embeddings = None
+        self.index = None
+        self.writable = False
+        self.loaded_hash = None
+
+        knowledge_base = self.load_knowledge_base(knowledge_base_path)
+        if index_dir and self.load_index():
+            self.sync(knowledge_base)
+        else:
+            self.build(knowledge_base)
+
+    @property
+    def knowledge_base(self):
+        return list(self.documents.values())
+
+    def load_knowledge_base(self, path):
+        return load_knowledge_base(path)
+
+    def encode(self, texts):
+        vectors = np.ascontiguousarray(self.sentence_model.encode(texts), dtype='float32')
+        faiss.normalize_L2(vectors)
+        return vectors
+
+    def create_index(self, embeddings, ids):
+        return create_ann_index(np.ascontiguousarray(embeddings), ids, self.index_config)
+
+    def build(self, knowledge_base):
+        documents = {faiss_id(document_id(item)): item for item in knowledge_base}
+        ids = np.fromiter(documents.keys(), dtype='int64', count=len(documents))
+        embeddings = self.encode([item['content'] for item in documents.values()])
+        index = self.create_index(embeddings, ids)
+
+        with self.lock:
+            self.documents, self.ids, self.embeddings, self.index = documents, ids, embeddings, index
+            self.writable = True
+        logger.info(f"Built {self.index_config.get('type', 'flat')} RAG index with {len(documents)} documents")
+        if self.index_dir:
+            self.save_index()
+
+    def build_index(self):
+        self.build(self.knowledge_base)
+        return self.index
+
+    def load_index(self):
+        manifest_path = os.path.join(self.index_dir, MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return False
+
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('model') != self.model_name or manifest.get('format') != INDEX_FORMAT:
+            logger.info("Persisted RAG index was built with another model or format, rebuilding it")
+            return False
+
+        with open(os.path.join(self.index_dir, DOCUMENTS_FILE), 'r') as f:
+            self.documents = {int(key): item for key, item in json.load(f).items()}
+        # Memory-mapped and read-only, so every worker process shares the same pages
+        self.ids = np.load(os.path.join(self.index_dir, IDS_FILE), mmap_mode='r')
+        self.embeddings = np.load(os.path.join(self.index_dir, EMBEDDINGS_FILE), mmap_mode='r')
+        self.loaded_hash = manifest.get('kb_hash')
+
+        if manifest.get('index') != self.index_config:
+            # Only the index type or its parameters changed, the stored embeddings are still valid
+            logger.info("Persisted RAG index was built with other index settings, rebuilding it from the embeddings")
+            self.index = self.create_index(self.embeddings, self.ids)
+            self.writable = True
+            self.save_index()
+            return True
+
+        # Every index type is memory-mapped, its vectors and graph included, not only the IVF lists
+        self.index = configure_search(faiss.read_index(os.path.join(self.index_dir, INDEX_FILE),
+                                                       faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY),
+                                      self.index_config)
+        self.writable = False
+        logger.info(f"Loaded persisted RAG index with {self.index.ntotal} documents from {self.index_dir}")
+        return True
+
+    def private_index(self):
+        # A clone would still point at the read-only mapped pages, read a private copy of the same file instead
+        return configure_search(faiss.read_index(os.path.join(self.index_dir, INDEX_FILE)), self.index_config)
+
+    def save_index(self):
+        os.makedirs(self.index_dir, exist_ok=True)
+
+        with self.lock:
+            documents = {str(key): item for key, item in self.documents.items()}
+            manifest = {
+                'format': INDEX_FORMAT,
+                'model': self.model_name,
+                'index': self.index_config,
+                'kb_hash': knowledge_base_hash(list(self.documents.values())),
+                'documents': len(self.documents),
+                'dimension': int(self.index.d)
+            }
+
+            # Write to temporary files and rename them, the manifest last, so a reader never sees a partial index
+            for filename, array in ((EMBEDDINGS_FILE, self.embeddings), (IDS_FILE, self.ids)):
+                path = os.path.join(self.index_dir, filename)
+                with open(path + '.tmp', 'wb') as f:
+                    np.save(f, np.asarray(array))
+                os.replace(path + '.tmp', path)
+
+            index_path = os.path.join(self.index_dir, INDEX_FILE)
+            faiss.write_index(self.index, index_path + '.tmp')
+            os.replace(index_path + '.tmp', index_path)
+
+        documents_path = os.path.join(self.index_dir, DOCUMENTS_FILE)
+        with open(documents_path + '.tmp', 'w') as f:
+            json.dump(documents, f)
+        os.replace(documents_path + '.tmp', documents_path)
+
+        manifest_path = os.path.join(self.index_dir, MANIFEST_FILE)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        logger.info(f"Persisted RAG index with {manifest['documents']} documents to {self.index_dir}")
+
+    def sync(self, knowledge_base):
+        if self.loaded_hash == knowledge_base_hash(knowledge_base):
+            return 0, 0
+
+        current = {document_id(item): item for item in knowledge_base}
+        known = {document_id(item): item for item in self.documents.values()}
+        upserts = [item for doc_id, item in current.items() if known.get(doc_id) != item]
+        deletes = [doc_id for doc_id in known if doc_id not in current]
+        if upserts or deletes:
+            self.apply_updates(upserts, deletes)
+        self.loaded_hash = None
+        return len(upserts), len(deletes)
+
+    def add_documents(self, documents):
+        self.apply_updates(upserts=documents)
+
+    def update_documents(self, documents):
+        self.apply_updates(upserts=documents)
+
+    def delete_documents(self, doc_ids):
+        self.apply_updates(deletes=doc_ids)
+
+    def apply_updates(self, upserts=(), deletes=()):
+        upserts = list({document_id(item): item for item in upserts}.values())
+        # Encoding is the slow part and runs before taking the lock, so queries keep being served meanwhile
+        vectors = self.encode([item['content'] for item in upserts]) if upserts else None
+        upsert_ids = np.array([faiss_id(document_id(item)) for item in upserts], dtype='int64')
+        delete_ids = {faiss_id(str(doc_id)) for doc_id in deletes} - set(upsert_ids.tolist())
+
+        with self.lock:
+            replaced = [i for i in upsert_ids.tolist() if i in self.documents]
+            deleted = [i for i in delete_ids if i in self.documents]
+            removed = np.array(replaced + deleted, dtype='int64')
+            keep = ~np.isin(self.ids, removed)
+            ids = np.concatenate([np.asarray(self.ids)[keep], upsert_ids])
+            embeddings = np.concatenate([np.asarray(self.embeddings)[keep], vectors]) if upserts \
+                else np.asarray(self.embeddings)[keep]
+
+            # A memory-mapped index is read-only, updates go to a private copy
+            index = self.index if self.writable else self.private_index()
+            try:
+                if len(removed):
+                    index.remove_ids(removed)
+                if upserts:
+                    index.add_with_ids(vectors, upsert_ids)
+            except RuntimeError:
+                # Some index types cannot remove vectors, rebuild from the stored embeddings instead
+                index = self.create_index(embeddings, ids)
+
+            for i in deleted:
+                del self.documents[i]
+            for i, item in zip(upsert_ids.tolist(), upserts):
+                self.documents[i] = item
+            self.ids, self.embeddings, self.index = ids, embeddings, index
+            self.writable = True
+
+        logger.info(f"Applied RAG knowledge base update: {len(upserts)} upserted, {len(deleted)} deleted")
+        if self.index_dir:
+            self.save_index()
+
+    def encode_queries(self, queries):
+        keys = [query_hash(query) for query in queries]
+        vectors = {}
+        with self.lock:
+            for key in keys:
+                if key in self.query_cache:
+                    self.query_cache.move_to_end(key)
+                    vectors[key] = self.query_cache[key]
+                    self.query_cache_hits += 1
+
+        missing = list({key: query for key, query in zip(keys, queries) if key not in vectors}.items())
+        if missing:
+            encoded = self.encode([query for _, query in missing])
+            with self.lock:
+                self.query_cache_misses += len(missing)
+                for (key, _), vector in zip(missing, encoded):
+                    vectors[key] = vector
+                    self.query_cache[key] = vector
+                    self.query_cache.move_to_end(key)
+                while len(self.query_cache) > self.query_cache_size:
+                    self.query_cache.popitem(last=False)
+
+        return np.stack([vectors[key] for key in keys])
+
+    def retrieve_batch(self, queries):
+        query_vectors = self.encode_queries(queries)
+        with self.lock:
+            similarities, ids = self.index.search(query_vectors, self.max_retrieved_documents)
+            return [
+                [
+                    self.documents[int(i)] for i, similarity in zip(row_ids, row_similarities)
+                    if i != -1 and similarity >= self.similarity_threshold
+                ]
+                for row_ids, row_similarities in zip(ids, similarities)
+            ]
+
+    def retrieve(self, query):
+        return self.retrieve_batch([query])[0]
+
+    async def aretrieve(self, query):
+        return await self.query_batcher.submit(query)
+
+    def stats(self):
+        return {
+            'documents': len(self.documents),
+            'query_cache_hits': self.query_cache_hits,
+            'query_cache_misses': self.query_cache_misses,
+            'query_batches': self.query_batcher.stats()
+        }
+
+    def close(self):
+        logger.info(f"RAG stats: {self.stats()}")
+        self.query_batcher.close()
+
+
+class KnowledgeBaseRefresher:
+    def __init__(self, rag, path, update_frequency):
+        self.rag = rag
+        self.path = path
+        self.interval = UPDATE_FREQUENCIES.get(update_frequency, update_frequency)
+        self.last_mtime = knowledge_base_mtime(path)
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+        logger.info(f"Watching knowledge base {self.path} every {self.interval} seconds")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Failed to refresh the knowledge base: {str(e)}")
+
+    async def refresh(self):
+        mtime = knowledge_base_mtime(self.path)
+        if mtime == self.last_mtime:
+            return False
+
+        knowledge_base = await asyncio.to_thread(load_knowledge_base, self.path)
+        upserted, deleted = await asyncio.to_thread(self.rag.sync, knowledge_base)
+        self.last_mtime = mtime
+        logger.info(f"Refreshed knowledge base: {upserted} documents upserted, {deleted} deleted")
+        return True
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
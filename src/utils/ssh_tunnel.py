@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from urllib.parse import urlsplit, urlunsplit
+
+from sshtunnel import SSHTunnelForwarder
+
+logger = logging.getLogger(__name__)
+
+
+def tunneled_url(url, host, port):
+    # Same scheme and path as the configured URL, through the local end of the tunnel
+    parsed = urlsplit(url if '://' in url else f"http://{url}")
+    return urlunsplit((parsed.scheme, f"{host}:{port}", parsed.path, '', ''))
+
+
+class SSHTunnelManager:
+    def __init__(self, endpoints, health_check_interval=15):
+        # endpoints maps a name to the tunnel configuration of log_sources.tunnel
+        self.endpoints = endpoints
+        self.health_check_interval = health_check_interval
+        self.forwarders = {}
+        self.ports = {}
+        self.locks = {name: asyncio.Lock() for name in endpoints}
+        self.health_task = None
+        self.reconnects = 0
+
+    def create_forwarder(self, name):
+        config = self.endpoints[name]
+        # Once a port has been bound it is kept across reconnects, so the clients using the tunnel stay valid
+        local_port = self.ports.get(name, config.get('local_bind_port', 0))
+        return SSHTunnelForwarder(
+            config['url'],
+            ssh_username=config['user'],
+            ssh_password=config['password'],
+            remote_bind_address=(config['remote_bind_url'], config['remote_bind_port']),
+            local_bind_address=(config.get('local_bind_url', '127.0.0.1'), local_port),
+            set_keepalive=config.get('keepalive_seconds', 30)
+        )
+
+    def is_healthy(self, name):
+        forwarder = self.forwarders.get(name)
+        return forwarder is not None and forwarder.is_active
+
+    async def ensure(self, name='default'):
+        # Returns the local (host, port) of a running tunnel, opening or reopening it when needed
+        if name not in self.endpoints:
+            raise ValueError(f"Unknown SSH tunnel: {name}")
+        if not self.is_healthy(name):
+            async with self.locks[name]:
+                if not self.is_healthy(name):
+                    await self.connect(name)
+        if self.health_task is None or self.health_task.done():
+            self.health_task = asyncio.create_task(self.run_health_checks())
+        return self.forwarders[name].local_bind_host, self.forwarders[name].local_bind_port
+
+    async def connect(self, name):
+        previous = self.forwarders.pop(name, None)
+        if previous is not None:
+            self.reconnects += 1
+            logger.warning(f"SSH tunnel {name} is down, reconnecting")
+            await asyncio.to_thread(previous.stop)
+
+        forwarder = self.create_forwarder(name)
+        await asyncio.to_thread(forwarder.start)
+        self.forwarders[name] = forwarder
+        self.ports[name] = forwarder.local_bind_port
+        logger.info(f"SSH tunnel {name} listening on {forwarder.local_bind_host}:{forwarder.local_bind_port}")
+
+    async def check(self, name):
+        forwarder = self.forwarders.get(name)
+        if forwarder is None:
+            return
+        # check_tunnels opens a connection through the forwarded port, so it runs in a thread
+        await asyncio.to_thread(forwarder.check_tunnels)
+        if not forwarder.is_active or not all(forwarder.tunnel_is_up.values()):
+            async with self.locks[name]:
+                if self.forwarders.get(name) is forwarder:
+                    await self.connect(name)
+
+    async def run_health_checks(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            for name in list(self.forwarders):
+                try:
+                    await self.check(name)
+                except Exception as e:
+                    logger.error(f"Health check of SSH tunnel {name} failed: {str(e)}")
+
+    def stats(self):
+        return {
+            'tunnels': {name: self.is_healthy(name) for name in self.endpoints},
+            'reconnects': self.reconnects
+        }
+
+    async def close(self):
+        if self.health_task is not None:
+            self.health_task.cancel()
+            self.health_task = None
+        for name, forwarder in list(self.forwarders.items()):
+            try:
+                await asyncio.to_thread(forwarder.stop)
+            except Exception as e:
+                logger.error(f"Failed to stop SSH tunnel {name}: {str(e)}")
+        self.forwarders.clear()
+        logger.info("SSH tunnels closed")
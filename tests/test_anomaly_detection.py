@@ -0,0 +1,138 @@
+import asyncio
+import json
+
+import pytest
+from unittest.mock import AsyncMock, patch
+
+from src.anomaly_detection import AnomalyDetectionModule, chunk_logs, merge_anomalies
+from src.utils.llm_scheduler import estimate_tokens
+
+
+def entry(n, source_date='2024-03-01'):
+    return {'date': f"{source_date}T{n // 60:02d}:{n % 60:02d}:00Z", 'action': 'search', 'payload': 'x' * 100, 'n': n}
+
+
+def test_chunk_logs_splits_each_source_in_time_order_within_the_budget():
+    logs = {'application_logs': [entry(n) for n in reversed(range(10))], 'auth_logs': [entry(n) for n in range(3)]}
+
+    chunks = chunk_logs(logs, max_chunk_tokens=130)
+
+    assert [(source, [hit['n'] for hit in hits]) for source, hits in chunks] == [
+        ('application_logs', [0, 1, 2]), ('application_logs', [3, 4, 5]), ('application_logs', [6, 7, 8]),
+        ('application_logs', [9]), ('auth_logs', [0, 1, 2])
+    ]
+
+
+def test_merge_anomalies_deduplicates_and_keeps_the_best_confidence():
+    anomalies = [
+        {'description': 'Burst of failed logins for user jdoe', 'supporting_data': ['10:00 failed'],
+         'potential_implications': 'Brute force', 'confidence_score': 0.7, 'recommended_actions': ['Lock account'],
+         'patterns': ['brute force']},
+        {'description': 'Burst of failed logins for user jdoe from Nice', 'supporting_data': ['10:01 failed'],
+         'potential_implications': 'Brute force', 'confidence_score': 0.6, 'recommended_actions': ['Lock account'],
+         'patterns': ['credential stuffing']},
+        {'description': 'Export of the full customer list', 'supporting_data': 'export 12:00',
+         'potential_implications': 'Data leak', 'confidence_score': 0.9, 'recommended_actions': [],
+         'patterns': []}
+    ]
+
+    merged = merge_anomalies(anomalies)
+
+    assert [anomaly['confidence_score'] for anomaly in merged] == [0.9, 0.7]
+    assert merged[1]['supporting_data'] == ['10:00 failed', '10:01 failed']
+    assert merged[1]['recommended_actions'] == ['Lock account']
+    assert merged[1]['patterns'] == ['brute force', 'credential stuffing']
+    assert merged[0]['supporting_data'] == ['export 12:00']
+
+
+def test_merge_anomalies_keeps_findings_about_different_entities_apart():
+    def anomaly(description):
+        return {'description': description, 'supporting_data': [], 'confidence_score': 0.5,
+                'recommended_actions': [], 'patterns': []}
+
+    merged = merge_anomalies([
+        anomaly('Burst of failed logins for user jdoe'), anomaly('Burst of failed logins for user asmith'),
+        anomaly('Burst of failed logins from 10.0.0.1'), anomaly('Burst of failed logins from 10.0.0.2')
+    ] + [anomaly('Burst of failed logins for user jdoe')] * 10)
+
+    assert sorted(anomaly['description'] for anomaly in merged) == [
+        'Burst of failed logins for user asmith', 'Burst of failed logins for user jdoe',
+        'Burst of failed logins from 10.0.0.1', 'Burst of failed logins from 10.0.0.2'
+    ]
+    # Reported by eleven chunks, the finding is not more certain than each report
+    assert all(anomaly['confidence_score'] == 0.5 for anomaly in merged)
+
+
+def test_merge_anomalies_ignores_counts_times_and_unnamed_entities():
+    def anomaly(description, confidence_score=0.5):
+        return {'description': description, 'supporting_data': [], 'confidence_score': confidence_score,
+                'recommended_actions': [], 'patterns': []}
+
+    merged = merge_anomalies([
+        anomaly('12 failed logins for user jdoe between 10:00 and 10:05', 0.9),
+        anomaly('9 failed logins for user jdoe between 14:00 and 14:03'),
+        anomaly('Unusual activity from user jdoe', 0.8),
+        anomaly('Unusual activity from the jdoe user'),
+        anomaly('Unusual activity from user asmith')
+    ])
+
+    assert [anomaly['description'] for anomaly in merged] == [
+        '12 failed logins for user jdoe between 10:00 and 10:05', 'Unusual activity from user jdoe',
+        'Unusual activity from user asmith'
+    ]
+
+
+@pytest.mark.asyncio
+async def test_chunked_detection_analyses_chunks_concurrently_and_reduces():
+    config = {'threshold': 0.8, 'statistics': {'enabled': False},
+              'chunking': {'enabled': True, 'max_chunk_tokens': 1000, 'max_concurrent_chunks': 2}}
+    module = AnomalyDetectionModule(config, {'context': ''}, None)
+    logs = {'application_logs': [entry(n) for n in range(40)]}
+    running, peak, prompts = 0, 0, []
+
+    async def get_llm_response(prompt, *args, **kwargs):
+        nonlocal running, peak
+        prompts.append(prompt)
+        index = len(prompts)
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return json.dumps([{'description': 'Automated search activity on the account', 'supporting_data': [index],
+                            'potential_implications': 'Scraping', 'confidence_score': 0.85 if index == 2 else 0.5,
+                            'recommended_actions': ['Rate limit'], 'patterns': ['automation']}])
+
+    with patch('src.anomaly_detection.get_llm_response', side_effect=get_llm_response):
+        anomalies = await module.detect(logs, {'incident_id': 'INC-1', 'analysis': {}})
+
+    # The budget covers the whole prompt, not only the log entries
+    assert len(prompts) > 1
+    assert all(estimate_tokens(prompt, 0) <= 1000 for prompt in prompts)
+    assert peak == 2
+    assert not any('[truncated]' in prompt for prompt in prompts)
+    # One finding reported by every chunk, with the confidence of its best report
+    assert len(anomalies) == 1
+    assert anomalies[0]['confidence_score'] == 0.85
+    assert len(anomalies[0]['supporting_data']) == len(prompts)
+
+
+@pytest.mark.asyncio
+async def test_chunked_detection_retries_each_chunk_but_not_the_whole_map():
+    config = {'threshold': 0.8, 'statistics': {'enabled': False},
+              'chunking': {'enabled': True, 'max_chunk_tokens': 1000, 'retry_attempts': 2}}
+    module = AnomalyDetectionModule(config, {'context': ''}, None)
+    logs = {'application_logs': [entry(n) for n in range(40)]}
+    calls = []
+
+    async def get_llm_response(prompt, *args, **kwargs):
+        calls.append(prompt)
+        raise RuntimeError('provider down')
+
+    with patch('src.anomaly_detection.get_llm_response', side_effect=get_llm_response), \
+            patch('src.utils.error_handling.asyncio.sleep', new=AsyncMock()):
+        with pytest.raises(RuntimeError):
+            await module.detect(logs, {'incident_id': 'INC-1', 'analysis': {}})
+
+    chunks = len(set(calls))
+    assert chunks > 1
+    assert len(calls) == 2 * chunks
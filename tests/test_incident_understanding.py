@@ -0,0 +1,56 @@
+import json
+
+import pytest
+from unittest.mock import AsyncMock, patch
+
+from src.incident_understanding import IncidentUnderstandingModule
+
+INCIDENTS = [
+    {'id': 'INC-001', 'timestamp': '2024-03-04T21:34', 'description': 'Unusual login activity'},
+    {'id': 'INC-002', 'timestamp': '2024-03-04T22:10', 'description': 'Refund to unknown account'}
+]
+
+
+@pytest.mark.asyncio
+async def test_process_batch_sends_one_prompt_for_several_incidents():
+    module = IncidentUnderstandingModule({'context': ''}, None, {'max_incidents_per_prompt': 5})
+    response = json.dumps({'INC-001': {'summary': 'login'}, 'INC-002': {'summary': 'refund'}})
+
+    with patch('src.incident_understanding.get_llm_response', AsyncMock(return_value=response)) as mock:
+        understandings = await module.process_batch(INCIDENTS)
+
+    mock.assert_awaited_once()
+    assert understandings['INC-002']['incident_id'] == 'INC-002'
+    assert understandings['INC-002']['analysis'] == {'summary': 'refund'}
+    assert understandings['INC-002']['retrieval_query'] == 'Refund to unknown account'
+
+
+@pytest.mark.asyncio
+async def test_process_batch_falls_back_to_single_prompts():
+    module = IncidentUnderstandingModule({'context': ''}, None)
+    responses = [json.dumps({'INC-001': {'summary': 'login'}}), json.dumps({'summary': 'refund'})]
+
+    with patch('src.incident_understanding.get_llm_response', AsyncMock(side_effect=responses)) as mock:
+        understandings = await module.process_batch(INCIDENTS)
+
+    assert mock.await_count == 2
+    assert understandings['INC-001']['analysis'] == {'summary': 'login'}
+    assert understandings['INC-002']['analysis'] == {'summary': 'refund'}
+
+
+@pytest.mark.asyncio
+async def test_process_batch_keeps_other_understandings_when_one_incident_fails():
+    module = IncidentUnderstandingModule({'context': ''}, None, {'max_incidents_per_prompt': 2})
+    incidents = INCIDENTS + [{'id': 'INC-003', 'timestamp': '2024-03-04T23:00', 'description': 'Card testing'}]
+    response = json.dumps({'INC-001': {'summary': 'login'}, 'INC-002': {'summary': 'refund'}})
+
+    async def get_llm_response(prompt, *args, **kwargs):
+        if 'INC-003' in prompt:
+            raise RuntimeError('provider down')
+        return response
+
+    with patch('src.incident_understanding.get_llm_response', side_effect=get_llm_response), \
+            patch('src.utils.error_handling.asyncio.sleep', AsyncMock()):
+        understandings = await module.process_batch(incidents)
+
+    assert set(understandings) == {'INC-001', 'INC-002'}
@@ -0,0 +1,347 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from unittest.mock import AsyncMock, patch
+
+from src.utils import llm_utils
+from src.utils.llm_batching import MicroBatcher
+from src.utils.llm_cache import LLMResponseCache, build_cache_key
+from src.utils.llm_clients import client_registry
+from src.utils.json_stream import JSONArrayStreamParser, iter_json_array
+from src.utils.llm_hedging import HedgedDispatcher
+from src.utils.llm_scheduler import PRIORITY_HIGH, PRIORITY_LOW, LLMScheduler
+
+
+def test_response_cache_memory_and_disk_tiers(tmp_path):
+    db_path = str(tmp_path / 'cache.sqlite')
+    cache = LLMResponseCache(max_entries=1, ttl_seconds=60, db_path=db_path)
+    cache.set('a', '[1]')
+    cache.set('b', '[2]')
+
+    assert cache.get('b') == '[2]'
+    assert cache.get('a') == '[1]'
+    assert cache.get('c') is None
+    stats = cache.stats()
+    assert stats['memory_hits'] == 1
+    assert stats['disk_hits'] == 1
+    assert stats['misses'] == 1
+    cache.close()
+
+    reopened = LLMResponseCache(db_path=db_path)
+    assert reopened.get('b') == '[2]'
+    reopened.close()
+
+
+def test_response_cache_expires_entries():
+    cache = LLMResponseCache(ttl_seconds=-1)
+    cache.set('a', '[1]')
+    assert cache.get('a') is None
+    assert cache.stats()['expirations'] == 1
+
+
+def test_cache_key_depends_on_sampling_parameters():
+    assert build_cache_key('p', 'generic', 'm', 0.7, 100) != build_cache_key('p', 'generic', 'm', 0.2, 100)
+
+
+@pytest.mark.asyncio
+async def test_get_llm_response_uses_cache():
+    config = {
+        'provider': 'generic',
+        'models': {'default': {'name': 'model', 'max_tokens': 10, 'temperature': 0.0}},
+        'cache': {'enabled': True}
+    }
+    with patch.object(llm_utils, 'get_generic_post_response', AsyncMock(return_value='{"ok": true}')) as mock:
+        first = await llm_utils.get_llm_response('prompt', config)
+        second = await llm_utils.get_llm_response('prompt', config)
+    llm_utils.close_response_cache()
+
+    assert first == second == '{"ok": true}'
+    mock.assert_awaited_once()
+
+
+async def _serve_generic_provider(status, body):
+    async def handler(request):
+        return web.json_response(body, status=status)
+
+    app = web.Application()
+    app.router.add_post('/v1/chat', handler)
+    server = TestServer(app)
+    await server.start_server()
+    return server
+
+
+@pytest.mark.asyncio
+async def test_generic_provider_uses_shared_session():
+    server = await _serve_generic_provider(200, {'choices': [{'message': {'content': '[]'}}]})
+    config = {
+        'url': str(server.make_url('/v1/chat')),
+        'token': 'token',
+        'models': {'default': {'name': 'model', 'max_tokens': 10, 'temperature': 0.0}}
+    }
+    try:
+        assert await llm_utils.get_generic_post_response('prompt', config) == '[]'
+        session = client_registry.get_http_session(config)
+        assert await llm_utils.get_generic_post_response('prompt', config) == '[]'
+        assert client_registry.get_http_session(config) is session
+    finally:
+        await client_registry.shutdown()
+        await server.close()
+
+
+@pytest.mark.asyncio
+async def test_generic_provider_raises_on_error_status():
+    server = await _serve_generic_provider(429, {'error': 'rate limited'})
+    config = {
+        'url': str(server.make_url('/v1/chat')),
+        'token': 'token',
+        'models': {'default': {'name': 'model', 'max_tokens': 10, 'temperature': 0.0}}
+    }
+    try:
+        with pytest.raises(llm_utils.LLMRequestError) as error:
+            await llm_utils.get_generic_post_response('prompt', config)
+        assert error.value.status == 429
+    finally:
+        await client_registry.shutdown()
+        await server.close()
+
+
+@pytest.mark.asyncio
+async def test_registry_loads_huggingface_pipeline_once():
+    config = {'model': {'name': 'local-model'}}
+    with patch('src.utils.llm_clients.pipeline', return_value=object()) as mock:
+        generators = await asyncio.gather(*[client_registry.get_huggingface_pipeline(config) for _ in range(3)])
+        assert await client_registry.get_huggingface_pipeline(config) is generators[0]
+    await client_registry.shutdown()
+
+    assert all(generator is generators[0] for generator in generators)
+    mock.assert_called_once_with('text-generation', model='local-model')
+
+
+def test_json_array_stream_parser_emits_elements_as_they_close():
+    text = 'Here you go:\n```json\n[{"a": "x]\\"y", "b": [1, {"c": 2}]}, "s,t", 3, {"d": null}]\n```'
+    parser = JSONArrayStreamParser()
+    elements = []
+    for i in range(0, len(text), 4):
+        elements.extend(parser.feed(text[i:i + 4]))
+
+    assert elements == [{"a": 'x]"y', "b": [1, {"c": 2}]}, "s,t", 3, {"d": None}]
+
+
+def test_json_array_stream_parser_emits_first_object_before_array_ends():
+    parser = JSONArrayStreamParser()
+    assert parser.feed('[{"id": 1}, {"id"') == [{"id": 1}]
+    assert parser.feed(': 2}]') == [{"id": 2}]
+
+
+@pytest.mark.asyncio
+async def test_stream_llm_response_parses_generic_server_sent_events():
+    async def handler(request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for token in ['[{"a"', ': 1},', ' {"a": 2}]']:
+            chunk = {'choices': [{'delta': {'content': token}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    app = web.Application()
+    app.router.add_post('/v1/chat', handler)
+    server = TestServer(app)
+    await server.start_server()
+    config = {
+        'provider': 'generic',
+        'url': str(server.make_url('/v1/chat')),
+        'token': 'token',
+        'models': {'default': {'name': 'model', 'max_tokens': 10, 'temperature': 0.0}}
+    }
+    try:
+        elements = [element async for element in iter_json_array(llm_utils.stream_llm_response('prompt', config))]
+    finally:
+        await client_registry.shutdown()
+        await server.close()
+
+    assert elements == [{'a': 1}, {'a': 2}]
+
+
+@pytest.mark.asyncio
+async def test_scheduler_grants_slots_by_priority_within_concurrency_cap():
+    scheduler = LLMScheduler({'max_concurrency': 1})
+    order = []
+    release = asyncio.Event()
+
+    async def request(name):
+        order.append(name)
+        if name == 'first':
+            await release.wait()
+        return name
+
+    first = asyncio.create_task(scheduler.run('generic', 'model', PRIORITY_LOW, 10, lambda: request('first')))
+    await asyncio.sleep(0)
+    low = asyncio.create_task(scheduler.run('generic', 'model', PRIORITY_LOW, 10, lambda: request('low')))
+    high = asyncio.create_task(scheduler.run('generic', 'model', PRIORITY_HIGH, 10, lambda: request('high')))
+    await asyncio.sleep(0)
+    assert scheduler.stats()['generic:model']['queue_depth'] == 2
+
+    release.set()
+    await asyncio.gather(first, low, high)
+    assert order == ['first', 'high', 'low']
+    assert scheduler.stats()['generic:model']['completed'] == 3
+
+
+@pytest.mark.asyncio
+async def test_scheduler_waits_for_token_budget():
+    scheduler = LLMScheduler({'tokens_per_minute': 600})
+    await scheduler.run('generic', 'model', PRIORITY_HIGH, 600, AsyncMock(return_value='a'))
+
+    second = asyncio.create_task(scheduler.run('generic', 'model', PRIORITY_HIGH, 5, AsyncMock(return_value='b')))
+    assert await second == 'b'
+    assert scheduler.stats()['generic:model']['max_wait_seconds'] >= 0.4
+    scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_scheduler_empties_the_budget_on_sdk_rate_limit_errors():
+    class RateLimitError(Exception):
+        # Shaped like openai.APIStatusError and anthropic.APIStatusError
+        status_code = 429
+
+    scheduler = LLMScheduler({'tokens_per_minute': 600})
+    with pytest.raises(RateLimitError):
+        await scheduler.run('openai', 'model', PRIORITY_HIGH, 5, AsyncMock(side_effect=RateLimitError()))
+
+    assert scheduler.lanes['openai:model'].tokens == 0.0
+    scheduler.close()
+
+
+@pytest.mark.asyncio
+async def test_get_llm_response_coalesces_identical_in_flight_prompts():
+    config = {
+        'provider': 'generic',
+        'models': {'default': {'name': 'model', 'max_tokens': 10, 'temperature': 0.0}}
+    }
+    release = asyncio.Event()
+
+    async def slow_response(prompt, config):
+        await release.wait()
+        return '[]'
+
+    coalesced_before = llm_utils.llm_request_flight.coalesced
+    with patch.object(llm_utils, 'get_generic_post_response', AsyncMock(side_effect=slow_response)) as mock:
+        tasks = [asyncio.create_task(llm_utils.get_llm_response('prompt', config)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*tasks)
+
+    assert results == ['[]', '[]', '[]']
+    mock.assert_awaited_once()
+    assert llm_utils.llm_request_flight.coalesced - coalesced_before == 2
+    assert llm_utils.llm_request_flight.stats()['in_flight'] == 0
+
+
+@pytest.mark.asyncio
+async def test_hedged_dispatcher_cancels_slow_primary():
+    dispatcher = HedgedDispatcher({'secondary_providers': ['anthropic'], 'initial_hedge_delay': 0.01})
+    cancelled = []
+
+    async def request(provider, started):
+        started()
+        if provider == 'generic':
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(provider)
+                raise
+        return f'{provider} answer'
+
+    assert await dispatcher.dispatch('generic', request) == 'anthropic answer'
+    await asyncio.sleep(0)
+    assert cancelled == ['generic']
+    assert dispatcher.stats()['hedge_wins'] == 1
+
+
+@pytest.mark.asyncio
+async def test_hedged_dispatcher_routes_around_degraded_provider():
+    dispatcher = HedgedDispatcher({'secondary_providers': ['anthropic'], 'degraded_after': 1})
+    calls = []
+
+    async def request(provider, started):
+        started()
+        calls.append(provider)
+        if provider == 'generic':
+            raise RuntimeError('provider down')
+        return 'answer'
+
+    assert await dispatcher.dispatch('generic', request) == 'answer'
+    assert dispatcher.is_degraded('generic')
+    assert await dispatcher.dispatch('generic', request) == 'answer'
+    assert calls == ['generic', 'anthropic', 'anthropic']
+
+
+@pytest.mark.asyncio
+async def test_hedged_dispatcher_ignores_time_spent_in_the_local_queue():
+    dispatcher = HedgedDispatcher({'secondary_providers': ['anthropic'], 'initial_hedge_delay': 0.05})
+
+    async def request(provider, started):
+        await asyncio.sleep(0.1)  # Waiting for a scheduler slot
+        started()
+        await asyncio.sleep(0.01)
+        return f'{provider} answer'
+
+    assert await dispatcher.dispatch('generic', request) == 'generic answer'
+    assert dispatcher.stats()['hedged'] == 0
+    assert dispatcher.latencies.samples['generic'][0] < 0.05
+
+
+@pytest.mark.asyncio
+async def test_get_llm_response_caches_under_the_provider_that_answered():
+    config = {
+        'provider': 'generic',
+        'models': {'default': {'name': 'model', 'max_tokens': 10, 'temperature': 0.0}},
+        'alternative_providers': {'anthropic': {'model': 'claude', 'temperature': 0.0, 'max_tokens': 10}},
+        'cache': {'enabled': True}
+    }
+    with patch.object(llm_utils, 'schedule_llm_request', AsyncMock(return_value=('anthropic', '[1]'))):
+        assert await llm_utils.get_llm_response('hedged prompt', config) == '[1]'
+    cache = llm_utils.get_response_cache(config)
+    prompt = await llm_utils.build_augmented_prompt('hedged prompt')
+    generic_key = build_cache_key(prompt, 'generic', *llm_utils.get_model_settings('generic', config))
+    anthropic_key = build_cache_key(prompt, 'anthropic', *llm_utils.get_model_settings('anthropic', config))
+    assert cache.get(generic_key) is None
+    assert cache.get(anthropic_key) == '[1]'
+    llm_utils.close_response_cache()
+
+
+@pytest.mark.asyncio
+async def test_micro_batcher_groups_concurrent_prompts():
+    batch_sizes = []
+
+    def generate_batch(prompts):
+        batch_sizes.append(len(prompts))
+        return [prompt.upper() for prompt in prompts]
+
+    batcher = MicroBatcher('test', generate_batch, max_batch_size=4, max_wait_ms=50)
+    results = await asyncio.gather(*[batcher.submit(f'prompt {i}') for i in range(6)])
+    batcher.close()
+
+    assert results == [f'PROMPT {i}' for i in range(6)]
+    assert batch_sizes == [4, 2]
+    assert batcher.stats()['batches'] == 2
+
+
+@pytest.mark.asyncio
+async def test_augmented_prompt_retrieves_with_query_and_skips_seen_documents():
+    rag = AsyncMock()
+    rag.aretrieve.return_value = [{'id': 'kb-1', 'content': 'refund fraud'}, {'id': 'kb-2', 'content': 'gift cards'}]
+    query = llm_utils.build_retrieval_query('Refund to unknown account', {'hypotheses': ['insider', 'phishing']})
+    assert query == 'Refund to unknown account\ninsider\nphishing'
+
+    seen_documents = {'kb-1'}
+    prompt = await llm_utils.build_augmented_prompt('long instructions', rag, query, seen_documents)
+
+    rag.aretrieve.assert_awaited_once_with(query)
+    assert 'refund fraud' not in prompt
+    assert '- gift cards' in prompt
+    assert seen_documents == {'kb-1', 'kb-2'}
@@ -0,0 +1,385 @@
+import asyncio
+
+import pytest
+from unittest.mock import patch
+
+from src.anomaly_detection import preprocess_logs
+from src.log_retrieval import LogRetrievalEngine, build_elasticsearch_query, summarize_aggregation, time_shards
+from src.utils.log_cache import DayPartitionedLogCache
+from src.utils.ssh_tunnel import SSHTunnelManager, tunneled_url
+
+API_CALL = {
+    'target_log_source': 'application_logs',
+    'officeId': 'NCE1A0950',
+    'userId': 'jdoe',
+    'date_from': '2024-03-01',
+    'date_to': '2024-03-05'
+}
+
+
+class FakeElasticsearch:
+    in_flight = 0
+    max_in_flight = 0
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.searches = []
+        self.closed_pits = []
+        self.aggregations = []
+
+    async def open_point_in_time(self, index, keep_alive):
+        return {'id': 'pit-0'}
+
+    async def search(self, query, size, track_total_hits, pit=None, sort=None, search_after=None, aggs=None,
+                     **kwargs):
+        FakeElasticsearch.in_flight += 1
+        FakeElasticsearch.max_in_flight = max(FakeElasticsearch.max_in_flight, FakeElasticsearch.in_flight)
+        await asyncio.sleep(0)
+        FakeElasticsearch.in_flight -= 1
+
+        if aggs is not None:
+            self.aggregations.append(aggs)
+            return {
+                'hits': {'total': {'value': len(self.documents)}, 'hits': []},
+                'aggregations': {'per_user': {'buckets': [{'key': 'jdoe', 'doc_count': len(self.documents)}]}}
+            }
+
+        self.searches.append({'pit': pit['id'], 'search_after': search_after, 'size': size, **kwargs})
+        start = 0 if search_after is None else search_after[0] + 1
+        hits = [{'_source': doc, 'sort': [i]} for i, doc in enumerate(self.documents) if i >= start][:size]
+        return {'pit_id': f"pit-{len(self.searches)}", 'hits': {'hits': hits}}
+
+    async def close_point_in_time(self, id):
+        self.closed_pits.append(id)
+
+
+def make_engine(documents, **source_config):
+    engine = LogRetrievalEngine({
+        'names_list': ['application_logs'],
+        'sources': [{'name': 'application_logs', 'type': 'elasticsearch', 'index': 'logs', **source_config}]
+    })
+    es = FakeElasticsearch(documents)
+    engine.es_clients.clients['application_logs'] = es
+    return engine, es
+
+
+@pytest.mark.asyncio
+async def test_retrieve_pages_through_every_hit_with_point_in_time():
+    engine, es = make_engine([{'n': i} for i in range(2500)], page_size=1000, max_hits=10000)
+
+    logs = await engine.retrieve([API_CALL])
+
+    assert len(logs['application_logs']) == 2500
+    assert [search['search_after'] for search in es.searches] == [None, [999], [1999]]
+    assert es.searches[1]['pit'] == 'pit-1'
+    assert es.closed_pits == ['pit-3']
+
+
+@pytest.mark.asyncio
+async def test_stream_yields_pages_and_stops_at_max_hits():
+    engine, es = make_engine([{'n': i} for i in range(50)], page_size=20, max_hits=45)
+
+    pages = [page async for source, page in engine.stream([API_CALL])]
+
+    assert [len(page) for page in pages] == [20, 20, 5]
+    assert es.closed_pits == ['pit-3']
+
+
+@pytest.mark.asyncio
+async def test_stream_accepts_api_calls_streamed_from_the_llm():
+    engine, es = make_engine([{'n': i} for i in range(30)], page_size=20, max_hits=100)
+
+    async def api_calls():
+        yield API_CALL
+        await asyncio.sleep(0)
+        yield {**API_CALL, 'userId': 'asmith'}
+
+    pages = [page async for source, page in engine.stream(api_calls())]
+
+    assert sorted(len(page) for page in pages) == [10, 10, 20, 20]
+
+
+@pytest.mark.asyncio
+async def test_retrieve_projects_fields_and_returns_aggregation_summaries():
+    fields = {'includes': ['date', 'user.userId'], 'excludes': ['payload']}
+    aggregations = {'per_user': {'terms': {'field': 'user.userId', 'size': 10}}}
+    engine, es = make_engine([{'n': i} for i in range(3)], fields=fields, aggregations=aggregations)
+
+    logs = await engine.retrieve([API_CALL])
+
+    assert es.searches[0]['source'] == fields
+    assert es.aggregations == [aggregations]
+    assert logs.summaries['application_logs'] == {'total_hits': 3, 'aggregations': {'per_user': {'jdoe': 3}}}
+    assert preprocess_logs(logs).startswith('[application_logs summary] {"total_hits": 3')
+
+
+@pytest.mark.asyncio
+async def test_retrieve_keeps_the_hits_when_the_aggregations_fail():
+    engine, es = make_engine([{'n': i} for i in range(3)], aggregations={'per_user': {'terms': {'field': 'user'}}})
+    search = es.search
+
+    async def search_without_aggregations(**kwargs):
+        if kwargs.get('aggs') is not None:
+            raise RuntimeError('too many buckets')
+        return await search(**kwargs)
+
+    es.search = search_without_aggregations
+    logs = await engine.retrieve([API_CALL])
+
+    assert len(logs['application_logs']) == 3
+    assert logs.summaries == {}
+
+
+def test_summarize_aggregation_handles_histograms_and_sub_aggregations():
+    result = {'buckets': [
+        {'key': 1709251200000, 'key_as_string': '2024-03-01', 'doc_count': 4,
+         'ips': {'value': 2}},
+        {'key': 1709337600000, 'key_as_string': '2024-03-02', 'doc_count': 0, 'ips': {'value': 0}}
+    ]}
+
+    assert summarize_aggregation(result) == {
+        '2024-03-01': {'count': 4, 'ips': 2},
+        '2024-03-02': {'count': 0, 'ips': 0}
+    }
+
+
+def test_query_planner_uses_terms_for_exact_values_and_filter_context():
+    query = build_elasticsearch_query({**API_CALL, 'userId': '*'})
+    assert query == {'bool': {'filter': [
+        {'term': {'officeId': 'NCE1A0950'}},
+        {'range': {'date': {'gte': '2024-03-01', 'lt': '2024-03-05'}}}
+    ]}}
+
+    query = build_elasticsearch_query({**API_CALL, 'officeId': ['NCE1A0950', 'PAR1A0100'], 'userId': 'jd*'},
+                                      {'officeId': 'officeId.keyword'})
+    assert query['bool']['filter'][:2] == [
+        {'terms': {'officeId.keyword': ['NCE1A0950', 'PAR1A0100']}},
+        {'wildcard': {'user.userId': {'value': 'jd*'}}}
+    ]
+
+
+class FakeForwarder:
+    started = []
+
+    def __init__(self, url, ssh_username, ssh_password, remote_bind_address, local_bind_address, set_keepalive):
+        self.local_bind_host, self.local_bind_port = local_bind_address
+        self.is_active = False
+        self.tunnel_is_up = {}
+
+    def start(self):
+        if self.local_bind_port == 0:
+            self.local_bind_port = 40000 + len(FakeForwarder.started)
+        self.is_active = True
+        FakeForwarder.started.append(self)
+
+    def check_tunnels(self):
+        self.tunnel_is_up = {('127.0.0.1', self.local_bind_port): self.is_active}
+
+    def stop(self):
+        self.is_active = False
+
+
+@pytest.mark.asyncio
+async def test_tunnel_manager_shares_one_tunnel_and_reconnects_on_the_same_port():
+    FakeForwarder.started = []
+    endpoint = {'url': 'bastion', 'user': 'u', 'password': 'p', 'remote_bind_url': 'es', 'remote_bind_port': 9200,
+                'local_bind_url': '127.0.0.1', 'local_bind_port': 0}
+    with patch('src.utils.ssh_tunnel.SSHTunnelForwarder', FakeForwarder):
+        manager = SSHTunnelManager({'default': endpoint}, health_check_interval=3600)
+        addresses = await asyncio.gather(*[manager.ensure() for _ in range(5)])
+        assert len(FakeForwarder.started) == 1
+        assert set(addresses) == {('127.0.0.1', 40000)}
+
+        FakeForwarder.started[0].is_active = False
+        await manager.check('default')
+        assert len(FakeForwarder.started) == 2
+        assert await manager.ensure() == ('127.0.0.1', 40000)
+        assert manager.stats() == {'tunnels': {'default': True}, 'reconnects': 1}
+        await manager.close()
+
+    assert tunneled_url('https://es.internal:9243/logs', '127.0.0.1', 40000) == 'https://127.0.0.1:40000/logs'
+
+
+@pytest.mark.asyncio
+async def test_each_source_uses_its_own_client_under_a_global_limit():
+    engine = LogRetrievalEngine({
+        'names_list': ['application_logs', 'access_logs'],
+        'max_concurrent_requests': 1,
+        'sources': [
+            {'name': 'application_logs', 'type': 'elasticsearch', 'index': 'app'},
+            {'name': 'access_logs', 'type': 'elasticsearch', 'index': 'access'}
+        ]
+    })
+    FakeElasticsearch.max_in_flight = 0
+    app, access = FakeElasticsearch([{'app': 1}]), FakeElasticsearch([{'access': 1}, {'access': 2}])
+    engine.es_clients.clients.update({'application_logs': app, 'access_logs': access})
+
+    logs = await engine.retrieve([API_CALL, {**API_CALL, 'target_log_source': 'access_logs'}])
+
+    assert logs == {'application_logs': [{'app': 1}], 'access_logs': [{'access': 1}, {'access': 2}]}
+    assert FakeElasticsearch.max_in_flight == 1
+
+
+@pytest.mark.asyncio
+async def test_log_cache_only_queries_the_missing_days():
+    documents = [{'date': f"2024-03-0{day}T10:00:00Z", 'day': day} for day in range(1, 8)]
+    engine, es = make_engine(documents)
+    engine.log_cache = DayPartitionedLogCache()
+    fetched = []
+
+    async def fetch(api_call):
+        fetched.append((api_call['date_from'], api_call['date_to']))
+        return [doc for doc in documents if api_call['date_from'] <= doc['date'][:10] < api_call['date_to']]
+
+    first = await engine.get_cached_logs(API_CALL, fetch)
+    second = await engine.get_cached_logs({**API_CALL, 'date_from': '2024-03-03', 'date_to': '2024-03-07'}, fetch)
+
+    assert [doc['day'] for doc in first] == [1, 2, 3, 4]
+    assert [doc['day'] for doc in second] == [3, 4, 5, 6]
+    assert fetched == [('2024-03-01', '2024-03-05'), ('2024-03-05', '2024-03-07')]
+    assert engine.log_cache.stats()['hits'] == 2
+
+
+def test_log_cache_evicts_oldest_days_beyond_its_size():
+    cache = DayPartitionedLogCache(max_size_mb=1)
+    payload = [{'message': 'x' * 400000}]
+    cache.put_days(('app', 'NCE', 'jdoe'), {'2024-03-01': payload, '2024-03-02': payload, '2024-03-03': payload})
+
+    assert cache.get_days(('app', 'NCE', 'jdoe'), ['2024-03-01', '2024-03-02', '2024-03-03']).keys() == \
+        {'2024-03-02', '2024-03-03'}
+    assert cache.stats()['evictions'] == 1
+
+
+def test_time_shards_split_wide_ranges():
+    assert time_shards('2024-03-01', '2024-03-04') == [('2024-03-01', '2024-03-04')]
+    assert time_shards('2024-03-01', '2024-03-04', shard_hours=24) == [
+        ('2024-03-01', '2024-03-02'), ('2024-03-02', '2024-03-03'), ('2024-03-03', '2024-03-04')
+    ]
+    assert time_shards('2024-03-01', '2024-03-02', shard_hours=12) == [
+        ('2024-03-01T00:00:00', '2024-03-01T12:00:00'), ('2024-03-01T12:00:00', '2024-03-02T00:00:00')
+    ]
+    assert time_shards('last week', '2024-03-02', shard_hours=24) == [('last week', '2024-03-02')]
+
+
+@pytest.mark.asyncio
+async def test_sharded_fetch_retries_failed_shards_and_merges_in_time_order():
+    engine, es = make_engine([], shard_hours=24, max_parallel_shards=2, retry_delay=0)
+    attempts = []
+
+    async def fetch(api_call):
+        attempts.append(api_call['date_from'])
+        if api_call['date_from'] == '2024-03-02' and attempts.count('2024-03-02') == 1:
+            raise TimeoutError('shard timed out')
+        day = api_call['date_from']
+        return [{'date': f"{day}T18:00:00Z"}, {'date': f"{day}T06:00:00Z"}]
+
+    hits = await engine.fetch_sharded_logs(API_CALL, fetch)
+
+    assert [hit['date'] for hit in hits][:4] == [
+        '2024-03-01T06:00:00Z', '2024-03-01T18:00:00Z', '2024-03-02T06:00:00Z', '2024-03-02T18:00:00Z'
+    ]
+    assert len(hits) == 8
+    assert sorted(attempts) == ['2024-03-01', '2024-03-02', '2024-03-02', '2024-03-03', '2024-03-04']
+
+
+@pytest.mark.asyncio
+async def test_timed_out_page_searches_are_retried_only_per_shard():
+    engine, es = make_engine([{'n': 1}], retry_attempts=2, retry_delay=0)
+    calls = []
+
+    async def search(**kwargs):
+        calls.append(kwargs)
+        raise TimeoutError('search timed out')
+
+    es.search = search
+    logs = await engine.retrieve([API_CALL])
+
+    assert logs == {}
+    assert len(calls) == 2
+
+
+def make_file_engine(path, **source_config):
+    return LogRetrievalEngine({
+        'names_list': ['application_logs'],
+        'sources': [{'name': 'application_logs', 'type': 'file', 'path': str(path), **source_config}]
+    })
+
+
+@pytest.mark.asyncio
+async def test_file_source_filters_partitioned_parquet_files(tmp_path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    for day in ('2024-02-29', '2024-03-01', '2024-03-02', '2024-03-05'):
+        partition = tmp_path / f"date={day}"
+        partition.mkdir()
+        rows = [
+            {'officeId': office, 'user': {'userId': user}, 'date': f"{day}T{hour:02d}:00:00Z", 'message': 'login'}
+            for hour, (office, user) in enumerate([('NCE1A0950', 'jdoe'), ('NCE1A0950', 'asmith'),
+                                                   ('PAR1A0100', 'jdoe'), ('NCE1A0950', 'jdoe')])
+        ]
+        pq.write_table(pa.Table.from_pylist(rows), partition / 'logs.parquet', row_group_size=2)
+
+    engine = make_file_engine(tmp_path)
+    logs = await engine.retrieve([API_CALL])
+
+    hits = logs['application_logs']
+    assert [hit['date'] for hit in hits] == ['2024-03-01T00:00:00Z', '2024-03-01T03:00:00Z',
+                                             '2024-03-02T00:00:00Z', '2024-03-02T03:00:00Z']
+    assert all(hit['officeId'] == 'NCE1A0950' and hit['user']['userId'] == 'jdoe' for hit in hits)
+
+    logs = await engine.retrieve([{**API_CALL, 'officeId': 'NCE*', 'userId': '*'}])
+    assert len(logs['application_logs']) == 6
+
+
+@pytest.mark.asyncio
+async def test_file_source_reads_ndjson_with_timestamps_and_max_hits(tmp_path):
+    import json
+
+    lines = [
+        {'officeId': 'NCE1A0950', 'user': {'userId': 'jdoe'}, 'date': f"2024-03-0{day}T10:00:00Z", 'n': day}
+        for day in range(1, 7)
+    ] + [{'officeId': 'PAR1A0100', 'user': {'userId': 'jdoe'}, 'date': '2024-03-02T10:00:00Z', 'n': 0}]
+    (tmp_path / 'app.ndjson').write_text('\n'.join(json.dumps(line) for line in reversed(lines)) + '\n')
+
+    engine = make_file_engine(tmp_path)
+    logs = await engine.retrieve([API_CALL])
+    assert [hit['n'] for hit in logs['application_logs']] == [1, 2, 3, 4]
+
+    engine = make_file_engine(tmp_path, max_hits=2)
+    pages = [page async for source, page in engine.stream([{**API_CALL, 'officeId': ['NCE1A0950', 'PAR1A0100']}])]
+    assert [len(page) for page in pages] == [2]
+
+
+@pytest.mark.asyncio
+async def test_file_source_skips_malformed_ndjson_lines(tmp_path, caplog):
+    import json
+
+    lines = [json.dumps({'officeId': 'NCE1A0950', 'user': {'userId': 'jdoe'}, 'date': '2024-03-01T10:00:00Z', 'n': 1}),
+             '{"officeId": "NCE1A0950", "user": {"userId": "jd', '["NCE1A0950"]',
+             json.dumps({'officeId': 'NCE1A0950', 'user': {'userId': 'jdoe'}, 'date': '2024-03-02T10:00:00Z', 'n': 2})]
+    (tmp_path / 'app.ndjson').write_text('\n'.join(lines) + '\n')
+
+    logs = await make_file_engine(tmp_path).retrieve([API_CALL])
+
+    assert [hit['n'] for hit in logs['application_logs']] == [1, 2]
+    assert 'Skipped 2 malformed lines' in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_file_source_filters_parquet_date_columns(tmp_path):
+    from datetime import date
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    rows = [{'officeId': 'NCE1A0950', 'user': {'userId': 'jdoe'}, 'date': date(2024, 2, day), 'n': day}
+            for day in range(26, 30)] + \
+           [{'officeId': 'NCE1A0950', 'user': {'userId': 'jdoe'}, 'date': date(2024, 3, day), 'n': 100 + day}
+            for day in range(1, 8)]
+    pq.write_table(pa.Table.from_pylist(rows), tmp_path / 'logs.parquet')
+    assert pq.read_schema(tmp_path / 'logs.parquet').field('date').type == pa.date32()
+
+    logs = await make_file_engine(tmp_path).retrieve([API_CALL])
+
+    assert [hit['n'] for hit in logs['application_logs']] == [101, 102, 103, 104]
@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from unittest.mock import patch
+
+from src.anomaly_detection import AnomalyDetectionModule
+from src.utils.log_statistics import LogStatisticsAnalyzer, severity_confidence
+
+START = datetime(2024, 3, 1, tzinfo=timezone.utc)
+
+
+def event(user, seconds, ip='10.0.0.1', country='FR', action='search', status='ok'):
+    return {
+        'date': (START + timedelta(seconds=seconds)).isoformat(),
+        'user': {'userId': user},
+        'clientIp': ip,
+        'geo': {'country': country},
+        'action': action,
+        'status': status
+    }
+
+
+def incident_logs():
+    # jdoe works normally for two days, then fails to log in 12 times in three minutes from a new address abroad,
+    # and a bot queries every half second
+    normal = [event('jdoe', hour * 3600 + (hour * 937) % 1800) for hour in range(48)]
+    burst = [event('jdoe', 40 * 3600 + 15 * attempt, ip='203.0.113.9', country='RU', action='login', status='failed')
+             for attempt in range(12)]
+    bot = [event('bot', 10 * 3600 + attempt * 0.5, ip='10.0.0.2') for attempt in range(30)]
+    return {'application_logs': normal + bot, 'auth_logs': burst}
+
+
+def test_analyzer_finds_bursts_spikes_novelty_and_automated_timing():
+    analysis = LogStatisticsAnalyzer().analyze(incident_logs())
+
+    summary = analysis['summary']
+    assert summary['events'] == 90
+    assert summary['events_per_source'] == {'application_logs': 78, 'auth_logs': 12}
+    assert summary['failed_logins'] == 12
+    assert summary['unique_users'] == 2
+
+    by_type = {}
+    for candidate in analysis['candidates']:
+        by_type.setdefault(candidate['type'], []).append(candidate)
+    burst = by_type['failed_login_burst'][0]
+    assert burst['supporting_data']['failures'] == 12
+    assert burst['supporting_data']['ips'] == ['203.0.113.9']
+    assert {c['key'] for c in by_type['volume_spike']} == {'jdoe', 'bot'}
+    assert by_type['new_ip'][0]['supporting_data']['ip'] == '203.0.113.9'
+    assert by_type['new_country'][0]['supporting_data']['country'] == 'RU'
+    assert [c['key'] for c in by_type['automated_timing']] == ['bot']
+    scores = [candidate['score'] for candidate in analysis['candidates']]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_analyzer_handles_epoch_timestamps_and_large_inputs():
+    base = int(START.timestamp() * 1000)
+    logs = {'application_logs': [
+        {'date': base + i * 1000, 'user': {'userId': f"user{i % 500}"}, 'clientIp': f"10.0.{i % 7}.1",
+         'action': 'login', 'status': 'failed' if i % 50 == 0 else 'ok'}
+        for i in range(100000)
+    ]}
+
+    summary = LogStatisticsAnalyzer({'max_candidates': 5}).analyze(logs)['summary']
+
+    assert summary['events'] == 100000
+    assert summary['from'] == START.isoformat()
+    assert summary['unique_users'] == 500
+    assert summary['failed_logins'] == 2000
+
+
+def test_novelty_only_builds_the_top_candidates():
+    # Every user switches to a new address for each event of the second half of the window
+    logs = {'application_logs': [
+        event(f"user{user}", hour * 3600 + user, ip='10.0.0.1' if hour < 24 else f"10.1.{user}.{hour}")
+        for user in range(50) for hour in range(48)
+    ] + [event('user0', 3600 + n, ip=f"10.2.0.{n}") for n in range(20)]}
+
+    analyzer = LogStatisticsAnalyzer({'max_candidates': 5, 'max_baseline_values': 3})
+    candidates = analyzer.novelty(analyzer.build_frame(logs), START, START + timedelta(hours=48))
+
+    assert len([candidate for candidate in candidates if candidate['type'] == 'new_ip']) == 5
+    assert all(len(candidate['supporting_data']['baseline_ips']) <= 3 for candidate in candidates)
+
+
+def test_severity_confidence_grows_with_the_threshold_ratio():
+    assert severity_confidence(1) == 0.5
+    assert severity_confidence(2) == 0.75
+    assert severity_confidence(0) == 0.0
+    assert severity_confidence(50) == 0.99
+
+
+@pytest.mark.asyncio
+async def test_detect_without_llm_returns_statistical_anomalies():
+    module = AnomalyDetectionModule({'use_llm': False, 'threshold': 0.8, 'max_anomalies': 5}, {}, None)
+
+    with patch('src.anomaly_detection.get_llm_response') as get_llm_response:
+        anomalies = await module.detect(incident_logs(), {'incident_id': 'INC-1', 'analysis': {}})
+
+    get_llm_response.assert_not_called()
+    assert 0 < len(anomalies) <= 5
+    assert {'automated_timing', 'failed_login_burst'} <= {anomaly['patterns'][0] for anomaly in anomalies}
+    for anomaly in anomalies:
+        assert set(anomaly) == {'description', 'supporting_data', 'potential_implications', 'confidence_score',
+                                'recommended_actions', 'patterns'}
+        assert anomaly['confidence_score'] >= 0.8
+
+
+@pytest.mark.asyncio
+async def test_detect_sends_the_statistical_summary_to_the_llm():
+    module = AnomalyDetectionModule({'use_llm': True, 'threshold': 0.8}, {'context': ''}, None)
+
+    with patch('src.anomaly_detection.get_llm_response', return_value='[]') as get_llm_response:
+        await module.detect(incident_logs(), {'incident_id': 'INC-1', 'analysis': {}})
+
+    prompt = get_llm_response.call_args.args[0]
+    assert '"failed_logins": 12' in prompt
+    assert '"type": "failed_login_burst"' in prompt
@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta, timezone
+
+from src.anomaly_detection import preprocess_logs
+from src.utils.log_templates import LogTemplateMiner, mask
+
+START = datetime(2024, 3, 1, tzinfo=timezone.utc)
+
+
+def timestamp(seconds):
+    return (START + timedelta(seconds=seconds)).isoformat()
+
+
+def test_miner_collapses_messages_into_templates_and_keeps_rare_ones():
+    miner = LogTemplateMiner({'max_exemplars': 1})
+    users = ['jdoe', 'asmith', 'bwayne', 'ckent']
+    for i in range(1000):
+        message = f"Login of user {users[i % 4]} from 10.0.0.{i % 9}"
+        miner.add('auth_logs', {'date': timestamp(i * 60), 'message': message})
+    miner.add('auth_logs', {'date': timestamp(500), 'message': 'Password reset requested for jdoe'})
+
+    assert len(miner.templates) == 2
+    frequent = miner.templates[0]
+    assert frequent.text() == 'Login of user <*> from <*>'
+    assert frequent.count == 1000
+    assert (frequent.first, frequent.last) == (timestamp(0), timestamp(999 * 60))
+
+    lines = miner.render()
+    assert lines[0].startswith(f"[auth_logs template T1] count=1000 first={timestamp(0)} last={timestamp(59940)}")
+    assert lines[1] == '[auth_logs] {"date": "%s", "message": "Password reset requested for jdoe"}' % timestamp(500)
+    assert lines[2].startswith('[auth_logs T1 exemplar] ')
+    assert len(lines) == 3
+
+
+def test_miner_uses_key_value_pairs_of_structured_entries_per_source():
+    miner = LogTemplateMiner()
+    for i in range(200):
+        miner.add('application_logs', {'date': timestamp(i), 'officeId': 'NCE1A0950', 'user': {'userId': f"u{i}"},
+                                       'action': 'search', 'status': 'ok'})
+        miner.add('auth_logs', {'date': timestamp(i), 'action': 'login', 'status': 'ok', 'ip': f"10.0.0.{i % 200}"})
+
+    assert [(template.source, template.text(), template.count) for template in miner.templates] == [
+        ('application_logs', 'action=search officeId=<*> status=ok user.userId=<*>', 200),
+        ('auth_logs', 'action=login ip=<*> status=ok', 200)
+    ]
+    assert mask('clientIp=10.0.0.1') == 'clientIp=<*>'
+    assert mask('search') == 'search'
+
+
+def test_preprocess_logs_covers_the_whole_window_without_truncating():
+    logs = {'application_logs': [
+        {'date': timestamp(i * 10), 'action': ['search', 'book', 'cancel'][i % 3], 'status': 'ok', 'n': i}
+        for i in range(5000)
+    ] + [{'date': timestamp(49990), 'action': 'export', 'status': 'denied', 'n': -1}]}
+
+    compressed = preprocess_logs(logs)
+    assert len(compressed) < 2000
+    assert '[truncated]' not in compressed
+    assert f"last={timestamp(49980)}" in compressed
+    assert '"action": "export"' in compressed
+
+    raw = preprocess_logs(logs, {'templates': {'enabled': False}})
+    assert raw.endswith('... [truncated]')
+    assert '"action": "export"' not in raw
@@ -0,0 +1,159 @@
+import asyncio
+import json
+import os
+
+import numpy as np
+import pytest
+from unittest.mock import patch
+
+from src.utils.rag import RAG, KnowledgeBaseRefresher
+
+
+class FakeSentenceTransformer:
+    def __init__(self, model_name):
+        self.encoded = 0
+        self.calls = 0
+
+    def encode(self, texts):
+        self.encoded += len(texts)
+        self.calls += 1
+        vectors = np.zeros((len(texts), 16), dtype='float32')
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                vectors[row, sum(map(ord, word)) % 16] += 1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+@pytest.fixture
+def knowledge_base(tmp_path):
+    path = tmp_path / 'kb.json'
+    path.write_text(json.dumps([
+        {'content': 'password spraying against agent accounts'},
+        {'content': 'refund fraud through duplicate bookings'},
+        {'content': 'login from an unusual country'}
+    ]))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def fake_sentence_transformer():
+    with patch('src.utils.rag.SentenceTransformer', FakeSentenceTransformer):
+        yield
+
+
+def test_rag_persists_and_reloads_index(tmp_path, knowledge_base):
+    index_dir = str(tmp_path / 'index')
+    first = RAG(str(knowledge_base), index_dir=index_dir)
+    assert first.sentence_model.encoded == 3
+
+    second = RAG(str(knowledge_base), index_dir=index_dir)
+    assert second.sentence_model.encoded == 0
+    assert second.index.ntotal == 3
+    assert second.retrieve('refund fraud through duplicate bookings')[0]['content'].startswith('refund')
+
+
+def test_rag_reembeds_only_changed_documents(tmp_path, knowledge_base):
+    index_dir = str(tmp_path / 'index')
+    RAG(str(knowledge_base), index_dir=index_dir)
+
+    documents = json.loads(knowledge_base.read_text())
+    documents.append({'content': 'gift card abuse'})
+    knowledge_base.write_text(json.dumps(documents))
+
+    rag = RAG(str(knowledge_base), index_dir=index_dir)
+    assert rag.sentence_model.encoded == 1
+    assert rag.index.ntotal == 4
+
+
+def test_rag_applies_incremental_updates_by_id(knowledge_base):
+    rag = RAG(str(knowledge_base))
+    rag.add_documents([{'id': 'kb-1', 'content': 'gift card abuse'}])
+    rag.update_documents([{'id': 'kb-1', 'content': 'gift card abuse by travel agents'}])
+    assert rag.index.ntotal == 4
+    assert rag.sentence_model.encoded == 5
+    assert rag.retrieve('gift card abuse by travel agents')[0]['id'] == 'kb-1'
+
+    rag.delete_documents(['kb-1'])
+    assert rag.index.ntotal == 3
+    assert all(item.get('id') != 'kb-1' for item in rag.knowledge_base)
+
+
+@pytest.mark.asyncio
+async def test_knowledge_base_refresher_syncs_changed_documents(tmp_path):
+    kb_dir = tmp_path / 'kb'
+    kb_dir.mkdir()
+    (kb_dir / 'fraud.json').write_text(json.dumps([{'id': 'a', 'content': 'refund fraud'}]))
+    rag = RAG(str(kb_dir))
+    refresher = KnowledgeBaseRefresher(rag, str(kb_dir), 3600)
+
+    (kb_dir / 'access.json').write_text(json.dumps({'id': 'b', 'content': 'login from an unusual country'}))
+    os.utime(kb_dir / 'access.json', (refresher.last_mtime + 10, refresher.last_mtime + 10))
+
+    assert await refresher.refresh()
+    assert rag.index.ntotal == 2
+    assert rag.sentence_model.encoded == 2
+    assert not await refresher.refresh()
+
+
+@pytest.mark.parametrize('index_type', ['flat', 'ivf', 'hnsw', 'sq8'])
+def test_rag_index_types_survive_reload_and_updates(tmp_path, knowledge_base, index_type):
+    index_dir = str(tmp_path / 'index')
+    RAG(str(knowledge_base), index_dir=index_dir, index_config={'type': index_type})
+    # Quantizers trained on three documents are coarse, only the ranking is checked
+    rag = RAG(str(knowledge_base), index_dir=index_dir, similarity_threshold=0.0, index_config={'type': index_type})
+    assert rag.sentence_model.encoded == 0
+
+    rag.add_documents([{'id': 'kb-1', 'content': 'gift card abuse'}])
+    rag.delete_documents(['kb-1'])
+    rag.add_documents([{'id': 'kb-2', 'content': 'seat blocking by bots'}])
+    assert rag.index.ntotal == 4
+    assert rag.retrieve('seat blocking by bots')[0]['id'] == 'kb-2'
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/maps'), reason='needs /proc to list the mapped files')
+@pytest.mark.parametrize('index_type', ['flat', 'ivf', 'hnsw', 'sq8'])
+def test_rag_memory_maps_the_persisted_index(tmp_path, knowledge_base, index_type):
+    index_dir = str(tmp_path / 'index')
+    RAG(str(knowledge_base), index_dir=index_dir, index_config={'type': index_type})
+    rag = RAG(str(knowledge_base), index_dir=index_dir, similarity_threshold=0.0, index_config={'type': index_type})
+
+    with open('/proc/self/maps') as f:
+        mapped = f.read()
+    assert os.path.join(index_dir, 'index.faiss') in mapped
+    assert rag.retrieve('refund fraud through duplicate bookings')
+
+
+def test_rag_reuses_embeddings_when_index_type_changes(tmp_path, knowledge_base):
+    index_dir = str(tmp_path / 'index')
+    RAG(str(knowledge_base), index_dir=index_dir)
+    rag = RAG(str(knowledge_base), index_dir=index_dir, index_config={'type': 'hnsw'})
+    assert rag.sentence_model.encoded == 0
+    assert rag.index.ntotal == 3
+
+
+def test_rag_threshold_is_a_cosine_similarity(knowledge_base):
+    rag = RAG(str(knowledge_base), similarity_threshold=0.99)
+    assert rag.retrieve('refund fraud through duplicate bookings')[0]['content'].startswith('refund')
+    assert rag.retrieve('seat blocking by bots') == []
+
+
+@pytest.mark.asyncio
+async def test_rag_batches_and_caches_concurrent_queries(knowledge_base):
+    rag = RAG(str(knowledge_base))
+    calls = rag.sentence_model.calls
+    refund, login, duplicate = await asyncio.gather(
+        rag.aretrieve('refund fraud through duplicate bookings'),
+        rag.aretrieve('login from an unusual country'),
+        rag.aretrieve('refund fraud through duplicate bookings')
+    )
+    assert rag.sentence_model.calls == calls + 1
+    assert rag.sentence_model.encoded == 5
+    assert refund == duplicate
+    assert refund[0]['content'].startswith('refund')
+    assert login[0]['content'].startswith('login')
+
+    await rag.aretrieve('login from an unusual country')
+    assert rag.sentence_model.calls == calls + 1
+    assert rag.stats()['query_cache_hits'] == 1
+    rag.close()
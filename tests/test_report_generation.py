@@ -0,0 +1,38 @@
+import asyncio
+import json
+
+import pytest
+from unittest.mock import patch
+
+from src import report_generation
+from src.report_generation import ReportGenerationModule, StreamingStory
+
+
+@pytest.mark.asyncio
+async def test_streamed_report_is_laid_out_while_the_completion_streams(tmp_path):
+    module = ReportGenerationModule({'output_format': 'pdf', 'output_path': str(tmp_path)}, {'streaming': True})
+    anomalies = [{'description': 'Burst of failed logins', 'confidence_score': 0.9,
+                  'potential_implications': 'Brute force', 'recommended_actions': ['Lock account']}]
+    stories, laid_out = [], []
+
+    def streaming_story(flowables=()):
+        stories.append(StreamingStory(flowables))
+        return stories[-1]
+
+    async def stream_llm_response(*args, **kwargs):
+        yield '[' + json.dumps({'section_title': 'Executive Summary', 'content': 'Brute force on jdoe'}) + ','
+        # doc.build() consumes the first section before the rest of the completion arrives
+        for _ in range(500):
+            if list.__len__(stories[0]) == 0:
+                break
+            await asyncio.sleep(0.01)
+        laid_out.append(list.__len__(stories[0]) == 0)
+        yield json.dumps({'section_title': 'Conclusion', 'content': ['Lock the account']}) + ']'
+
+    with patch.object(report_generation, 'StreamingStory', side_effect=streaming_story), \
+            patch.object(report_generation, 'stream_llm_response', stream_llm_response):
+        report = await module.generate_streaming('prompt', {'id': 'INC-1'}, anomalies)
+
+    assert laid_out == [True]
+    assert report.startswith(b'%PDF')
+    assert (tmp_path / 'fraud_report.pdf').read_bytes() == report